@@ -0,0 +1,458 @@
+"""
+Replays synthetic raid traffic through the Logger event handlers and reports what each event costs.
+
+The plugin runs against an in-memory, mongomock-style plugin DB and fake channels that record what is sent,
+so every database round trip, REST call and embed can be counted. For each kind of event, it reports DB round
+trips, REST calls, embeds and messages sent per event, and handler latency percentiles::
+
+    PYTHONPATH=/path/to/modmail python -m logger.bench.replay --events 2000 --json replay.json
+    PYTHONPATH=/path/to/modmail python -m logger.bench.replay --check replay.json
+
+With --check, it exits with an error when an event costs more round trips, REST calls or sends than in the
+given report, such as an extra find_one per delete. Nothing here is loaded by the plugin.
+"""
+
+import argparse
+import asyncio
+import copy
+import datetime
+import json
+import random
+import re
+import sys
+import time
+import typing
+from types import SimpleNamespace
+
+import discord
+from discord.enums import AuditLogAction
+from discord.utils import time_snowflake
+from pymongo.errors import PyMongoError
+
+from logger.logger import Logger
+
+GUILD_ID = 1000
+LOG_CHANNEL_ID = 1001
+BOT_USER_ID = 1
+EVENTS = ('message', 'message_delete', 'message_edit', 'bulk_message_delete', 'audit_logs')
+
+
+class Counters:
+    def __init__(self):
+        self.round_trips = 0
+        self.rest = 0
+        self.messages = 0
+        self.embeds = 0
+
+    def snapshot(self) -> dict:
+        return dict(vars(self))
+
+
+# Fake plugin DB
+
+def _values(doc, path: str) -> list:
+    values = [doc]
+    for key in path.split('.'):
+        found = []
+        for value in values:
+            if isinstance(value, list):
+                found.extend(v.get(key) for v in value if isinstance(v, dict) and key in v)
+            elif isinstance(value, dict) and key in value:
+                found.append(value[key])
+        values = found
+    flat = []
+    for value in values:
+        flat.extend(value if isinstance(value, list) else [value])
+    return flat
+
+
+def _matches(doc: dict, query: dict) -> bool:
+    for path, expected in query.items():
+        values = _values(doc, path)
+        if isinstance(expected, dict) and '$regex' in expected:
+            if not any(isinstance(v, str) and re.search(expected['$regex'], v) for v in values):
+                return False
+        elif expected not in values:
+            return False
+    return True
+
+
+class FakeCursor:
+    def __init__(self, docs: typing.List[dict]):
+        self._docs = iter(docs)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return copy.deepcopy(next(self._docs))
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeCollection:
+    """
+    Just enough of a motor collection for the plugin, every query counts as a round trip.
+    """
+
+    def __init__(self, counters: Counters, docs: typing.Iterable[dict] = ()):
+        self.counters = counters
+        self.docs = [copy.deepcopy(d) for d in docs]
+
+    def _find(self, query: dict) -> typing.List[dict]:
+        return [d for d in self.docs if _matches(d, query)]
+
+    async def find_one(self, query: dict, projection=None):
+        self.counters.round_trips += 1
+        found = self._find(query)
+        return copy.deepcopy(found[0]) if found else None
+
+    def find(self, query: dict, projection=None) -> FakeCursor:
+        self.counters.round_trips += 1
+        return FakeCursor(self._find(query))
+
+    async def count_documents(self, query: dict, limit: int = 0) -> int:
+        self.counters.round_trips += 1
+        count = len(self._find(query))
+        return min(count, limit) if limit else count
+
+    async def find_one_and_update(self, query: dict, update: dict, upsert: bool = False, return_document=False):
+        self.counters.round_trips += 1
+        found = self._find(query)
+        if not found:
+            if not upsert:
+                return None
+            doc = {k: v for k, v in query.items() if not isinstance(v, dict)}
+            self.docs.append(doc)
+        else:
+            doc = found[0]
+        before = copy.deepcopy(doc) if found else None
+        doc.update(update.get('$set', {}))
+        # ReturnDocument.AFTER is True
+        return copy.deepcopy(doc) if return_document else before
+
+    def watch(self, pipeline=None):
+        raise PyMongoError('Change streams need a replica set')
+
+
+# Fake Discord objects
+
+class FakeUser:
+    def __init__(self, id: int, name: str, bot: bool = False):
+        self.id = id
+        self.name = name
+        self.discriminator = f'{id % 10000:04d}'
+        self.bot = bot
+        self.mention = f'<@{id}>'
+
+    def __str__(self):
+        return f'{self.name}#{self.discriminator}'
+
+
+class FakeMessage:
+    def __init__(self, id: int, channel: 'FakeChannel', author: FakeUser, content: str):
+        self.id = id
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.created_at = discord.utils.snowflake_time(id)
+        self.jump_url = f'https://discord.com/channels/{channel.guild.id}/{channel.id}/{id}'
+
+
+class FakeChannel:
+    def __init__(self, id: int, name: str, guild: 'FakeGuild', counters: Counters):
+        self.id = id
+        self.name = name
+        self.guild = guild
+        self.category = None
+        self.mention = f'<#{id}>'
+        self.counters = counters
+        self.messages: typing.Dict[int, FakeMessage] = {}
+
+    def permissions_for(self, member):
+        # No webhooks, every batch is sent as plain messages
+        return SimpleNamespace(manage_webhooks=False, read_messages=True, send_messages=True)
+
+    async def send(self, content=None, *, embed=None, file=None):
+        self.counters.rest += 1
+        self.counters.messages += 1
+        self.counters.embeds += embed is not None
+
+    async def fetch_message(self, id: int) -> FakeMessage:
+        self.counters.rest += 1
+        if id not in self.messages:
+            raise discord.NotFound(SimpleNamespace(status=404, reason='Not Found'), 'Unknown Message')
+        return self.messages[id]
+
+
+class FakeGuild:
+    def __init__(self, id: int, counters: Counters):
+        self.id = id
+        self.counters = counters
+        self.channels: typing.Dict[int, FakeChannel] = {}
+        self.audit_entries: typing.List[SimpleNamespace] = []
+        self.me = FakeUser(BOT_USER_ID, 'Modmail', bot=True)
+
+    def add_channel(self, id: int, name: str) -> FakeChannel:
+        channel = self.channels[id] = FakeChannel(id, name, self, self.counters)
+        return channel
+
+    def get_channel(self, id: int) -> typing.Optional[FakeChannel]:
+        return self.channels.get(id)
+
+    async def audit_logs(self, *, limit=100, after=None, oldest_first=False):
+        self.counters.rest += 1
+        entries = [e for e in self.audit_entries if after is None or e.id > after.id]
+        entries.sort(key=lambda e: e.id, reverse=not oldest_first)
+        for entry in entries[:limit]:
+            yield entry
+
+
+class FakePasteBackend:
+    name = 'fake paste'
+
+    def __init__(self, counters: Counters, latency: float):
+        self.counters = counters
+        self.latency = latency
+
+    async def upload(self, session, text: str) -> str:
+        self.counters.rest += 1
+        await asyncio.sleep(self.latency)
+        return 'https://paste.invalid/replay'
+
+
+class FakeBot:
+    def __init__(self, counters: Counters, guild: FakeGuild, logs: typing.List[dict]):
+        self.loop = asyncio.get_event_loop()
+        self.guild_id = guild.id
+        self.guild = self.modmail_guild = guild
+        self.user = guild.me
+        self.prefix = '?'
+        self.main_color = 0x7289da
+        self.session = None
+        self.db = SimpleNamespace(logs=FakeCollection(counters, logs))
+        self._plugin_db = FakeCollection(counters, [{'_id': 'logger-config', 'channel_id': LOG_CHANNEL_ID}])
+        self.plugin_db = SimpleNamespace(get_partition=lambda cog: self._plugin_db)
+
+    def get_guild(self, id: int):
+        return self.guild if id == self.guild.id else None
+
+    def get_channel(self, id: int):
+        return self.guild.get_channel(id)
+
+    async def wait_until_ready(self):
+        return
+
+
+# Synthetic traffic
+
+class PayloadGenerator:
+    def __init__(self, rng: random.Random, guild: FakeGuild, channels: typing.List[FakeChannel],
+                 users: typing.List[FakeUser]):
+        self.rng = rng
+        self.guild = guild
+        self.channels = channels
+        self.users = users
+        self.sent: typing.List[FakeMessage] = []
+        self._next_id = time_snowflake(datetime.datetime.utcnow())
+
+    def _id(self) -> int:
+        self._next_id += 1 << 22
+        return self._next_id
+
+    def message(self) -> FakeMessage:
+        channel = self.rng.choice(self.channels)
+        words = self.rng.randint(1, 40)
+        content = ' '.join(self.rng.choice(('raid', 'spam', 'hello', 'join', 'free', 'nitro')) for _ in range(words))
+        message = FakeMessage(self._id(), channel, self.rng.choice(self.users), content)
+        channel.messages[message.id] = message
+        self.sent.append(message)
+        return message
+
+    def _known_or_unknown(self, known: float) -> typing.Tuple[int, int]:
+        if self.sent and self.rng.random() < known:
+            message = self.rng.choice(self.sent)
+            return message.id, message.channel.id
+        return self._id(), self.rng.choice(self.channels).id
+
+    def delete(self, known: float = 0.8) -> discord.RawMessageDeleteEvent:
+        message_id, channel_id = self._known_or_unknown(known)
+        return discord.RawMessageDeleteEvent({'id': message_id, 'channel_id': channel_id, 'guild_id': self.guild.id})
+
+    def edit(self, known: float = 0.8) -> discord.RawMessageUpdateEvent:
+        message_id, channel_id = self._known_or_unknown(known)
+        return discord.RawMessageUpdateEvent({'id': message_id, 'channel_id': channel_id,
+                                              'guild_id': str(self.guild.id), 'content': f'edited {message_id}'})
+
+    def bulk_delete(self, size: int = 50) -> discord.RawBulkMessageDeleteEvent:
+        channel = self.rng.choice(self.channels)
+        known = [m.id for m in self.sent if m.channel is channel][-size // 2:]
+        ids = known + [self._id() for _ in range(size - len(known))]
+        return discord.RawBulkMessageDeleteEvent({'ids': ids, 'channel_id': channel.id, 'guild_id': self.guild.id})
+
+    def audit_entry(self, moderator: FakeUser) -> SimpleNamespace:
+        action = self.rng.choice((AuditLogAction.message_delete, AuditLogAction.kick, AuditLogAction.ban))
+        target = self.rng.choice(self.users)
+        channel = self.rng.choice(self.channels)
+        return SimpleNamespace(
+            id=self._id(), action=action, user=moderator, target=target, reason='Raid',
+            created_at=datetime.datetime.utcnow(), before=None, after=None,
+            extra=SimpleNamespace(channel=channel, count=self.rng.randint(1, 5)),
+        )
+
+
+def percentile(latencies: typing.List[float], p: float) -> float:
+    if not latencies:
+        return 0.0
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000
+
+
+async def drain(cog: Logger) -> None:
+    # Uploads first, their callbacks queue more embeds
+    while cog.uploader._pending:
+        await asyncio.gather(*list(cog.uploader._pending), return_exceptions=True)
+        await asyncio.sleep(0)
+    for writer in list(cog._writers.values()):
+        await writer.flush()
+
+
+async def run_phase(name: str, cog: Logger, counters: Counters, calls: typing.List[typing.Callable],
+                    concurrency: int) -> dict:
+    before = counters.snapshot()
+    latencies = []
+
+    async def timed(call):
+        start = time.perf_counter()
+        await call()
+        latencies.append(time.perf_counter() - start)
+
+    for i in range(0, len(calls), concurrency):
+        await asyncio.gather(*(timed(call) for call in calls[i:i + concurrency]))
+    await drain(cog)
+
+    after = counters.snapshot()
+    events = len(calls) or 1
+    return dict(
+        event=name,
+        events=len(calls),
+        round_trips_per_event=(after['round_trips'] - before['round_trips']) / events,
+        rest_per_event=(after['rest'] - before['rest']) / events,
+        embeds_per_event=(after['embeds'] - before['embeds']) / events,
+        messages_per_event=(after['messages'] - before['messages']) / events,
+        p50_ms=percentile(latencies, 0.5),
+        p95_ms=percentile(latencies, 0.95),
+        p99_ms=percentile(latencies, 0.99),
+    )
+
+
+async def run(args) -> typing.List[dict]:
+    rng = random.Random(args.seed)
+    counters = Counters()
+    guild = FakeGuild(GUILD_ID, counters)
+    guild.add_channel(LOG_CHANNEL_ID, 'modmail-logger')
+    channels = [guild.add_channel(2000 + i, f'general-{i}') for i in range(args.channels)]
+    threads = [guild.add_channel(3000 + i, f'thread-{i}') for i in range(args.threads)]
+    users = [FakeUser(10_000 + i, f'user{i}') for i in range(args.users)]
+    moderator = FakeUser(9, 'moderator')
+    logs = [{'open': True, 'channel_id': str(t.id), 'messages': [{'message_id': str(rng.getrandbits(60)),
+                                                                  'type': 'thread_message'} for _ in range(20)]}
+            for t in threads]
+
+    bot = FakeBot(counters, guild, logs)
+    cog = Logger(bot)
+    # Fetched by hand below, so background fetches don't land in other events' counts
+    cog.audit_logs_logger.cancel()
+    cog.refresh_config.cancel()
+    cog.uploader.backend = FakePasteBackend(counters, args.paste_latency)
+    await cog._states_loaded
+    await cog.thread_messages._warming
+    state = cog.states[GUILD_ID]
+    await state.load_audit_cursor()
+
+    gen = PayloadGenerator(rng, guild, channels + threads, users)
+    n = args.events
+    results = []
+    try:
+        messages = [gen.message() for _ in range(n)]
+        results.append(await run_phase('message', cog, counters,
+                                       [lambda m=m: cog.on_message(m) for m in messages], args.concurrency))
+        deletes = [gen.delete() for _ in range(n)]
+        results.append(await run_phase('message_delete', cog, counters,
+                                       [lambda p=p: cog.on_raw_message_delete(p) for p in deletes],
+                                       args.concurrency))
+        edits = [gen.edit() for _ in range(n)]
+        results.append(await run_phase('message_edit', cog, counters,
+                                       [lambda p=p: cog.on_raw_message_edit(p) for p in edits], args.concurrency))
+        bulks = [gen.bulk_delete(args.bulk_size) for _ in range(max(n // 50, 1))]
+        results.append(await run_phase('bulk_message_delete', cog, counters,
+                                       [lambda p=p: cog.on_raw_bulk_message_delete(p) for p in bulks],
+                                       args.concurrency))
+
+        guild.audit_entries = [gen.audit_entry(moderator) for _ in range(n)]
+        pages = -(-n // cog.AUDIT_LOG_BATCH)
+        # Pages have to be fetched in order, from the cursor
+        results.append(await run_phase('audit_logs', cog, counters,
+                                       [lambda: cog.fetch_audit_logs(state)] * pages, 1))
+    finally:
+        cog.cog_unload()
+        await asyncio.sleep(0)
+    return results
+
+
+def print_report(results: typing.List[dict]) -> None:
+    print(f"{'event':22} {'events':>7} {'db/ev':>7} {'rest/ev':>8} {'embeds/ev':>10} {'msgs/ev':>8} "
+          f"{'p50':>9} {'p95':>9} {'p99':>9}")
+    for r in results:
+        print(f"{r['event']:22} {r['events']:>7} {r['round_trips_per_event']:>7.2f} {r['rest_per_event']:>8.2f} "
+              f"{r['embeds_per_event']:>10.2f} {r['messages_per_event']:>8.2f} {r['p50_ms']:>7.2f}ms "
+              f"{r['p95_ms']:>7.2f}ms {r['p99_ms']:>7.2f}ms")
+
+
+def regressions(results: typing.List[dict], baseline: typing.List[dict], tolerance: float) -> typing.List[str]:
+    previous = {r['event']: r for r in baseline}
+    found = []
+    for r in results:
+        old = previous.get(r['event'])
+        if old is None:
+            continue
+        for key in ('round_trips_per_event', 'rest_per_event', 'embeds_per_event', 'messages_per_event'):
+            if r[key] > old[key] + tolerance:
+                found.append(f"{r['event']}: {key} went from {old[key]:.2f} to {r[key]:.2f}")
+    return found
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=1000, help='events of each kind')
+    parser.add_argument('--concurrency', type=int, default=50, help='events handled at once')
+    parser.add_argument('--channels', type=int, default=20)
+    parser.add_argument('--threads', type=int, default=10, help='open Modmail thread channels')
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--bulk-size', type=int, default=50, help='messages in each bulk delete')
+    parser.add_argument('--paste-latency', type=float, default=0.05, help='seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write the report to this file')
+    parser.add_argument('--check', help='fail if any event costs more than in this report')
+    parser.add_argument('--tolerance', type=float, default=0.05, help='allowed increase per event for --check')
+    args = parser.parse_args()
+
+    # discord.ext.tasks loops are bound to the default loop when the plugin is imported
+    results = asyncio.get_event_loop().run_until_complete(run(args))
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.check:
+        with open(args.check) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print('Regression:', line)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
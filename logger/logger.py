@@ -1,14 +1,30 @@
+import abc
+import asyncio
 import datetime
+import gzip
+import hashlib
+import io
+import json
+import math
+import os
+import shutil
+import sqlite3
 import typing
+from collections import OrderedDict, deque
+from concurrent import futures
 from logging import getLogger
 from json import JSONDecodeError
 
-from aiohttp import ClientResponseError
+from aiohttp import ClientError
 
-from discord import Embed, TextChannel, NotFound, CategoryChannel, PermissionOverwrite
+from discord import (utils, Embed, File, TextChannel, User, NotFound, CategoryChannel, PermissionOverwrite,
+                     HTTPException, Object)
 from discord.ext import commands, tasks
 from discord.enums import AuditLogAction
-from discord.utils import escape_markdown, escape_mentions
+from discord.utils import escape_markdown, escape_mentions, snowflake_time, time_snowflake
+
+from pymongo import ReturnDocument
+from pymongo.errors import PyMongoError
 
 from core import checks
 from core.models import PermissionLevel
@@ -16,6 +32,10 @@ from core.models import PermissionLevel
 
 logger = getLogger('Modmail')
 
+LOCAL_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs', 'logger.sqlite3')
+# Units of durations in search times, such as 12h
+SEARCH_TIME_UNITS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
 
 def loop_(*, seconds=0, minutes=0, hours=0, count=None, reconnect=True, loop=None):
     def decorator(func):
@@ -30,24 +50,766 @@ def escape(s):
     return escape_mentions(escape_markdown(str(s)))
 
 
+def parse_search_time(value):
+    """
+    A UTC timestamp from an ISO date or time, or from a duration ago such as 30m, 12h or 7d.
+    """
+    unit = SEARCH_TIME_UNITS.get(value[-1:].lower())
+    if unit is not None and value[:-1].isdigit():
+        return datetime.datetime.now(datetime.timezone.utc).timestamp() - int(value[:-1]) * unit
+    try:
+        time = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'Unknown time "{escape(value)}", use a date such as 2021-05-01, '
+                         'a time such as 2021-05-01T18:30 or a duration such as 12h.') from None
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=datetime.timezone.utc)
+    return time.timestamp()
+
+
+class LoggerConfig:
+    """
+    In-memory copy of a guild's logger-config document.
+
+    Commands write through it, and it is refreshed from the database on changes, so event handlers never wait on it.
+    """
+    TTL = 300
+
+    def __init__(self, db, id='logger-config'):
+        self.db = db
+        self.id = id
+        self.loaded = False
+        self.channel_id = None
+        self.log_modmail = True
+        self.log_bot = False
+        self.local_log = False
+        self.no_log: typing.Set[str] = set()
+
+    def _apply(self, config):
+        self.channel_id = config.get('channel_id')
+        log_modmail = config.get('log_modmail')
+        self.log_modmail = log_modmail if isinstance(log_modmail, bool) else True
+        log_bot = config.get('log_bot')
+        self.log_bot = log_bot if isinstance(log_bot, bool) else False
+        self.local_log = config.get('local_log') is True
+        self.no_log = set(map(str, config.get('no_log', [])))
+        self.loaded = True
+
+    async def refresh(self):
+        self._apply(await self.db.find_one({'_id': self.id}) or {})
+
+    async def update(self, **values):
+        config = await self.db.find_one_and_update(
+            {'_id': self.id},
+            {'$set': values},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        self._apply(config)
+
+
+class GuildState:
+    """
+    The config, log channel and audit log cursor of one guild.
+
+    The main guild keeps the document IDs from before guilds had their own state.
+    """
+
+    def __init__(self, bot, db, guild_id):
+        self.bot = bot
+        self.db = db
+        self.guild_id = guild_id
+        suffix = '' if guild_id == bot.guild_id else f'-{guild_id}'
+        self.config = LoggerConfig(db, f'logger-config{suffix}')
+        self.cursor_id = f'audit-cursor{suffix}'
+        self.audit_cursor = None
+        # Whether it's waiting for its turn in the audit log scheduler
+        self.audit_pending = False
+        self.audit_requested_at = 0
+        self.audit_deferred: typing.Optional[asyncio.TimerHandle] = None
+        self._channel = None
+
+    @property
+    def guild(self):
+        return self.bot.get_guild(self.guild_id)
+
+    async def refresh(self):
+        channel_id = self.config.channel_id
+        await self.config.refresh()
+        if self.config.channel_id != channel_id:
+            self._channel = None
+
+    async def set_log_channel(self, channel):
+        await self.config.update(channel_id=channel.id)
+        self._channel = channel
+
+    def get_log_channel(self):
+        if self._channel is not None:
+            return self._channel
+        channel_id = self.config.channel_id
+        if channel_id is None:
+            raise ValueError(f'No logger channel specified, set one with `{self.bot.prefix}logger channel #channel`.')
+        guild = self.guild
+        channel = guild and guild.get_channel(channel_id)
+        if channel is None and self.guild_id == self.bot.guild_id:
+            channel = self.bot.modmail_guild.get_channel(channel_id)
+        if channel is None:
+            logger.error('Logger channel with ID `%s` not found.', channel_id)
+            raise ValueError(f'Logger channel with ID `{channel_id}` not found.')
+        self._channel = channel
+        return channel
+
+    def _ensure_configured(self):
+        if self.config.channel_id is None:
+            raise ValueError(f'No logger channel specified, set one with `{self.bot.prefix}logger channel #channel`.')
+
+    def is_log_modmail(self):
+        self._ensure_configured()
+        return self.config.log_bot and self.config.log_modmail
+
+    def is_log_bot(self):
+        self._ensure_configured()
+        return self.config.log_bot
+
+    def is_logged(self, id):
+        self._ensure_configured()
+        return str(id) not in self.config.no_log
+
+    async def load_audit_cursor(self):
+        cursor = await self.db.find_one({'_id': self.cursor_id})
+        if cursor is None:
+            # Nothing from before the first start
+            self.audit_cursor = time_snowflake(datetime.datetime.utcnow())
+            await self.save_audit_cursor()
+        else:
+            self.audit_cursor = cursor['after']
+
+    async def save_audit_cursor(self):
+        await self.db.find_one_and_update(
+            {'_id': self.cursor_id},
+            {'$set': {'after': self.audit_cursor}},
+            upsert=True
+        )
+
+
+class BloomFilter:
+    """
+    Set membership without false negatives, in a fixed amount of memory.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _indexes(self, key):
+        digest = hashlib.blake2b(str(key).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, key):
+        for i in self._indexes(key):
+            self.bits[i >> 3] |= 1 << (i & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[i >> 3] & (1 << (i & 7)) for i in self._indexes(key))
+
+
+class ThreadMessageIndex:
+    """
+    Answers whether a message ID is a logged thread message, mostly without asking the database.
+
+    Thread messages only exist in open thread channels, whose messages are all added to a bloom filter.
+    Possible hits are confirmed with the logs collection and remembered in a bounded LRU.
+    """
+    CAPACITY = 200_000
+    LRU_SIZE = 5000
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.ready = False
+        self.channels: typing.Set[int] = set()
+        self.bloom = BloomFilter(self.CAPACITY)
+        self.lru: typing.OrderedDict[int, bool] = OrderedDict()
+        self._warming = None
+
+    async def _query(self, message_id):
+        return bool(await self.bot.db.logs.count_documents(
+            {"messages.message_id": str(message_id), "messages.type": "thread_message"}, limit=1))
+
+    async def warm(self):
+        channels = set()
+        bloom = BloomFilter(self.CAPACITY)
+        async for log in self.bot.db.logs.find({'open': True}, {'channel_id': 1, 'messages.message_id': 1}):
+            if log.get('channel_id'):
+                channels.add(int(log['channel_id']))
+            for message in log.get('messages', []):
+                if message.get('message_id'):
+                    bloom.add(int(message['message_id']))
+        # Threads opened while warming up
+        self.channels = channels | self.channels
+        self.bloom = bloom
+        self.lru.clear()
+        self.ready = True
+        logger.debug('Indexed %s thread messages in %s threads.', bloom.count, len(channels))
+
+    def rewarm(self):
+        if self._warming is None or self._warming.done():
+            self._warming = self.bot.loop.create_task(self.warm())
+
+    def add_channel(self, channel_id):
+        self.channels.add(channel_id)
+
+    def remove_channel(self, channel_id):
+        # The channel is deleted along with its messages
+        self.channels.discard(channel_id)
+
+    def add_message(self, channel_id, message_id):
+        if channel_id not in self.channels:
+            return
+        self.bloom.add(message_id)
+        if self.bloom.count > self.bloom.capacity:
+            self.rewarm()
+
+    async def contains(self, channel_id, message_id):
+        if not self.ready:
+            return await self._query(message_id)
+        if channel_id not in self.channels:
+            return False
+        if message_id in self.lru:
+            self.lru.move_to_end(message_id)
+            return self.lru[message_id]
+        if message_id not in self.bloom:
+            return False
+        found = self.lru[message_id] = await self._query(message_id)
+        if len(self.lru) > self.LRU_SIZE:
+            self.lru.popitem(last=False)
+        return found
+
+
+class StoredAuthor(typing.NamedTuple):
+    id: int
+    bot: bool
+    name: str
+    discriminator: str
+
+    @property
+    def mention(self):
+        return f'<@{self.id}>'
+
+
+class StoredMessage:
+    """
+    Stands in for a message that is no longer in discord.py's cache.
+    """
+    __slots__ = ('id', 'channel', 'author', 'content')
+
+    def __init__(self, id, channel, author, content):
+        self.id = id
+        self.channel = channel
+        self.author = author
+        self.content = content
+
+    @property
+    def created_at(self):
+        return snowflake_time(self.id)
+
+    @property
+    def jump_url(self):
+        return f'https://discord.com/channels/{self.channel.guild.id}/{self.channel.id}/{self.id}'
+
+
+class MessageStore:
+    """
+    Keeps the content and author of recent messages, for edits and deletes that miss discord.py's cache.
+
+    Each guild has a budget in bytes, and all guilds share a total budget. The oldest messages are dropped first,
+    from the guild using the most once the total budget is reached.
+    """
+    BUDGET = 16 * 1024 * 1024
+    TOTAL_BUDGET = 64 * 1024 * 1024
+    # Rough per-message overhead on top of its content
+    OVERHEAD = 200
+
+    def __init__(self, bot, budget=BUDGET, total_budget=TOTAL_BUDGET):
+        self.bot = bot
+        self.budget = budget
+        self.total_budget = total_budget
+        self.total = 0
+        self._messages: typing.Dict[int, OrderedDict] = {}
+        self._sizes: typing.Dict[int, int] = {}
+
+    def _size(self, content):
+        return len(content.encode()) + self.OVERHEAD
+
+    def _evict_oldest(self, gid):
+        messages = self._messages[gid]
+        *_, content = messages.popitem(last=False)[1]
+        self._resize(gid, -self._size(content))
+        if not messages:
+            del self._messages[gid], self._sizes[gid]
+
+    def _resize(self, gid, delta):
+        self._sizes[gid] += delta
+        self.total += delta
+
+    def add(self, message):
+        gid = message.guild.id
+        messages = self._messages.setdefault(gid, OrderedDict())
+        self._sizes.setdefault(gid, 0)
+        self._discard(gid, message.id)
+        author = StoredAuthor(message.author.id, message.author.bot, message.author.name, message.author.discriminator)
+        messages[message.id] = message.channel.id, author, message.content
+        self._resize(gid, self._size(message.content))
+        while self._sizes.get(gid, 0) > self.budget:
+            self._evict_oldest(gid)
+        while self.total > self.total_budget:
+            self._evict_oldest(max(self._sizes, key=self._sizes.get))
+
+    def _discard(self, gid, message_id):
+        entry = self._messages.get(gid, {}).pop(message_id, None)
+        if entry is not None:
+            self._resize(gid, -self._size(entry[2]))
+        return entry
+
+    def get(self, gid, message_id):
+        entry = self._messages.get(gid, {}).get(message_id)
+        if entry is None:
+            return None
+        channel_id, author, content = entry
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            return None
+        return StoredMessage(message_id, channel, author, content)
+
+    def update(self, gid, message_id, content):
+        entry = self._messages.get(gid, {}).get(message_id)
+        if entry is not None:
+            self._resize(gid, self._size(content) - self._size(entry[2]))
+            self._messages[gid][message_id] = (*entry[:2], content)
+
+    def pop(self, gid, message_id):
+        message = self.get(gid, message_id)
+        self._discard(gid, message_id)
+        return message
+
+
+class PasteBackend(abc.ABC):
+    """
+    Somewhere to upload transcripts to, returns the link to the paste.
+    """
+    name = None
+
+    @abc.abstractmethod
+    async def upload(self, session, text):
+        ...
+
+
+class HastebinBackend(PasteBackend):
+    name = 'Hastebin'
+
+    def __init__(self, url='https://hastebin.cc'):
+        self.url = url
+
+    async def upload(self, session, text):
+        async with session.post(f'{self.url}/documents', data=text.encode()) as resp:
+            resp.raise_for_status()
+            key = (await resp.json(content_type=None))['key']
+        return f'{self.url}/{key}'
+
+
+class TranscriptUploader:
+    """
+    Uploads transcripts in the background with a strict timeout, retrying a few times before giving up.
+
+    Transcripts are uploaded concurrently, and each one is given up on after MAX_WAIT seconds at most.
+    """
+    TIMEOUT = 5
+    RETRIES = 2
+    RETRY_AFTER = 10
+    CONCURRENCY = 4
+    MAX_WAIT = 60
+
+    def __init__(self, bot, backend):
+        self.bot = bot
+        self.backend = backend
+        self._semaphore = asyncio.Semaphore(self.CONCURRENCY)
+        # task -> callback, for the uploads still going
+        self._pending: typing.Dict[asyncio.Task, typing.Callable] = {}
+
+    async def upload(self, text):
+        try:
+            return await asyncio.wait_for(self.backend.upload(self.bot.session, text), self.TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning('Uploading to %s timed out.', self.backend.name)
+        except (ClientError, JSONDecodeError, KeyError, TypeError) as e:
+            logger.warning('Failed to upload to %s: %s.', self.backend.name, e)
+        return None
+
+    def submit(self, text, callback):
+        """
+        The callback is called with the link, or None once every attempt failed.
+        """
+        task = self.bot.loop.create_task(self._run(text))
+        self._pending[task] = callback
+        task.add_done_callback(self._done)
+
+    async def _attempts(self, text):
+        for attempt in range(self.RETRIES + 1):
+            if attempt:
+                await asyncio.sleep(self.RETRY_AFTER * attempt)
+            async with self._semaphore:
+                url = await self.upload(text)
+            if url is not None:
+                return url
+        return None
+
+    async def _run(self, text):
+        try:
+            return await asyncio.wait_for(self._attempts(text), self.MAX_WAIT)
+        except asyncio.TimeoutError:
+            logger.warning('Gave up uploading to %s after %s seconds.', self.backend.name, self.MAX_WAIT)
+            return None
+
+    def _done(self, task):
+        callback = self._pending.pop(task, None)
+        if callback is None or task.cancelled():
+            return
+        if task.exception() is not None:
+            logger.warning('Failed to upload to %s: %s.', self.backend.name, task.exception())
+            return callback(None)
+        callback(task.result())
+
+    def close(self):
+        # Whatever is still uploading is logged with the attachment instead
+        pending, self._pending = self._pending, {}
+        for task, callback in pending.items():
+            task.cancel()
+            callback(None)
+
+
+class LogWriter:
+    """
+    Sends the embeds for one log channel in order, packing up to 10 of them in each message.
+
+    Embeds are sent through a webhook, a message is sent once it is full or shortly after its first embed was queued.
+    Without the permission to manage webhooks, every embed is sent on its own.
+    """
+    WEBHOOK_NAME = 'Logger'
+    MAX_EMBEDS = 10
+    MAX_CHARACTERS = 6000
+    FLUSH_AFTER = 1
+    BACKLOG_WARNING = 100
+
+    def __init__(self, bot, channel):
+        self.bot = bot
+        self.channel = channel
+        self.queue = deque()
+        self._webhook = None
+        self._wakeup = asyncio.Event()
+        self._warned = False
+        self._task = self.bot.loop.create_task(self._run())
+
+    @property
+    def backlog(self):
+        return len(self.queue)
+
+    def put(self, embed, file=None):
+        self.queue.append((embed, file))
+        self._wakeup.set()
+        if self.backlog >= self.BACKLOG_WARNING and not self._warned:
+            self._warned = True
+            logger.warning('Logger is %s embeds behind in #%s.', self.backlog, self.channel.name)
+
+    async def _get_webhook(self):
+        if self._webhook is not None:
+            return self._webhook
+        if not self.channel.permissions_for(self.channel.guild.me).manage_webhooks:
+            return None
+        self._webhook = utils.get(await self.channel.webhooks(), name=self.WEBHOOK_NAME)
+        if self._webhook is None:
+            self._webhook = await self.channel.create_webhook(name=self.WEBHOOK_NAME,
+                                                              avatar=await self.bot.user.avatar_url.read(),
+                                                              reason='Logger')
+        return self._webhook
+
+    def _next_batch(self):
+        embed, file = self.queue.popleft()
+        batch = [embed]
+        if file is not None:
+            # Attachments go on their own
+            return batch, file
+        size = len(embed)
+        while self.queue and len(batch) < self.MAX_EMBEDS and self.queue[0][1] is None and \
+                size + len(self.queue[0][0]) <= self.MAX_CHARACTERS:
+            embed, _ = self.queue.popleft()
+            size += len(embed)
+            batch.append(embed)
+        return batch, None
+
+    async def _send(self, batch, file=None):
+        try:
+            webhook = await self._get_webhook()
+            if webhook is not None:
+                if file is not None:
+                    return await webhook.send(embed=batch[0], file=file)
+                return await webhook.send(embeds=batch)
+        except NotFound:
+            # Deleted webhook, a new one is made for the next batch
+            self._webhook = None
+        except HTTPException as e:
+            logger.warning('Failed to send logs through the webhook: %s.', e)
+        if file is not None:
+            file.reset()
+            return await self.channel.send(embed=batch[0], file=file)
+        for embed in batch:
+            await self.channel.send(embed=embed)
+
+    async def flush(self):
+        while self.queue:
+            batch, file = self._next_batch()
+            try:
+                await self._send(batch, file)
+            except HTTPException as e:
+                logger.warning('Failed to send %s logs: %s.', len(batch), e)
+        if self._warned:
+            logger.info('Logger caught up in #%s.', self.channel.name)
+            self._warned = False
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            if self.backlog < self.MAX_EMBEDS:
+                # Give the rest of a burst a chance to fit in the same message
+                await asyncio.sleep(self.FLUSH_AFTER)
+            await self.flush()
+            self._wakeup.clear()
+
+    def close(self):
+        self._task.cancel()
+        if self.queue:
+            self.bot.loop.create_task(self.flush())
+
+
+class LocalSink:
+    """
+    Optional local copy of the logs in an append-only sqlite database, searchable by channel, user and time.
+
+    Rows are buffered and written in batches on a single worker thread. Once the database grows past MAX_SIZE,
+    it is moved aside, gzipped and a new one is started, so searches cover the current file only.
+    """
+    FLUSH_AFTER = 1
+    MAX_SIZE = 64 * 1024 * 1024
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS logs (time REAL NOT NULL, kind TEXT NOT NULL, guild_id INTEGER NOT NULL, '
+        'channel_id INTEGER, user_id INTEGER, message_id INTEGER, content TEXT, extra TEXT)',
+        'CREATE INDEX IF NOT EXISTS logs_channel ON logs (guild_id, channel_id, time)',
+        'CREATE INDEX IF NOT EXISTS logs_user ON logs (guild_id, user_id, time)',
+        'CREATE INDEX IF NOT EXISTS logs_time ON logs (guild_id, time)',
+    )
+
+    def __init__(self, bot, path):
+        self.bot = bot
+        self.path = path
+        self.rows = []
+        self._db: typing.Optional[sqlite3.Connection] = None
+        # Started on first use, most guilds never enable it
+        self._executor: typing.Optional[futures.ThreadPoolExecutor] = None
+        self._wakeup = asyncio.Event()
+        self._task: typing.Optional[asyncio.Task] = None
+
+    def _start(self):
+        if self._executor is None:
+            self._executor = futures.ThreadPoolExecutor(max_workers=1)
+            self._task = self.bot.loop.create_task(self._run())
+
+    def put(self, kind, guild_id, *, channel_id=None, user_id=None, message_id=None, content=None, extra=None,
+            time=None):
+        time = time if time is not None else datetime.datetime.utcnow()
+        self.rows.append((time.replace(tzinfo=datetime.timezone.utc).timestamp(), kind, guild_id, channel_id,
+                          user_id, message_id, content, json.dumps(extra) if extra is not None else None))
+        self._start()
+        self._wakeup.set()
+
+    def _connect(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            for statement in self.SCHEMA:
+                self._db.execute(statement)
+            self._db.commit()
+        return self._db
+
+    def _write(self, rows):
+        db = self._connect()
+        db.executemany('INSERT INTO logs VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        db.commit()
+        if os.path.getsize(self.path) >= self.MAX_SIZE:
+            self._rotate()
+
+    def _rotate(self):
+        self._db.close()
+        self._db = None
+        root, ext = os.path.splitext(self.path)
+        rotated = f'{root}-{datetime.datetime.utcnow():%Y%m%d-%H%M%S}{ext}'
+        os.replace(self.path, rotated)
+        with open(rotated, 'rb') as src, gzip.open(rotated + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(rotated)
+        logger.info('Rotated local logs to %s.gz.', rotated)
+
+    def _search(self, guild_id, channel_id, user_id, after, before, limit):
+        query = 'SELECT time, kind, channel_id, user_id, message_id, content, extra FROM logs WHERE guild_id = ?'
+        params = [guild_id]
+        if channel_id is not None:
+            query += ' AND channel_id = ?'
+            params.append(channel_id)
+        if user_id is not None:
+            query += ' AND user_id = ?'
+            params.append(user_id)
+        if after is not None:
+            query += ' AND time >= ?'
+            params.append(after)
+        if before is not None:
+            query += ' AND time < ?'
+            params.append(before)
+        query += ' ORDER BY time DESC LIMIT ?'
+        params.append(limit)
+        return self._connect().execute(query, params).fetchall()
+
+    async def flush(self):
+        rows, self.rows = self.rows, []
+        if not rows:
+            return
+        try:
+            await asyncio.get_event_loop().run_in_executor(self._executor, self._write, rows)
+        except (sqlite3.Error, OSError) as e:
+            logger.warning('Failed to write %s local logs: %s.', len(rows), e)
+
+    async def search(self, guild_id, *, channel_id=None, user_id=None, after=None, before=None, limit=10):
+        """
+        After and before are UTC timestamps.
+        """
+        self._start()
+        # Include whatever is still buffered
+        await self.flush()
+        return await asyncio.get_event_loop().run_in_executor(
+            self._executor, self._search, guild_id, channel_id, user_id, after, before, limit
+        )
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            await asyncio.sleep(self.FLUSH_AFTER)
+            self._wakeup.clear()
+            await self.flush()
+
+    async def _close(self):
+        await self.flush()
+
+        def _close():
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+        await asyncio.get_event_loop().run_in_executor(self._executor, _close)
+        self._executor.shutdown(wait=False)
+
+    def close(self):
+        if self._executor is None:
+            return
+        self._task.cancel()
+        self.bot.loop.create_task(self._close())
+
+
 class Logger(commands.Cog):
     """
     Logs stuff.
     """
+    AUDIT_LOG_DELAY = 2
+    # Same as the old poll, for events that are mostly not in the audit log
+    AUDIT_LOG_INTERVAL = 10
+    # Same as an audit logs page
+    AUDIT_LOG_BATCH = 100
 
     def __init__(self, bot):
         self.bot = bot
         self.db = bot.plugin_db.get_partition(self)
-        self._channel = None
-        self._log_modmail = None
-        self._log_bot = None
+        self.states: typing.Dict[int, GuildState] = {}
+        self.thread_messages = ThreadMessageIndex(bot)
+        self.thread_messages.rewarm()
+        self.messages = MessageStore(bot)
+        self.uploader = TranscriptUploader(bot, HastebinBackend())
+        self._writers: typing.Dict[int, LogWriter] = {}
+        self.sink = LocalSink(bot, LOCAL_LOG_PATH)
+        self._states_loaded = self.bot.loop.create_task(self.load_states())
+        self.refresh_config.start()
+        self._watch_config = self.bot.loop.create_task(self.watch_config())
+        # Audit logs are fetched after the gateway events that create entries, from the last seen entry.
+        # Guilds with new entries take turns, a page each.
+        self._audit_queue = deque()
+        self._audit_wakeup = asyncio.Event()
         self.audit_logs_logger.start()
-        self.last_audit_log = datetime.datetime.utcnow(), -1
 
     def cog_unload(self):
         self.audit_logs_logger.cancel()
-        self._channel = None
-        self.last_audit_log = datetime.datetime.utcnow(), -1
+        for state in self.states.values():
+            if state.audit_deferred is not None:
+                state.audit_deferred.cancel()
+        self.refresh_config.cancel()
+        self._watch_config.cancel()
+        self._states_loaded.cancel()
+        self.uploader.close()
+        self.sink.close()
+        for writer in self._writers.values():
+            writer.close()
+
+    def get_state(self, guild_id):
+        state = self.states.get(guild_id)
+        if state is None:
+            state = self.states[guild_id] = GuildState(self.bot, self.db, guild_id)
+        return state
+
+    def command_state(self, ctx):
+        # The main guild is configured from the Modmail guild too
+        if ctx.guild.id == self.bot.modmail_guild.id:
+            return self.get_state(self.bot.guild_id)
+        return self.get_state(ctx.guild.id)
+
+    @staticmethod
+    def config_guild_id(_id):
+        return int(_id.rsplit('-', 1)[1])
+
+    async def load_states(self):
+        await self.get_state(self.bot.guild_id).config.refresh()
+        async for config in self.db.find({'_id': {'$regex': '^logger-config-'}}):
+            # noinspection PyProtectedMember
+            self.get_state(self.config_guild_id(config['_id'])).config._apply(config)
+
+    @loop_(seconds=LoggerConfig.TTL)
+    async def refresh_config(self):
+        for state in list(self.states.values()):
+            try:
+                await state.refresh()
+            except PyMongoError:
+                logger.warning('Failed to refresh logger config.', exc_info=True)
+                return
+
+    async def watch_config(self):
+        # Change streams need a replica set, the TTL refresh covers everything else
+        try:
+            async with self.db.watch([{'$match': {'documentKey._id': {'$regex': '^logger-config'}}}]) as stream:
+                async for change in stream:
+                    _id = change['documentKey']['_id']
+                    if _id == 'logger-config':
+                        await self.get_state(self.bot.guild_id).refresh()
+                    else:
+                        await self.get_state(self.config_guild_id(_id)).refresh()
+        except PyMongoError as e:
+            logger.debug('Not watching logger config (%s), refreshing every %s seconds.', e, LoggerConfig.TTL)
 
     @commands.group(name='logger')
     @checks.has_permissions(PermissionLevel.ADMINISTRATOR)
@@ -68,36 +830,18 @@ class Logger(commands.Cog):
                 ctx.guild.me: PermissionOverwrite(send_messages=True)
             })
 
-        await self.set_log_channel(channel)
+        await self.set_log_channel(self.command_state(ctx), channel)
         await ctx.send(f'Successfully set logger channel to: {channel.mention}.')
 
-    async def set_log_channel(self, channel):
-        logger.info('Setting channel_id for logger.')
-        await self.db.find_one_and_update(
-            {'_id': 'logger-config'},
-            {'$set': {'channel_id': channel.id}},
-            upsert=True
-        )
-        self._channel = channel
+    async def set_log_channel(self, state, channel):
+        logger.info('Setting channel_id for logger in %s.', state.guild_id)
+        await state.set_log_channel(channel)
 
         _task = self.audit_logs_logger.get_task()
         if _task is None or _task.done():
             self.audit_logs_logger.start()
-
-    async def get_log_channel(self):
-        if self._channel is not None:
-            return self._channel
-        logger.debug('Retrieving channel_id for logger from config.')
-        config = await self.db.find_one({'_id': 'logger-config'})
-        channel_id = (config or {}).get('channel_id')
-        if channel_id is None:
-            raise ValueError(f'No logger channel specified, set one with `{self.bot.prefix}logger channel #channel`.')
-        channel = self.bot.guild.get_channel(channel_id) or self.bot.modmail_guild.get_channel(channel_id)
-        if channel is None:
-            logger.error('Logger channel with ID `%s` not found.', channel_id)
-            raise ValueError(f'Logger channel with ID `{channel_id}` not found.')
-        self._channel = channel
-        return channel
+        if state.audit_cursor is None:
+            await state.load_audit_cursor()
 
     @logger_.command(name='log-modmail')
     @checks.has_permissions(PermissionLevel.ADMINISTRATOR)
@@ -107,83 +851,36 @@ class Logger(commands.Cog):
 
         Ie. threads channel created, help msgs edits, reply msgs, etc.
         """
+        state = self.command_state(ctx)
         try:
-            target = not await self.is_log_modmail()
+            target = not state.is_log_modmail()
         except ValueError as e:
             return await ctx.send(str(e))
-        await self.db.find_one_and_update(
-            {'_id': 'logger-config'},
-            {'$set': {'log_modmail': target}},
-            upsert=True
-        )
+        await state.config.update(log_modmail=target)
         logger.debug('Setting log_modmail to %s.', target)
-        self._log_modmail = target
         if target:
             await ctx.send('Logger will now log Modmail bot messages.')
         else:
             await ctx.send('Logger will stop logging Modmail bot messages.')
 
-    async def is_log_modmail(self):
-        if isinstance(self._log_bot, bool):
-            if not self._log_bot:
-                return False
-        if isinstance(self._log_modmail, bool):
-            return self._log_modmail
-        config = await self.db.find_one({'_id': 'logger-config'})
-        if (config or {}).get('channel_id') is None:
-            raise ValueError(f'No logger channel specified, set one with `{self.bot.prefix}logger channel #channel`.')
-        log_modmail = config.get('log_modmail')
-        if not isinstance(log_modmail, bool):
-            logger.debug('Setting log_modmail to True for the first time.')
-            await self.db.find_one_and_update(
-                {'_id': 'logger-config'},
-                {'$set': {'log_modmail': True}},
-                upsert=True
-            )
-            log_modmail = True
-        self._log_modmail = log_modmail
-        return log_modmail
-
     @logger_.command(name='log-bot')
     @checks.has_permissions(PermissionLevel.ADMINISTRATOR)
     async def log_bot(self, ctx):
         """
         Toggle whether to log bot activities. Defaults no.
         """
+        state = self.command_state(ctx)
         try:
-            target = not await self.is_log_bot()
+            target = not state.is_log_bot()
         except ValueError as e:
             return await ctx.send(str(e))
-        await self.db.find_one_and_update(
-            {'_id': 'logger-config'},
-            {'$set': {'log_bot': target}},
-            upsert=True
-        )
+        await state.config.update(log_bot=target)
         logger.debug('Setting log_bot to %s.', target)
-        self._log_bot = target
         if target:
             await ctx.send('Logger will now log bot messages.')
         else:
             await ctx.send('Logger will stop logging bot messages.')
 
-    async def is_log_bot(self):
-        if isinstance(self._log_bot, bool):
-            return self._log_bot
-        config = await self.db.find_one({'_id': 'logger-config'})
-        if (config or {}).get('channel_id') is None:
-            raise ValueError(f'No logger channel specified, set one with `{self.bot.prefix}logger channel #channel`.')
-        log_bot = config.get('log_bot')
-        if not isinstance(log_bot, bool):
-            logger.debug('Setting log_bot to False for the first time.')
-            await self.db.find_one_and_update(
-                {'_id': 'logger-config'},
-                {'$set': {'log_bot': False}},
-                upsert=True
-            )
-            log_bot = True
-        self._log_bot = log_bot
-        return log_bot
-
     @logger_.command()
     @checks.has_permissions(PermissionLevel.ADMINISTRATOR)
     async def whitelist(self, ctx, *, channel: typing.Union[TextChannel, int]):
@@ -193,202 +890,263 @@ class Logger(commands.Cog):
         id = str(getattr(channel, 'id', channel))
         name = str(getattr(channel, 'mention', channel))
 
-        config = await self.db.find_one({'_id': 'logger-config'})
-        if config is None:
+        state = self.command_state(ctx)
+        if state.config.channel_id is None:
             return await ctx.send(f'No logger channel specified, '
                                   f'set one with `{self.bot.prefix}logger channel #channel`.')
-        blocked = config.get('no_log', [])
-        if id not in blocked:
-            blocked.append(id)
-            await self.db.find_one_and_update(
-                {'_id': 'logger-config'},
-                {'$set': {'no_log': blocked}}
-            )
+        blocked = state.config.no_log ^ {id}
+        await state.config.update(no_log=sorted(blocked))
+        if id in blocked:
             return await ctx.send(f'{name} will no longer be logged.')
-        blocked.remove(id)
-        await self.db.find_one_and_update(
-            {'_id': 'logger-config'},
-            {'$set': {'no_log': blocked}}
-        )
         return await ctx.send(f'{name} will now be logged.')
 
-    async def is_logged(self, id):
-        id = str(id)
-        config = await self.db.find_one({'_id': 'logger-config'})
-        if (config or {}).get('channel_id') is None:
-            raise ValueError(f'No logger channel specified, '
-                             f'set one with `{self.bot.prefix}logger channel #channel`.')
-        log_modmail = config.get('no_log', [])
-        return id not in log_modmail
+    @logger_.command(name='local-log')
+    @checks.has_permissions(PermissionLevel.ADMINISTRATOR)
+    async def local_log(self, ctx):
+        """
+        Toggle whether to also keep the logs on disk, to be searched with `logger search`. Defaults no.
+        """
+        state = self.command_state(ctx)
+        target = not state.config.local_log
+        await state.config.update(local_log=target)
+        logger.debug('Setting local_log to %s.', target)
+        if target:
+            await ctx.send('Logger will now keep the logs on disk.')
+        else:
+            await ctx.send('Logger will stop keeping the logs on disk.')
+
+    @logger_.command()
+    @checks.has_permissions(PermissionLevel.ADMINISTRATOR)
+    async def search(self, ctx, channel: typing.Optional[TextChannel] = None,
+                     user: typing.Optional[User] = None, *options):
+        """
+        Search the logs kept on disk, newest first.
+
+        Both the channel and the user are optional. The options are a limit of at most 25, and
+        `after:<time>` and `before:<time>`, where the time is a UTC date such as `2021-05-01`,
+        a UTC time such as `2021-05-01T18:30` or a duration ago such as `12h` or `7d`.
+        """
+        state = self.command_state(ctx)
+        if not state.config.local_log:
+            return await ctx.send(f'Logs are not kept on disk, enable it with `{self.bot.prefix}logger local-log`.')
+        limit = 10
+        bounds = {}
+        for option in options:
+            name, sep, value = option.partition(':')
+            if sep and name.lower() in {'after', 'before'}:
+                try:
+                    bounds[name.lower()] = parse_search_time(value)
+                except ValueError as e:
+                    return await ctx.send(str(e))
+            elif option.isdigit():
+                limit = int(option)
+            else:
+                return await ctx.send(f'Unknown search option "{escape(option)}".')
+        rows = await self.sink.search(state.guild_id, channel_id=getattr(channel, 'id', None),
+                                      user_id=getattr(user, 'id', None), limit=max(1, min(limit, 25)), **bounds)
+        if not rows:
+            return await ctx.send('No logs found.')
+
+        lines = []
+        for time, kind, channel_id, user_id, message_id, content, _ in rows:
+            time = datetime.datetime.utcfromtimestamp(time).strftime('%Y-%m-%d %H:%M')
+            line = f'`{time}` **{kind}**'
+            if channel_id is not None:
+                line += f' in <#{channel_id}>'
+            if user_id is not None:
+                line += f' by <@{user_id}>'
+            if message_id is not None:
+                line += f' ({message_id})'
+            if content:
+                line += f': {escape(content[:100])}'
+            lines.append(line)
+        description = ''
+        for line in lines:
+            if len(description) + len(line) + 1 > 2048:
+                break
+            description += line + '\n'
+        await ctx.send(embed=Embed(title=f'{len(rows)} log{"" if len(rows) == 1 else "s"} found',
+                                   description=description, color=self.bot.main_color))
+
+    def record(self, state, kind, **kwargs):
+        if state.config.local_log:
+            self.sink.put(kind, state.guild_id, **kwargs)
+
+    def request_audit_logs(self, state, *, throttled=False):
+        """
+        Throttled requests are merged into one every AUDIT_LOG_INTERVAL seconds.
+        """
+        now = self.bot.loop.time()
+        if throttled:
+            wait = state.audit_requested_at + self.AUDIT_LOG_INTERVAL - now
+            if wait > 0:
+                if state.audit_deferred is None:
+                    state.audit_deferred = self.bot.loop.call_later(wait, self._request_deferred_audit_logs, state)
+                return
+        state.audit_requested_at = now
+        if not state.audit_pending:
+            state.audit_pending = True
+            self._audit_queue.append(state.guild_id)
+            self._audit_wakeup.set()
+
+    def _request_deferred_audit_logs(self, state):
+        state.audit_deferred = None
+        self.request_audit_logs(state)
 
-    @loop_(seconds=10)
+    @loop_()
     async def audit_logs_logger(self):
+        await self._audit_wakeup.wait()
+        # Entries are created around the same time as their gateway event, let a burst settle
+        await asyncio.sleep(self.AUDIT_LOG_DELAY)
+        self._audit_wakeup.clear()
+        while self._audit_queue:
+            state = self.states[self._audit_queue.popleft()]
+            state.audit_pending = False
+            # One guild failing shouldn't stop the loop for the others
+            try:
+                more = await self.fetch_audit_logs(state)
+            except (PyMongoError, HTTPException):
+                logger.warning('Failed to log audit logs of guild %s.', state.guild_id, exc_info=True)
+                continue
+            if more:
+                # There's more, after the other guilds had their turn
+                self.request_audit_logs(state)
+
+    async def fetch_audit_logs(self, state):
+        """
+        Logs a page of new audit log entries, returns whether there may be more.
+        """
+        guild = state.guild
+        if guild is None:
+            return False
         try:
-            channel = await self.get_log_channel()
+            channel = state.get_log_channel()
         except ValueError as e:
             logger.warning(str(e))
-            self.audit_logs_logger.cancel()
-            return
+            return False
+        if state.audit_cursor is None:
+            await state.load_audit_cursor()
 
+        cursor = state.audit_cursor
         audits = []
-        async for audit in self.bot.guild.audit_logs(limit=30):
-            if audit.created_at < self.last_audit_log[0] or audit.id == self.last_audit_log[1]:
-                break
-            try:
-                if not await self.is_log_modmail() and audit.user.id == self.bot.user.id:
+        read = 0
+        try:
+            async for audit in guild.audit_logs(limit=self.AUDIT_LOG_BATCH, after=Object(id=cursor),
+                                                oldest_first=True):
+                read += 1
+                state.audit_cursor = audit.id
+                if not state.is_log_modmail() and audit.user.id == self.bot.user.id:
                     continue
-                if not await self.is_log_bot() and audit.user.bot:
+                if not state.is_log_bot() and audit.user.bot:
                     continue
-            except ValueError as e:
-                logger.warning(str(e))
-                self.audit_logs_logger.cancel()
-                return
-            audits.append(audit)
-
-        for audit in reversed(audits):
-            if audit.action == AuditLogAction.channel_create:
-                name = escape_markdown(getattr(audit.target, 'name',
-                                               getattr(audit.after, 'name', 'unknown-channel')))
-                if isinstance(audit.target, CategoryChannel):
-                    await channel.send(embed=self.make_embed(
-                        f'Category Created',
-                        f'Category "**{name}**" has been created by {audit.user.mention}.',
-                        time=audit.created_at,
-                        fields=[('Category ID:', audit.target.id, True)]
-                    ))
-                else:
-                    cat = getattr(audit.target, 'category', None)
-                    if cat is not None:
-                        await channel.send(embed=self.make_embed(
-                            f'Channel Created',
-                            f'**#{name}** has been created by {audit.user.mention} '
-                            f'under "**{escape_markdown(cat.name)}**" category.',
-                            time=audit.created_at,
-                            fields=[('Channel ID:', audit.target.id, True),
-                                    ('Category ID:', cat.id, True)]
-                        ))
-                    else:
-                        await channel.send(embed=self.make_embed(
-                            f'Channel Created',
-                            f'**#{name}** has been created by {audit.user.mention}.',
-                            time=audit.created_at,
-                            fields=[('Channel ID:', audit.target.id, True)]
-                        ))
-
-            elif audit.action == AuditLogAction.channel_update:
-                name = escape_markdown(
-                    getattr(audit.target, 'name',
-                            getattr(audit.after, 'name', getattr(audit.before, 'name', 'unknown-channel'))))
-                if isinstance(audit.target, CategoryChannel):
-                    await channel.send(embed=self.make_embed(
-                        f'Category Updated',
-                        f'Category "**{name}**" has been updated by {audit.user.mention}.',
-                        time=audit.created_at,
-                        fields=[
-                            ('Category ID:', audit.target.id, True),
-                            ('Changes:', ', '.join(map(lambda a: a[0].replace('_', ' ').title(),
-                                                       iter(audit.after))), False)
-                        ]
-                    ))
-                else:
-                    await channel.send(embed=self.make_embed(
-                        f'Channel Updated',
-                        f'**#{name}** has been updated by {audit.user.mention}.',
-                        time=audit.created_at,
-                        fields=[
-                            ('Channel ID:', audit.target.id, True),
-                            ('Changes:', ', '.join(map(lambda a: a[0].replace('_', ' ').title(),
-                                                       iter(audit.after))), False)
-                        ]
-                    ))
-
-            elif audit.action == AuditLogAction.channel_delete:
-                name = escape_markdown(getattr(audit.target, 'name',
-                                               getattr(audit.before, 'name', audit.target.id)))
-                if isinstance(audit.target, CategoryChannel):
-                    await channel.send(embed=self.make_embed(
-                        f'Category Deleted',
-                        f'Category "**{name}**" has been deleted by {audit.user.mention}.',
-                        time=audit.created_at,
-                        fields=[('Category ID:', audit.target.id, True)]
-                    ))
-                else:
-                    cat = getattr(audit.target, 'category', None)
-                    if cat is not None:
-                        await channel.send(embed=self.make_embed(
-                            f'Channel Deleted',
-                            f'**#{name}** has been deleted by {audit.user.mention} '
-                            f'under "**{escape_markdown(cat.name)}**" category.',
-                            time=audit.created_at,
-                            fields=[('Channel ID:', audit.target.id, True),
-                                    ('Category ID:', cat.id, True)]
-                        ))
-                    else:
-                        await channel.send(embed=self.make_embed(
-                            f'Channel Deleted',
-                            f'**#{name}** has been deleted by {audit.user.mention}.',
-                            time=audit.created_at,
-                            fields=[('Channel ID:', audit.target.id, True)]
-                        ))
-
-            elif audit.action == AuditLogAction.kick:
-                await channel.send(embed=self.make_embed(
-                    f'Member Kicked',
-                    f'{audit.target} has been kicked by {audit.user.mention}.',
-                    time=audit.created_at,
-                    fields=[('Reason:', escape(audit.reason) or 'No Reason', False)]
-                ))
-
-            elif audit.action == AuditLogAction.member_prune:
-                await channel.send(embed=self.make_embed(
-                    f'Members Pruned',
-                    f'**{getattr(audit.extra, "members_removed", None)}** members were pruned by {audit.user.mention}.',
-                    time=audit.created_at,
-                    fields=[('Prune days:', str(getattr(audit.extra, 'delete_members_days', None)), False)]
-                ))
-
-            elif audit.action == AuditLogAction.ban:
-                await channel.send(embed=self.make_embed(
-                    f'Member Banned',
-                    f'{audit.target} has been banned by {audit.user.mention}.',
-                    time=audit.created_at,
-                    fields=[('Reason:', escape(audit.reason) or 'No Reason', False)]
-                ))
-
-            elif audit.action == AuditLogAction.unban:
-                await channel.send(embed=self.make_embed(
-                    f'Member Unbanned',
-                    f'{audit.target} has been unbanned by {audit.user.mention}.',
-                    time=audit.created_at
-                ))
-
-            elif audit.action == AuditLogAction.message_delete:
-                if not await self.is_logged(getattr(getattr(audit.extra, 'channel', None), 'id', -1)):
+                if audit.action == AuditLogAction.message_delete and \
+                        not state.is_logged(getattr(getattr(audit.extra, 'channel', None), 'id', -1)):
                     continue
+                audits.append(audit)
+                self.record(state, f'audit.{audit.action.name}', user_id=audit.user.id,
+                            content=str(audit.target), time=audit.created_at)
+        except ValueError as e:
+            logger.warning(str(e))
+            return False
+        except HTTPException as e:
+            logger.warning('Failed to fetch audit logs: %s.', e)
+            return False
+        finally:
+            self.log_audits(channel, audits)
+            if state.audit_cursor != cursor:
+                await state.save_audit_cursor()
+        return read == self.AUDIT_LOG_BATCH
+
+    # action -> (verb, where to look for the channel name, fallback name)
+    CHANNEL_AUDITS = {
+        AuditLogAction.channel_create: ('created', ('after',), 'unknown-channel'),
+        AuditLogAction.channel_update: ('updated', ('after', 'before'), 'unknown-channel'),
+        AuditLogAction.channel_delete: ('deleted', ('before',), None),
+    }
+    # action -> (title, description), filled in for each entry
+    MEMBER_AUDITS = {
+        AuditLogAction.kick: ('Member Kicked', '{target} has been kicked by {user}.'),
+        AuditLogAction.ban: ('Member Banned', '{target} has been banned by {user}.'),
+        AuditLogAction.unban: ('Member Unbanned', '{target} has been unbanned by {user}.'),
+    }
+
+    def _format_channel_audit(self, audit):
+        verb, sources, fallback = self.CHANNEL_AUDITS[audit.action]
+        target = audit.target
+        name = getattr(target, 'name', None)
+        for source in sources:
+            name = name or getattr(getattr(audit, source), 'name', None)
+        name = escape_markdown(str(name or fallback or target.id))
+
+        if isinstance(target, CategoryChannel):
+            title = f'Category {verb.title()}'
+            description = f'Category "**{name}**" has been {verb} by {audit.user.mention}.'
+            fields = [('Category ID:', target.id, True)]
+        else:
+            title = f'Channel {verb.title()}'
+            description = f'**#{name}** has been {verb} by {audit.user.mention}'
+            fields = [('Channel ID:', target.id, True)]
+            cat = getattr(target, 'category', None)
+            if cat is not None and audit.action != AuditLogAction.channel_update:
+                description += f' under "**{escape_markdown(cat.name)}**" category'
+                fields.append(('Category ID:', cat.id, True))
+            description += '.'
+        if audit.action == AuditLogAction.channel_update:
+            fields.append(('Changes:', ', '.join(a[0].replace('_', ' ').title() for a in audit.after), False))
+        return title, description, fields
+
+    def _format_member_audit(self, audit):
+        title, description = self.MEMBER_AUDITS[audit.action]
+        fields = None
+        if audit.action != AuditLogAction.unban:
+            fields = [('Reason:', escape(audit.reason) or 'No Reason', False)]
+        return title, description.format(target=audit.target, user=audit.user.mention), fields
+
+    def _format_prune_audit(self, audit):
+        return (
+            'Members Pruned',
+            f'**{getattr(audit.extra, "members_removed", None)}** members were pruned by {audit.user.mention}.',
+            [('Prune days:', str(getattr(audit.extra, 'delete_members_days', None)), False)]
+        )
 
-                pl = '' if getattr(audit.extra, 'count', 1) == 1 else 's'
-                channel_text = getattr(getattr(audit.extra, 'channel', None), 'name', 'unknown-channel')
-                await channel.send(embed=self.make_embed(
-                    f'Message{pl} Deleted',
-                    f'{audit.user.mention} deleted **{getattr(audit.extra, "count", "?")}** message{pl} sent by '
-                    f'{audit.target.mention} from **#{channel_text}**.',
-                    time=audit.created_at,
-                    fields=[('Channel ID:', audit.target.id, True)]
-                ))
-
-        if audits:
-            self.last_audit_log = audits[-1].created_at, audits[-1].id
+    def _format_message_delete_audit(self, audit):
+        deleted_from = getattr(audit.extra, 'channel', None)
+        count = getattr(audit.extra, 'count', 1)
+        pl = '' if count == 1 else 's'
+        return (
+            f'Message{pl} Deleted',
+            f'{audit.user.mention} deleted **{getattr(audit.extra, "count", "?")}** message{pl} sent by '
+            f'{audit.target.mention} from **#{getattr(deleted_from, "name", "unknown-channel")}**.',
+            [('Channel ID:', audit.target.id, True)]
+        )
 
-            if len(audits) == 30:
-                await channel.send(embed=self.make_embed(
-                    'Warning',
-                    'Due to the nature of Discord API, there may be more audits undisplayed. '
-                    'Check the audits page for a complete list of audits.'
-                ))
+    AUDIT_FORMATTERS = {
+        **dict.fromkeys(CHANNEL_AUDITS, _format_channel_audit),
+        **dict.fromkeys(MEMBER_AUDITS, _format_member_audit),
+        AuditLogAction.member_prune: _format_prune_audit,
+        AuditLogAction.message_delete: _format_message_delete_audit,
+    }
+
+    def format_audit(self, audit):
+        formatter = self.AUDIT_FORMATTERS.get(audit.action)
+        if formatter is None:
+            return None
+        title, description, fields = formatter(self, audit)
+        return self.make_embed(title, description, time=audit.created_at, fields=fields)
+
+    def log_audits(self, channel, audits):
+        embeds = [embed for embed in (self.format_audit(audit) for audit in audits) if embed is not None]
+        for embed in embeds:
+            self.send_log(channel, embed)
 
     @audit_logs_logger.before_loop
     async def audit_logs_logger_before(self):
         await self.bot.wait_until_ready()
+        await self._states_loaded
+        # Catch up on whatever happened while offline
+        for state in list(self.states.values()):
+            if state.config.channel_id is not None:
+                self.request_audit_logs(state)
         logger.info('Starting audit log listener loop.')
 
     @audit_logs_logger.after_loop
@@ -397,25 +1155,29 @@ class Logger(commands.Cog):
 
     @commands.Cog.listener()
     async def on_raw_message_delete(self, payload):
-        if payload.guild_id != self.bot.guild_id:
+        state = self.states.get(payload.guild_id)
+        if state is None:
             return
+        # Deleted by someone else than the author, most are not
+        self.request_audit_logs(state, throttled=True)
         try:
-            if not await self.is_logged(payload.channel_id):
+            if not state.is_logged(payload.channel_id):
                 return
-            channel = await self.get_log_channel()
-            logging_bot = await self.is_log_bot()
-            logging_modmail = await self.is_log_modmail()
+            channel = state.get_log_channel()
+            logging_bot = state.is_log_bot()
+            logging_modmail = state.is_log_modmail()
         except ValueError:
             return
 
-        message = payload.cached_message
+        # Dropped from the store either way
+        message = self.messages.pop(payload.guild_id, payload.message_id)
+        message = payload.cached_message or message
 
         if message:
             if not logging_modmail:
                 if message.author.id == self.bot.user.id:
                     return
-                elif await self.bot.db.logs.count_documents(
-                        {"messages.message_id": str(payload.message_id), "messages.type": "thread_message"}, limit=1):
+                elif await self.thread_messages.contains(payload.channel_id, payload.message_id):
                     return
             if not logging_bot and message.author.bot:
                 return
@@ -426,7 +1188,9 @@ class Logger(commands.Cog):
                 time = message.created_at.strftime('%b %d at %I:%M %p UTC')
             md_time = message.created_at.strftime('%H%M_%d_%B_%Y_in_UTC')
 
-            return await channel.send(embed=self.make_embed(
+            self.record(state, 'delete', channel_id=payload.channel_id, user_id=message.author.id,
+                        message_id=payload.message_id, content=message.content)
+            return self.send_log(channel, self.make_embed(
                 f'A message has been deleted from #{message.channel.name}.',
                 message.content or 'No Content',
                 fields=[('Message ID:', payload.message_id, True),
@@ -435,15 +1199,16 @@ class Logger(commands.Cog):
                         ('Message sent on:', f'[{time}](https://time.is/{md_time}?Message_Deleted)', True)],
                 footer='A further message may follow if this message was not deleted by the author.'
             ))
-        if (not logging_modmail or not logging_bot) and await self.bot.db.logs.count_documents(
-                {"messages.message_id": str(payload.message_id), "messages.type": "thread_message"}, limit=1):
+        if (not logging_modmail or not logging_bot) and \
+                await self.thread_messages.contains(payload.channel_id, payload.message_id):
             return
-        payload_channel = self.bot.guild.get_channel(payload.channel_id)
+        payload_channel = state.guild.get_channel(payload.channel_id)
         if payload_channel is not None:
             channel_text = payload_channel.name
         else:
             channel_text = 'deleted-channel'
-        return await channel.send(embed=self.make_embed(
+        self.record(state, 'delete', channel_id=payload.channel_id, message_id=payload.message_id)
+        return self.send_log(channel, self.make_embed(
             f'A message was deleted in #{channel_text}.',
             fields=[('Message ID:', payload.message_id, True),
                     ('Channel ID:', payload.channel_id, True)],
@@ -453,17 +1218,27 @@ class Logger(commands.Cog):
 
     @commands.Cog.listener()
     async def on_raw_bulk_message_delete(self, payload):
-        if payload.guild_id != self.bot.guild_id:
+        state = self.states.get(payload.guild_id)
+        if state is None:
             return
+        self.request_audit_logs(state)
         try:
-            if not await self.is_logged(payload.channel_id):
+            if not state.is_logged(payload.channel_id):
                 return
-            channel = await self.get_log_channel()
+            channel = state.get_log_channel()
         except ValueError:
             return
 
-        messages = sorted(payload.cached_messages, key=lambda msg: msg.created_at)
+        cached = {message.id: message for message in payload.cached_messages}
+        for message_id in payload.message_ids:
+            message = self.messages.pop(payload.guild_id, message_id)
+            if message is not None and message_id not in cached:
+                cached[message_id] = message
+        messages = sorted(cached.values(), key=lambda msg: msg.created_at)
         message_ids = payload.message_ids
+        for message in messages:
+            self.record(state, 'bulk-delete', channel_id=payload.channel_id, user_id=message.author.id,
+                        message_id=message.id, content=message.content)
         pl = '' if len(message_ids) == 1 else 's'
         pl_be = 'is' if len(message_ids) == 1 else 'are'
         pl_be_past = 'was' if len(message_ids) == 1 else 'were'
@@ -487,34 +1262,39 @@ class Logger(commands.Cog):
                 pl_unknown = '' if len(unknown_message_ids) == 1 else 's'
                 upload_text += f'Unknown message ID{pl_unknown}: ' + ', '.join(map(str, unknown_message_ids)) + '.'
 
-        payload_channel = self.bot.guild.get_channel(payload.channel_id)
+        payload_channel = state.guild.get_channel(payload.channel_id)
         if payload_channel is not None:
             channel_text = payload_channel.name
         else:
             channel_text = 'deleted-channel'
 
-        try:
-            async with self.bot.session.post('https://hastebin.cc/documents', data=upload_text) as resp:
-                key = (await resp.json())["key"]
-                return await channel.send(embed=self.make_embed(
-                    f'{len(message_ids)} message{pl} deleted from #{channel_text}.',
-                    f'Deleted message{pl}: https://hastebin.cc/{key}.',
+        title = f'{len(message_ids)} message{pl} deleted from #{channel_text}.'
+
+        def uploaded(url):
+            if url is not None:
+                return self.send_log(channel, self.make_embed(
+                    title,
+                    f'Deleted message{pl}: {url}.',
                     fields=[('Channel ID:', payload.channel_id, True)]
                 ))
-        except (JSONDecodeError, ClientResponseError, IndexError):
-            return await channel.send(embed=self.make_embed(
-                f'{len(message_ids)} message{pl} deleted from #{channel_text}.',
-                f'Failed to upload to Hastebin. Deleted message ID{pl}: ' + ', '.join(map(str, message_ids)) + '.',
-                fields=[('Channel ID', payload.channel_id, True)]
-            ))
+            return self.send_log(channel, self.make_embed(
+                title,
+                f'Failed to upload to {self.uploader.backend.name}, the deleted message{pl} {pl_be} attached.',
+                fields=[('Channel ID:', payload.channel_id, True)]
+            ), file=File(io.BytesIO(upload_text.encode()), filename=f'deleted-messages-{payload.channel_id}.txt'))
+
+        self.uploader.submit(upload_text, uploaded)
 
     @commands.Cog.listener()
     async def on_raw_message_edit(self, payload):
         channel_id = int(payload.data['channel_id'])
+        state = self.states.get(int(payload.data.get('guild_id', 0)))
+        if state is None:
+            return
         try:
-            if not await self.is_logged(channel_id):
+            if not state.is_logged(channel_id):
                 return
-            channel = await self.get_log_channel()
+            channel = state.get_log_channel()
         except ValueError:
             return
 
@@ -523,11 +1303,13 @@ class Logger(commands.Cog):
         new_content = payload.data.get('content', '')
         old_message = payload.cached_message
 
-        payload_channel = self.bot.guild.get_channel(channel_id)
+        payload_channel = state.guild.get_channel(channel_id)
         if payload_channel is None:
             return
-        if payload_channel.guild.id != self.bot.guild_id:
-            return
+        if old_message is None:
+            old_message = self.messages.get(payload_channel.guild.id, message_id)
+        if new_content:
+            self.messages.update(payload_channel.guild.id, message_id, new_content)
 
         channel_text = payload_channel.name
 
@@ -537,9 +1319,9 @@ class Logger(commands.Cog):
             try:
                 message = await payload_channel.fetch_message(message_id)
 
-                if not await self.is_log_modmail() and message.author.id == self.bot.user.id:
+                if not state.is_log_modmail() and message.author.id == self.bot.user.id:
                     return
-                if not await self.is_log_bot() and message.author.bot:
+                if not state.is_log_bot() and message.author.bot:
                     return
 
                 try:
@@ -548,7 +1330,7 @@ class Logger(commands.Cog):
                     time = message.created_at.strftime('%b %d, %Y at %I:%M %p UTC')
                 md_time = message.created_at.strftime('%H%M_%d_%B_%Y_in_UTC')
 
-                return await channel.send(embed=self.make_embed(
+                return self.send_log(channel, self.make_embed(
                     f'A message was updated in #{channel_text}.',
                     'No text content was updated (possibly an embed / files edit).',
                     fields=[('Message ID:', f'[{message_id}]({message.jump_url})', True),
@@ -557,7 +1339,7 @@ class Logger(commands.Cog):
                             ('Message sent on:', f'[{time}](https://time.is/{md_time}?Message_Edited)', True)]
                 ))
             except NotFound:
-                return await channel.send(embed=self.make_embed(
+                return self.send_log(channel, self.make_embed(
                     f'A message was updated in #{channel_text}.',
                     'No text content was updated (possibly an embed / files edit).',
                     fields=[('Message ID:', message_id, True),
@@ -565,9 +1347,9 @@ class Logger(commands.Cog):
                 ))
 
         if old_message:
-            if not await self.is_log_modmail() and old_message.author.id == self.bot.user.id:
+            if not state.is_log_modmail() and old_message.author.id == self.bot.user.id:
                 return
-            if not await self.is_log_bot() and old_message.author.bot:
+            if not state.is_log_bot() and old_message.author.bot:
                 return
 
             try:
@@ -576,7 +1358,9 @@ class Logger(commands.Cog):
                 time = old_message.created_at.strftime('%b %d, %Y at %I:%M %p UTC')
             md_time = old_message.created_at.strftime('%H%M_%d_%B_%Y_in_UTC')
 
-            return await channel.send(embed=self.make_embed(
+            self.record(state, 'edit', channel_id=channel_id, user_id=old_message.author.id, message_id=message_id,
+                        content=new_content, extra={'before': old_message.content})
+            return self.send_log(channel, self.make_embed(
                 f'A message was updated in #{channel_text}.',
                 fields=[('Before', old_message.content or 'No Content', False),
                         ('After', new_content or 'No Content', False),
@@ -589,9 +1373,9 @@ class Logger(commands.Cog):
 
         try:
             message = await payload_channel.fetch_message(message_id)
-            if not await self.is_log_modmail() and message.author.id == self.bot.user.id:
+            if not state.is_log_modmail() and message.author.id == self.bot.user.id:
                 return
-            if not await self.is_log_bot() and message.author.bot:
+            if not state.is_log_bot() and message.author.bot:
                 return
             try:
                 time = message.created_at.strftime('%b %-d, %Y at %-I:%M %p UTC')
@@ -599,7 +1383,9 @@ class Logger(commands.Cog):
                 time = message.created_at.strftime('%b %d, %Y at %I:%M %p UTC')
             md_time = message.created_at.strftime('%H%M_%d_%B_%Y_in_UTC')
 
-            return await channel.send(embed=self.make_embed(
+            self.record(state, 'edit', channel_id=channel_id, user_id=message.author.id, message_id=message_id,
+                        content=new_content)
+            return self.send_log(channel, self.make_embed(
                 f'A message was updated in #{channel_text}.',
                 'The former message content cannot be found.',
                 fields=[('Now', new_content or 'No Content', False),
@@ -610,7 +1396,8 @@ class Logger(commands.Cog):
                         ]
             ))
         except NotFound:
-            return await channel.send(embed=self.make_embed(
+            self.record(state, 'edit', channel_id=channel_id, message_id=message_id, content=new_content)
+            return self.send_log(channel, self.make_embed(
                 f'A message was updated in #{channel_text}.',
                 'The former message content cannot be found.',
                 fields=[('Now', new_content or 'No Content', False),
@@ -619,32 +1406,98 @@ class Logger(commands.Cog):
                         ]
             ))
 
+    @commands.Cog.listener()
+    async def on_thread_ready(self, thread, *args):
+        self.thread_messages.add_channel(thread.channel.id)
+
+    @commands.Cog.listener()
+    async def on_thread_close(self, thread, *args):
+        self.thread_messages.remove_channel(thread.channel.id)
+
+    @commands.Cog.listener()
+    async def on_message(self, message):
+        # Anything in a thread channel may end up logged as a thread message
+        self.thread_messages.add_message(message.channel.id, message.id)
+        if message.guild is None:
+            return
+        state = self.states.get(message.guild.id)
+        if state is None:
+            return
+        try:
+            if not state.is_logged(message.channel.id):
+                return
+        except ValueError:
+            return
+        self.messages.add(message)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_create(self, channel):
+        state = self.states.get(channel.guild.id)
+        if state is not None:
+            self.request_audit_logs(state)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_update(self, before, after):
+        state = self.states.get(after.guild.id)
+        if state is not None:
+            self.request_audit_logs(state)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel):
+        state = self.states.get(channel.guild.id)
+        if state is not None:
+            self.request_audit_logs(state)
+
+    @commands.Cog.listener()
+    async def on_member_ban(self, guild, user):
+        state = self.states.get(guild.id)
+        if state is not None:
+            self.request_audit_logs(state)
+
+    @commands.Cog.listener()
+    async def on_member_unban(self, guild, user):
+        state = self.states.get(guild.id)
+        if state is not None:
+            self.request_audit_logs(state)
+
     @commands.Cog.listener()
     async def on_member_join(self, member):
-        if member.guild.id != self.bot.guild_id:
+        state = self.states.get(member.guild.id)
+        if state is None:
             return
         try:
-            channel = await self.get_log_channel()
+            channel = state.get_log_channel()
         except ValueError:
             return
-        await channel.send(embed=self.make_embed(
+        self.record(state, 'join', user_id=member.id)
+        self.send_log(channel, self.make_embed(
             'Member Joined',
             f'{member.mention} has joined.'
         ))
 
     @commands.Cog.listener()
     async def on_member_remove(self, member):
-        if member.guild.id != self.bot.guild_id:
+        state = self.states.get(member.guild.id)
+        if state is None:
             return
+        # Kicked or pruned
+        self.request_audit_logs(state)
         try:
-            channel = await self.get_log_channel()
+            channel = state.get_log_channel()
         except ValueError:
             return
-        await channel.send(embed=self.make_embed(
+        self.record(state, 'leave', user_id=member.id)
+        self.send_log(channel, self.make_embed(
             'Member Left',
             f'{member} has left.'
         ))
 
+    def send_log(self, channel, embed, file=None):
+        writer = self._writers.get(channel.id)
+        if writer is None:
+            writer = self._writers[channel.id] = LogWriter(self.bot, channel)
+        writer.put(embed, file)
+
     def make_embed(self, title, description='', *, time=None, fields=None, footer=None):
         embed = Embed(title=title[:256], description=description[:2048], color=self.bot.main_color)
         embed.timestamp = time if time is not None else datetime.datetime.utcnow()
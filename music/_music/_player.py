@@ -36,7 +36,7 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 import asyncio
 import json
 import typing
-from time import time
+from time import perf_counter, time
 
 import lavalink
 
@@ -47,6 +47,8 @@ from core.models import getLogger
 
 from .queue import Queue
 from .audiotrack import LazyAudioTrack
+from .nodes import NodeBalancer
+from .metrics import metrics
 from .exceptions import *
 from .utils import *
 
@@ -79,6 +81,11 @@ class Player(lavalink.BasePlayer):
         self.main_color = discord.Colour.blurple()
         self.error_color = discord.Colour.red()
 
+        # Whether the state changed since the last checkpoint
+        self.dirty = True
+        # perf_counter of the play command waiting for its track to start
+        self.play_requested_at: typing.Optional[float] = None
+
     @property
     def command_channel(self) -> typing.Optional[TextChannel]:
         if not self._cmd_channel:
@@ -87,6 +94,7 @@ class Player(lavalink.BasePlayer):
         if not (perm.read_messages and perm.send_messages):
             logger.debug("No permission for music command channel")
             self._cmd_channel = None
+            self.dirty = True
         return self._cmd_channel
 
     @command_channel.setter
@@ -94,6 +102,7 @@ class Player(lavalink.BasePlayer):
         perm = channel.permissions_for(channel.guild.me)
         if perm.read_messages and perm.send_messages:
             self._cmd_channel = channel
+            self.dirty = True
         else:
             logger.debug("No permission for potential music command channel")
 
@@ -106,6 +115,7 @@ class Player(lavalink.BasePlayer):
         if self._playing_message:
             asyncio.create_task(self._playing_message.delete())
         self._playing_message = value
+        self.dirty = True
 
     async def send_playing_message(self, track):
         if not self.command_channel:
@@ -129,6 +139,7 @@ class Player(lavalink.BasePlayer):
     @repeat.setter
     def repeat(self, value: typing.Optional[str]) -> None:
         self.queue.repeat = value
+        self.dirty = True
 
     @property
     def current(self) -> typing.Optional[LazyAudioTrack]:
@@ -156,6 +167,11 @@ class Player(lavalink.BasePlayer):
     def remaining(self) -> float:
         return self.queue.remaining
 
+    @property
+    def node_balancer(self) -> NodeBalancer:
+        # noinspection PyProtectedMember
+        return self.node._manager._lavalink.node_balancer
+
     def load_next_few(self) -> None:
         self.queue.load_next_few()
 
@@ -166,7 +182,8 @@ class Player(lavalink.BasePlayer):
         logger.debug(f"Fetching playlist {query}")
         retry = 3
         while retry > 0:
-            resp = await self.node.get_tracks(query)
+            with metrics.timer(f'lavalink.loadtracks.{self.node.name}'):
+                resp = await self.node.get_tracks(query)
             if resp and resp.get('loadType') == 'LOAD_FAILED':
                 logger.warning("Failed to fetch track for %s %s retry %s", query, resp, retry)
                 retry -= 1
@@ -181,7 +198,8 @@ class Player(lavalink.BasePlayer):
         logger.debug(f"Fetching track {query}")
         retry = 3
         while retry > 0:
-            resp = await self.node.get_tracks(query)
+            with metrics.timer(f'lavalink.loadtracks.{self.node.name}'):
+                resp = await self.node.get_tracks(query)
             if resp and resp.get('loadType') == 'LOAD_FAILED':
                 logger.warning("Failed to fetch track for %s %s retry %s", query, resp, retry)
                 retry -= 1
@@ -228,6 +246,17 @@ class Player(lavalink.BasePlayer):
                     except discord.HTTPException:
                         logger.debug("Failed to send queue message.")
 
+    async def enqueue_many(self, tracks: typing.List[LazyAudioTrack]) -> None:
+        if not tracks:
+            return
+        self.cancel_tasks()
+        playing = self.is_playing_a_track
+        self.queue.extend(tracks)
+        if not playing:
+            await self.play_next()
+        else:
+            self.load_next_few()
+
     async def play_previous(self, start_time: int = 0, end_time: int = 0, no_replace: bool = False) \
             -> typing.Optional[LazyAudioTrack]:
         self.cancel_tasks()
@@ -242,20 +271,26 @@ class Player(lavalink.BasePlayer):
 
     async def set_pause(self, pause: bool):
         logger.debug("Setting pause to %s", pause)
+        # Freeze (or resume) the extrapolated position from where it is now
+        self.queue.seed_position(self.position)
         # noinspection PyProtectedMember
         await self.node._send(op='pause', guildId=self.guild_id, pause=pause)
         self.paused = pause
+        self.dirty = True
 
     async def set_volume(self, vol: int):
         logger.debug("Setting volume to %s", vol)
         self.volume = max(min(vol, 1000), 0)
+        self.dirty = True
         # noinspection PyProtectedMember
         await self.node._send(op='volume', guildId=self.guild_id, volume=self.volume)
 
     async def seek(self, position: int):
         logger.debug("Setting pos to %s", position)
+        self.dirty = True
         # noinspection PyProtectedMember
         await self.node._send(op='seek', guildId=self.guild_id, position=position)
+        self.queue.seed_position(position)
 
     async def fastforward(self, seconds: float) -> None:
         if not self.is_playing_a_track:
@@ -266,7 +301,7 @@ class Player(lavalink.BasePlayer):
             await self.play_next()
         else:
             await self.seek(new_pos)
-            await self._update_state({'position': new_pos, 'time': time()})
+            await self.queue.update_state({'position': new_pos, 'time': int(time() * 1000)})
 
     async def rewind(self, seconds: float) -> None:
         if not self.is_playing_a_track:
@@ -274,10 +309,14 @@ class Player(lavalink.BasePlayer):
         ms = seconds * 1000
         new_pos = max(int(self.position - ms), 0)
         await self.seek(new_pos)
-        await self._update_state({'position': new_pos, 'time': time()})
+        await self.queue.update_state({'position': new_pos, 'time': int(time() * 1000)})
 
     async def _handle_event(self, event: lavalink.Event) -> None:
         if isinstance(event, lavalink.TrackStartEvent):
+            # lavalink.py drops Lavalink's own TrackStartEvent, this is the one the queue dispatches for the play op
+            if self.play_requested_at is not None:
+                metrics.observe('play.command_to_start', (perf_counter() - self.play_requested_at) * 1000)
+                self.play_requested_at = None
             self.cancel_tasks()
             await self.send_playing_message(event.track)
         elif isinstance(event, lavalink.TrackStuckEvent):
@@ -334,6 +373,10 @@ class Player(lavalink.BasePlayer):
             asyncio.create_task(self.play_next())
 
     async def _update_state(self, state: dict) -> None:
+        # Only called for playerUpdates from Lavalink
+        if 'time' in state:
+            # Includes any clock difference with the node
+            metrics.observe(f'lavalink.player_update_delay.{self.node.name}', max(time() * 1000 - state['time'], 0))
         await self.queue.update_state(state)
 
     async def change_node(self, node: lavalink.Node) -> None:
@@ -344,6 +387,7 @@ class Player(lavalink.BasePlayer):
         logger.debug("Changing nodes for player %s", self)
         old_node = self.node
         self.node = node
+        self.dirty = True
 
         if self._voice_state:
             await self._dispatch_voice_update()
@@ -394,6 +438,7 @@ class Player(lavalink.BasePlayer):
             await self.queue.stop()
 
         self.channel_id = data['channel_id']
+        self.dirty = True
 
         if not self.channel_id:  # We're disconnecting
             logger.debug('Disconnecting from %s...', self.guild_id)
@@ -473,7 +518,8 @@ class Player(lavalink.BasePlayer):
             queue=self.queue.dump(),
             _cmd_channel_id=self._cmd_channel.id if self._cmd_channel else None,
             _playing_message_id=self._playing_message.id if self._playing_message else None,
-            node_name=self.node.name
+            node_name=self.node.name,
+            timestamp=time()
         )
         return json.dumps(data) if jsonify else data
 
@@ -512,6 +558,9 @@ class Player(lavalink.BasePlayer):
         self.volume = data['volume']
         paused = self.paused = data['paused']
         self.equalizer = data['equalizer']
+        if not paused and data.get('timestamp'):
+            # Checkpoints are periodic, account for the time played since this one was taken
+            self.queue.seed_position(self.queue.position + max(time() - data['timestamp'], 0) * 1000)
         logger.debug("Waiting for ready... %s", guild_id)
         await self.ready.wait()
         if self.is_playing_a_track:
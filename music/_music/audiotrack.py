@@ -34,30 +34,126 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 import json
 import re
+import typing
+import weakref
 from asyncio import Lock
 
 import lavalink
 
 from core.models import getLogger
 
-__all__ = ["LazyAudioTrack", 'CLEAN_TITLE_RE']
+__all__ = ["LazyAudioTrack", "TrackInfo", 'CLEAN_TITLE_RE']
 
 logger = getLogger(__name__)
 CLEAN_TITLE_RE = re.compile(r"\s*[(\[](?:official .+?|lyrics?)[)\]]", re.I)
 
 
+class TrackInfo:
+    """
+    The metadata of a loaded track.
+
+    Entries are interned by identifier, every queued copy of a track across all guilds shares the same one.
+    An entry is freed as soon as no track refers to it anymore.
+    """
+    __slots__ = ('identifier', 'track', 'title', 'author', 'duration', 'is_seekable', 'stream', 'uri', '_line',
+                 '__weakref__')
+    _interned: 'weakref.WeakValueDictionary[str, TrackInfo]' = weakref.WeakValueDictionary()
+
+    def __init__(self, identifier, track, title, author, duration, is_seekable, stream, uri):
+        self.identifier = identifier
+        self.track = track
+        self.title = title
+        self.author = author
+        self.duration = duration
+        self.is_seekable = is_seekable
+        self.stream = stream
+        self.uri = uri
+        self._line = None
+
+    @classmethod
+    def intern(cls, identifier, track, **info) -> 'TrackInfo':
+        self = cls._interned.get(identifier)
+        if self is None or self.track != track:
+            self = cls._interned[identifier] = cls(identifier, track, **info)
+        return self
+
+    @classmethod
+    def from_data(cls, data: dict) -> 'TrackInfo':
+        return cls.intern(
+            data['info']['identifier'],
+            data['track'],
+            title=CLEAN_TITLE_RE.sub("", data['info']['title']),
+            author=data['info']['author'],
+            duration=data['info']['length'],
+            is_seekable=data['info']['isSeekable'],
+            stream=data['info']['isStream'],
+            uri=data['info']['uri'],
+        )
+
+    @classmethod
+    def lookup(cls, identifier: str) -> typing.Optional['TrackInfo']:
+        return cls._interned.get(identifier)
+
+    @classmethod
+    def count(cls) -> int:
+        return len(cls._interned)
+
+    def dump(self) -> dict:
+        return {name: getattr(self, name) for name in self.__slots__[:-2]}
+
+    @classmethod
+    def load_dump(cls, data: dict) -> 'TrackInfo':
+        return cls.intern(**data)
+
+    @property
+    def line(self) -> str:
+        # Entries never change, so they are serialised once for every save file they end up in
+        if self._line is None:
+            self._line = json.dumps({'track_info': self.dump()}, separators=(',', ':'))
+        return self._line
+
+
+def _info_property(name):
+    def getter(self):
+        if self.info is None:
+            raise AttributeError("Track not loaded.")
+        return getattr(self.info, name)
+    return property(getter)
+
+
 class LazyAudioTrack(lavalink.AudioTrack):
+    track = _info_property('track')
+    identifier = _info_property('identifier')
+    is_seekable = _info_property('is_seekable')
+    author = _info_property('author')
+    stream = _info_property('stream')
+    uri = _info_property('uri')
+
     # noinspection PyMissingConstructor
     def __init__(self, query, title, requester: int, *, duration=None, spotify=False):
         self.requester = requester
         self.query = query
-        self.og_title = self.title = CLEAN_TITLE_RE.sub("", title)
+        self.og_title = self._title = CLEAN_TITLE_RE.sub("", title)
         self.spotify = spotify
-        if duration:
-            self.duration = duration
+        self._duration = duration or None
+        self.info: typing.Optional[TrackInfo] = None
         self._load_lock = Lock()
         self.loaded = False
         self.success = True
+        # Set once the track data was evicted, loads the exact same track again
+        self.reload_query = None
+
+    @property
+    def title(self):
+        return self.info.title if self.info is not None else self._title
+
+    @property
+    def duration(self):
+        if self.info is not None:
+            return self.info.duration
+        if self._duration is None:
+            raise AttributeError("Track not loaded.")
+        return self._duration
 
     @classmethod
     def from_loaded(cls, data: dict, requester: int, **extra) -> 'LazyAudioTrack':
@@ -68,14 +164,7 @@ class LazyAudioTrack(lavalink.AudioTrack):
 
     def _parse_data(self, data):
         try:
-            self.track = data['track']
-            self.identifier = data['info']['identifier']
-            self.is_seekable = data['info']['isSeekable']
-            self.author = data['info']['author']
-            self.duration = data['info']['length']
-            self.stream = data['info']['isStream']
-            self.title = CLEAN_TITLE_RE.sub("", data['info']['title'])
-            self.uri = data['info']['uri']
+            self.info = TrackInfo.from_data(data)
         except KeyError as ke:
             self.success = False
             missing_key, = ke.args
@@ -90,7 +179,7 @@ class LazyAudioTrack(lavalink.AudioTrack):
                 return
             # noinspection PyBroadException
             try:
-                result = await player.req_lavalink_track(self.query)
+                result = await player.req_lavalink_track(self.reload_query or self.query)
             except Exception:
                 logger.error("Fetching track failed %s", self, exc_info=True)
                 self.success = False
@@ -103,22 +192,31 @@ class LazyAudioTrack(lavalink.AudioTrack):
                 self.success = False
                 logger.error("Fetching track failed %s %s", self, result)
 
+    def unload(self) -> bool:
+        info = self.info
+        if not self.loaded or not self.success or info is None or info.stream or not info.uri:
+            return False
+        # Only what's needed to display the queue is kept, the entry is freed once no other guild queued it
+        self._title = info.title
+        self._duration = info.duration
+        self.reload_query = info.uri
+        self.info = None
+        self.loaded = False
+        return True
+
     def dump(self, jsonify=False):
         data = dict(
             requester=self.requester,
             query=self.query,
             og_title=self.og_title,
-            title=self.title,
+            title=self._title,
             spotify=self.spotify,
-            duration=getattr(self, 'duration', None),
+            duration=self._duration,
             loaded=self.loaded,
             success=self.success,
-            track=getattr(self, 'track', None),
-            identifier=getattr(self, 'identifier', None),
-            is_seekable=getattr(self, 'is_seekable', None),
-            author=getattr(self, 'author', None),
-            stream=getattr(self, 'stream', None),
-            uri=getattr(self, 'uri', None),
+            # Save files store every entry once, see StateCheckpointer
+            info=self.info.identifier if self.info is not None else None,
+            reload_query=self.reload_query,
         )
         return json.dumps(data) if jsonify else data
 
@@ -128,25 +226,27 @@ class LazyAudioTrack(lavalink.AudioTrack):
             data = json.loads(data)
         self = cls(data['query'], data['title'], data['requester'], duration=data['duration'], spotify=data['spotify'])
         self.og_title = data['og_title']
-        self.title = data['title']
         self.loaded = data['loaded']
         self.success = data['success']
-        self.track = data['track']
-        self.identifier = data['identifier']
-        self.is_seekable = data['is_seekable']
-        self.author = data['author']
-        self.stream = data['stream']
-        self.uri = data['uri']
+        self.reload_query = data.get('reload_query')
+
+        info = data.get('info')
+        if isinstance(info, str):
+            info = TrackInfo.lookup(info)
+        elif isinstance(info, dict):
+            info = TrackInfo.load_dump(info)
+        elif info is None and data.get('track'):
+            # Saved before entries were shared
+            info = TrackInfo.intern(
+                data['identifier'], data['track'], title=data['title'], author=data['author'],
+                duration=data['duration'], is_seekable=data['is_seekable'], stream=data['stream'], uri=data['uri']
+            )
+        self.info = info
+        if self.loaded and self.success and info is None:
+            # The entry is gone, the track has to be fetched again
+            self.loaded = False
         return self
 
-    def __getattribute__(self, name):
-        try:
-            return super().__getattribute__(name)
-        except AttributeError:
-            if name in {'track', 'identifier', 'is_seekable', 'author', 'duration', 'stream', 'title', 'uri'}:
-                raise AttributeError("Track not loaded.")
-            raise
-
     def __repr__(self):
         if self.loaded and self.success:
             return '<AudioTrack title={0.title} identifier={0.identifier} loaded=True>'.format(self)
@@ -0,0 +1,194 @@
+"""
+As substantial work has been placed—a few months of development—to make this fully featured music bot free for public use, please refrain from discrediting author or falsely claiming this open source work.
+
+BSD 3-Clause License
+
+Copyright (c) 2021, taku#3343 (Discord)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import time
+import typing
+
+from core.models import getLogger
+
+from .audiotrack import TrackInfo
+
+__all__ = ['StateCheckpointer']
+
+logger = getLogger(__name__)
+
+
+class StateCheckpointer:
+    """
+    Periodically saves the state of connected players to newline-delimited JSON files, one per node.
+
+    The first line of each file is a header with the node information, followed by every track info
+    the queues on that node refer to, written once each. Every following line is one guild.
+    Only players marked as dirty are serialised again, the lines of the other players are reused as is.
+    Files are written off the event loop to a temporary file, then atomically renamed over the old one.
+    """
+    EXTENSION = '.ndjson'
+
+    def __init__(self, bot, path: str):
+        self.bot = bot
+        self.path = path
+        # guild_id -> (node_name, serialised line)
+        self._lines: typing.Dict[int, typing.Tuple[str, str]] = {}
+        # guild_id -> track infos referenced by its line
+        self._infos: typing.Dict[int, typing.Dict[str, TrackInfo]] = {}
+        self._nodes: typing.Dict[str, dict] = {}
+        self._lock = asyncio.Lock()
+
+    def _file(self, node_name: str) -> str:
+        return os.path.join(self.path, f"{node_name}{self.EXTENSION}")
+
+    def _drop(self, gid: int) -> str:
+        self._infos.pop(gid, None)
+        return self._lines.pop(gid)[0]
+
+    def _collect(self, force: bool = False) -> typing.Dict[str, typing.Optional[typing.List[str]]]:
+        changed_nodes = set()
+        players = self.bot.lavalink.player_manager.players
+
+        for gid in [gid for gid in self._lines if gid not in players]:
+            changed_nodes.add(self._drop(gid))
+
+        for gid, player in players.items():
+            if not player.is_connected:
+                if gid in self._lines:
+                    changed_nodes.add(self._drop(gid))
+                continue
+            if not player.dirty and not force and gid in self._lines:
+                continue
+            player.dirty = False
+            data = player.dump()
+            node_name = data['node_name']
+            line = json.dumps({'guild_id': gid, 'data': data}, separators=(',', ':'))
+            old = self._lines.get(gid)
+            if old is not None:
+                changed_nodes.add(old[0])
+            changed_nodes.add(node_name)
+            self._lines[gid] = node_name, line
+            self._infos[gid] = {track.info.identifier: track.info for track in player.queue if track.info is not None}
+            self._nodes[node_name] = {'node_name': node_name, 'host': player.node.host, 'port': player.node.port}
+
+        writes = {}
+        for node_name in changed_nodes:
+            gids = [gid for gid, (name, _) in self._lines.items() if name == node_name]
+            if not gids:
+                writes[node_name] = None
+                continue
+            infos = {}
+            for gid in gids:
+                infos.update(self._infos.get(gid, {}))
+            writes[node_name] = [info.line for info in infos.values()] + [self._lines[gid][1] for gid in gids]
+        return writes
+
+    def _write(self, writes: typing.Dict[str, typing.Optional[typing.List[str]]], timestamp: float) -> None:
+        for node_name, lines in writes.items():
+            save_file = self._file(node_name)
+            if lines is None:
+                if os.path.exists(save_file):
+                    os.unlink(save_file)
+                continue
+            header = dict(self._nodes.get(node_name, {'node_name': node_name}), timestamp=timestamp)
+            fd, tmp_file = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+            with os.fdopen(fd, 'w') as f:
+                f.write(json.dumps(header, separators=(',', ':')))
+                f.write('\n')
+                f.write('\n'.join(lines))
+                f.write('\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, save_file)
+
+    async def checkpoint(self) -> int:
+        async with self._lock:
+            writes = self._collect()
+            if not writes:
+                return 0
+            logger.debug("Checkpointing music states for %s", ', '.join(writes))
+            await self.bot.loop.run_in_executor(None, self._write, writes, time.time())
+            return len(writes)
+
+    def flush(self) -> None:
+        # Used on unload, every position is up to date this way
+        writes = self._collect(force=True)
+        self._write(writes, time.time())
+
+    def discard(self, node_name: str) -> None:
+        for gid in [gid for gid, (name, _) in self._lines.items() if name == node_name]:
+            self._drop(gid)
+        save_file = self._file(node_name)
+        if os.path.exists(save_file):
+            os.unlink(save_file)
+
+    @classmethod
+    def read_header(cls, save_file: str) -> typing.Optional[dict]:
+        with open(save_file, 'r') as f:
+            if save_file.endswith('.json'):
+                # Save file from before checkpoints, the whole thing has to be parsed
+                save = json.load(f)
+                save.pop('guilds', None)
+                return save
+            line = f.readline()
+        return json.loads(line) if line.strip() else None
+
+    @classmethod
+    def iter_guilds(cls, save_file: str) -> typing.Iterator[typing.Tuple[int, dict]]:
+        with open(save_file, 'r') as f:
+            if save_file.endswith('.json'):
+                for gid, data in json.load(f)['guilds'].items():
+                    yield int(gid), data
+                return
+            f.readline()  # header
+            # Guild records hold on to the entries they refer to until they are restored
+            infos: typing.Dict[str, TrackInfo] = {}
+            for line in f:
+                if not line.strip():
+                    continue
+                # noinspection PyBroadException
+                try:
+                    record = json.loads(line)
+                except Exception:
+                    logger.warning("Skipping corrupted line in %s", save_file, exc_info=True)
+                    continue
+                if 'track_info' in record:
+                    info = TrackInfo.load_dump(record['track_info'])
+                    infos[info.identifier] = info
+                    continue
+                for track in record['data']['queue']['tracks']:
+                    if isinstance(track.get('info'), str):
+                        track['info'] = infos.get(track['info'])
+                yield int(record['guild_id']), record['data']
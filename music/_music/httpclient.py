@@ -0,0 +1,207 @@
+"""
+As substantial work has been placed—a few months of development—to make this fully featured music bot free for public use, please refrain from discrediting author or falsely claiming this open source work.
+
+BSD 3-Clause License
+
+Copyright (c) 2021, taku#3343 (Discord)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import asyncio
+import collections
+import typing
+
+import aiohttp
+
+from core.models import getLogger
+
+__all__ = ['HTTPClient', 'UpstreamStats']
+
+logger = getLogger(__name__)
+
+
+class UpstreamStats:
+    """
+    Request counters and a window of recent latencies for one upstream.
+    """
+    WINDOW = 256
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.latencies = collections.deque(maxlen=self.WINDOW)
+
+    def record(self, elapsed: float, error: bool = False) -> None:
+        self.requests += 1
+        if error:
+            self.errors += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.latencies.append(elapsed)
+
+    def percentile(self, p: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * p), len(ordered) - 1)]
+
+    def dump(self) -> dict:
+        return dict(
+            requests=self.requests,
+            errors=self.errors,
+            retries=self.retries,
+            avg_ms=self.total_time / self.requests * 1000 if self.requests else 0.0,
+            p50_ms=self.percentile(0.5) * 1000,
+            p95_ms=self.percentile(0.95) * 1000,
+            max_ms=self.max_time * 1000,
+        )
+
+
+class HTTPClient:
+    """
+    All HTTP traffic of the music plugin goes through one tuned connector.
+
+    Each upstream gets its own session on the shared connector, with its own timeouts,
+    and every request made through it is timed.
+    """
+    TIMEOUTS = {
+        'lavalink': aiohttp.ClientTimeout(total=30, connect=5),
+        'spotify': aiohttp.ClientTimeout(total=10, connect=5),
+        'genius': aiohttp.ClientTimeout(total=15, connect=5),
+    }
+    DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=5)
+    RETRY_STATUSES = {429, 500, 502, 503, 504}
+    RETRIES = 2
+
+    def __init__(self):
+        self._connector: typing.Optional[aiohttp.TCPConnector] = None
+        self._sessions: typing.Dict[str, aiohttp.ClientSession] = {}
+        self.stats: typing.Dict[str, UpstreamStats] = collections.defaultdict(UpstreamStats)
+
+    @property
+    def connector(self) -> aiohttp.TCPConnector:
+        if self._connector is None or self._connector.closed:
+            self._connector = aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=20,
+                ttl_dns_cache=300,
+                keepalive_timeout=30,
+                enable_cleanup_closed=True,
+            )
+        return self._connector
+
+    def _trace(self, upstream: str) -> aiohttp.TraceConfig:
+        stats = self.stats[upstream]
+        trace = aiohttp.TraceConfig()
+
+        # noinspection PyUnusedLocal
+        async def on_request_start(session, ctx, params):
+            ctx.start = asyncio.get_event_loop().time()
+
+        # noinspection PyUnusedLocal
+        async def on_request_end(session, ctx, params):
+            stats.record(asyncio.get_event_loop().time() - ctx.start, error=params.response.status >= 400)
+
+        # noinspection PyUnusedLocal
+        async def on_request_exception(session, ctx, params):
+            stats.record(asyncio.get_event_loop().time() - ctx.start, error=True)
+
+        trace.on_request_start.append(on_request_start)
+        trace.on_request_end.append(on_request_end)
+        trace.on_request_exception.append(on_request_exception)
+        return trace
+
+    def session(self, upstream: str) -> aiohttp.ClientSession:
+        session = self._sessions.get(upstream)
+        if session is None or session.closed:
+            session = self._sessions[upstream] = aiohttp.ClientSession(
+                connector=self.connector,
+                connector_owner=False,
+                timeout=self.TIMEOUTS.get(upstream, self.DEFAULT_TIMEOUT),
+                trace_configs=[self._trace(upstream)],
+            )
+        return session
+
+    async def request(self, upstream: str, method: str, url: str, *, read: str = 'json',
+                      retries: int = None, raise_for_status: bool = False,
+                      **kwargs) -> typing.Tuple[int, typing.Any]:
+        retries = self.RETRIES if retries is None else retries
+        # Only idempotent requests are retried after they were sent
+        idempotent = method.upper() in {'GET', 'HEAD'}
+        attempt = 0
+        while True:
+            try:
+                async with self.session(upstream).request(method, url, **kwargs) as r:
+                    if idempotent and r.status in self.RETRY_STATUSES and attempt < retries:
+                        delay = float(r.headers.get('Retry-After', 2 ** attempt)) if r.status == 429 else 2 ** attempt
+                        raise _Retry(delay)
+                    if raise_for_status:
+                        r.raise_for_status()
+                    if read == 'json':
+                        body = await r.json(content_type=None)
+                    elif read == 'text':
+                        body = await r.text()
+                    else:
+                        body = await r.read()
+                    return r.status, body
+            except _Retry as e:
+                delay = e.delay
+            except (aiohttp.ClientConnectorError, asyncio.TimeoutError, aiohttp.ServerDisconnectedError) as e:
+                retryable = idempotent or isinstance(e, aiohttp.ClientConnectorError)
+                if not retryable or attempt >= retries:
+                    raise
+                delay = 2 ** attempt
+            attempt += 1
+            self.stats[upstream].retries += 1
+            logger.debug("Retrying %s %s (%s) in %ss", method, url, upstream, delay)
+            await asyncio.sleep(min(delay, 10))
+
+    def dump_stats(self) -> typing.Dict[str, dict]:
+        return {upstream: stats.dump() for upstream, stats in self.stats.items()}
+
+    async def close_sessions(self, keep: typing.Collection[str] = ()) -> None:
+        # The connector stays open, closed sessions are opened again when they're next used
+        for upstream in [u for u in self._sessions if u not in keep]:
+            session = self._sessions.pop(upstream)
+            if not session.closed:
+                await session.close()
+
+    async def close(self) -> None:
+        await self.close_sessions()
+        if self._connector is not None and not self._connector.closed:
+            await self._connector.close()
+        self._connector = None
+
+
+class _Retry(Exception):
+    def __init__(self, delay):
+        self.delay = delay
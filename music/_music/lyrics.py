@@ -34,38 +34,196 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 """
 
 import asyncio
-import os
+import json
+import re
+import sqlite3
+import time
 import typing
+import urllib.parse
 from concurrent import futures
 
-from lyricsgenius import Genius
-from lyricsgenius.types.song import Song
+import aiohttp
+from bs4 import BeautifulSoup, NavigableString
 
-from .utils import cache
+from core.models import getLogger
 
-__all__ = ["Lyrics"]
+from .audiotrack import CLEAN_TITLE_RE
+from .httpclient import HTTPClient
+from .metrics import metrics
+
+__all__ = ["Lyrics", "Song"]
+
+logger = getLogger(__name__)
+
+FEATURING_RE = re.compile(r"\s*[(\[]?\b(?:feat|ft|featuring)\b\.?.*$", re.I)
+NON_WORD_RE = re.compile(r"[\W_]+")
+
+
+def normalise(s: typing.Optional[str]) -> str:
+    if not s:
+        return ''
+    s = CLEAN_TITLE_RE.sub("", s)
+    s = FEATURING_RE.sub("", s)
+    return NON_WORD_RE.sub(" ", s.casefold()).strip()
+
+
+class Song:
+    __slots__ = ('title', 'artist', 'lyrics', 'url')
+
+    def __init__(self, title: str, artist: str, lyrics: str, url: str):
+        self.title = title
+        self.artist = artist
+        self.lyrics = lyrics
+        self.url = url
+
+    def dump(self) -> dict:
+        return dict(title=self.title, artist=self.artist, lyrics=self.lyrics, url=self.url)
+
+    @classmethod
+    def load_dump(cls, data: dict) -> 'Song':
+        return cls(data['title'], data['artist'], data['lyrics'], data['url'])
+
+    def __repr__(self):
+        return '<Song title={0.title} artist={0.artist}>'.format(self)
+
+
+class LyricsCache:
+    """
+    Persistent lyrics cache backed by sqlite, all access happens on a single worker thread.
+    """
+    # Songs without lyrics are looked up again after a while, Genius may have them by then
+    MISS_EXPIRES_AFTER = 86400
+
+    def __init__(self, path: str):
+        self._executor = futures.ThreadPoolExecutor(max_workers=1)
+        self._db: typing.Optional[sqlite3.Connection] = None
+        self._path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            self._db = sqlite3.connect(self._path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS lyrics "
+                             "(key TEXT PRIMARY KEY, song TEXT, created_at REAL NOT NULL)")
+            self._db.commit()
+        return self._db
+
+    def _get(self, key: str) -> typing.Tuple[bool, typing.Optional[Song]]:
+        row = self._connect().execute("SELECT song, created_at FROM lyrics WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False, None
+        song, created_at = row
+        if song is None:
+            if time.time() - created_at >= self.MISS_EXPIRES_AFTER:
+                return False, None
+            return True, None
+        return True, Song.load_dump(json.loads(song))
+
+    def _set(self, key: str, song: typing.Optional[Song]) -> None:
+        db = self._connect()
+        db.execute("INSERT OR REPLACE INTO lyrics (key, song, created_at) VALUES (?, ?, ?)",
+                   (key, json.dumps(song.dump()) if song else None, time.time()))
+        db.commit()
+
+    async def get(self, key: str) -> typing.Tuple[bool, typing.Optional[Song]]:
+        return await asyncio.get_event_loop().run_in_executor(self._executor, self._get, key)
+
+    async def set(self, key: str, song: typing.Optional[Song]) -> None:
+        await asyncio.get_event_loop().run_in_executor(self._executor, self._set, key, song)
+
+    def close(self) -> None:
+        def _close():
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+        self._executor.submit(_close)
+        self._executor.shutdown(wait=False)
 
 
 class Lyrics:
-    def __init__(self, GENIUS_TOKEN):
-        self._executor = futures.ThreadPoolExecutor(max_workers=3)
+    API_BASE = 'https://api.genius.com/'
+    WEB_BASE = 'https://genius.com/'
+
+    def __init__(self, GENIUS_TOKEN, http: HTTPClient, *, cache_path: str = None,
+                 api_base: str = None, web_base: str = None):
         self.GENIUS_TOKEN = GENIUS_TOKEN
+        self.http = http
+        self.api_base = api_base or self.API_BASE
+        self.web_base = web_base or self.WEB_BASE
+        self.cache = LyricsCache(cache_path) if cache_path else None
+        self._in_flight: typing.Dict[str, asyncio.Future] = {}
+
+    async def _api_get(self, path: str, **params) -> dict:
+        headers = {'Authorization': f'Bearer {self.GENIUS_TOKEN}'}
+        _, data = await self.http.request('genius', 'GET', self.api_base + path, params=params, headers=headers,
+                                          raise_for_status=True)
+        return data['response']
 
     async def test_token(self) -> bool:
-        loop = asyncio.get_event_loop()
-        genius = Genius(self.GENIUS_TOKEN, verbose=False)
-        import requests
         try:
-            await loop.run_in_executor(self._executor, genius.search_song, "chevy uwu")
+            await self._api_get('search', q='chevy uwu')
             return True
-        except requests.exceptions.HTTPError:
+        except aiohttp.ClientResponseError:
             return False
 
-    def _fetch_lyrics(self, query: str) -> typing.Optional[Song]:
-        genius = Genius(self.GENIUS_TOKEN, verbose=False)
-        return genius.search_song(query, get_full_info=False)
-
-    @cache(512)
-    async def fetch_lyrics(self, query: str) -> typing.Optional[Song]:
-        loop = asyncio.get_event_loop()
-        return await loop.run_in_executor(self._executor, self._fetch_lyrics, query)
+    @staticmethod
+    def _parse_lyrics(page: str) -> typing.Optional[str]:
+        soup = BeautifulSoup(page, "html.parser")
+        for header in soup.find_all("div", class_=re.compile("LyricsHeader")):
+            header.decompose()
+        containers = soup.find_all("div", attrs={"data-lyrics-container": "true"})
+        if not containers:
+            # Older layout
+            containers = soup.find_all("div", class_=re.compile("^lyrics$|Lyrics__Root"))
+        if not containers:
+            return None
+        for br in soup.find_all("br"):
+            br.replace_with(NavigableString("\n"))
+        lyrics = "\n".join(container.get_text() for container in containers)
+        return lyrics.strip("\n") or None
+
+    async def _search_song(self, query: str) -> typing.Optional[Song]:
+        response = await self._api_get('search', q=query)
+        hit = next((h['result'] for h in response.get('hits', []) if h.get('type') == 'song'), None)
+        if hit is None:
+            return None
+        url = hit['url']
+        _, page = await self.http.request('genius', 'GET', self.web_base + urllib.parse.urlparse(url).path.lstrip('/'),
+                                          read='text', raise_for_status=True)
+        # Parsing a whole page takes a while, keep it off the loop
+        lyrics = await asyncio.get_event_loop().run_in_executor(None, self._parse_lyrics, page)
+        if not lyrics:
+            return None
+        return Song(hit['title'], hit['primary_artist']['name'], lyrics, url)
+
+    async def _fetch_lyrics(self, key: str, query: str) -> typing.Optional[Song]:
+        if self.cache is not None:
+            found, song = await self.cache.get(key)
+            if found:
+                metrics.incr('lyrics.cache_hits')
+                return song
+        metrics.incr('lyrics.cache_misses')
+        try:
+            song = await self._search_song(query)
+        except aiohttp.ClientResponseError as e:
+            logger.warning("Failed to fetch lyrics for %s: [%s] %s", query, e.status, e.message)
+            return None
+        if self.cache is not None:
+            await self.cache.set(key, song)
+        return song
+
+    async def fetch_lyrics(self, query: str, artist: str = None) -> typing.Optional[Song]:
+        key = f"{normalise(query)}\x00{normalise(artist)}"
+        future = self._in_flight.get(key)
+        if future is None:
+            # Merge lookups of the same song that are already in flight
+            future = self._in_flight[key] = asyncio.ensure_future(
+                self._fetch_lyrics(key, f"{query} {artist}" if artist else query)
+            )
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        else:
+            metrics.incr('lyrics.merged')
+        return await asyncio.shield(future)
+
+    def close(self) -> None:
+        if self.cache is not None:
+            self.cache.close()
@@ -0,0 +1,124 @@
+"""
+As substantial work has been placed—a few months of development—to make this fully featured music bot free for public use, please refrain from discrediting author or falsely claiming this open source work.
+
+BSD 3-Clause License
+
+Copyright (c) 2021, taku#3343 (Discord)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import bisect
+import collections
+import contextlib
+import time
+import typing
+
+__all__ = ['Histogram', 'Metrics', 'metrics']
+
+
+class Histogram:
+    """
+    Counts observations in fixed buckets, in milliseconds.
+
+    Percentiles are the upper bound of the bucket they fall in.
+    """
+    BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms: float) -> None:
+        self.counts[bisect.bisect_left(self.BUCKETS, ms)] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def percentile(self, p: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else self.max
+        return self.max
+
+    def dump(self) -> dict:
+        return dict(
+            count=self.count,
+            avg_ms=self.total / self.count if self.count else 0.0,
+            p50_ms=self.percentile(0.5),
+            p95_ms=self.percentile(0.95),
+            max_ms=self.max,
+        )
+
+
+class Metrics:
+    """
+    Process wide counters and latency histograms of the music plugin.
+    """
+    def __init__(self):
+        self.counters: typing.Counter[str] = collections.Counter()
+        self.histograms: typing.Dict[str, Histogram] = collections.defaultdict(Histogram)
+        self.started_at = time.time()
+
+    def incr(self, name: str, n: int = 1) -> None:
+        self.counters[name] += n
+
+    def observe(self, name: str, ms: float) -> None:
+        self.histograms[name].observe(ms)
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.histograms[name].observe((time.perf_counter() - start) * 1000)
+
+    def dump(self) -> dict:
+        return dict(
+            uptime=time.time() - self.started_at,
+            counters=dict(self.counters),
+            histograms={name: histogram.dump() for name, histogram in sorted(self.histograms.items())},
+        )
+
+    def reset(self) -> None:
+        self.counters.clear()
+        self.histograms.clear()
+        self.started_at = time.time()
+
+
+metrics = Metrics()
@@ -0,0 +1,169 @@
+"""
+As substantial work has been placed—a few months of development—to make this fully featured music bot free for public use, please refrain from discrediting author or falsely claiming this open source work.
+
+BSD 3-Clause License
+
+Copyright (c) 2021, taku#3343 (Discord)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import asyncio
+import typing
+
+import lavalink
+
+from core.models import getLogger
+
+__all__ = ['NodeBalancer']
+
+logger = getLogger(__name__)
+
+
+class NodeBalancer:
+    """
+    Places players on the least loaded Lavalink node and moves them away from nodes that are struggling.
+
+    The load of a node is computed from the last ``stats`` op it sent (players, playingPlayers, cpu and frameStats).
+    Since Lavalink only sends stats once a minute, players placed in between are counted locally as well.
+    """
+    # Lavalink sends 50 frames per second for each playing player, frameStats are already averaged per player
+    FRAMES_PER_MINUTE = 3000
+    # Past these, a node is considered overloaded and players will be moved away from it
+    OVERLOAD_SYSTEM_LOAD = 0.9
+    OVERLOAD_FRAME_LOSS = 0.1
+    # Players moved per rebalance pass, changing node restarts the track so keep it low
+    MAX_MOVES = 5
+
+    def __init__(self, client: lavalink.Client):
+        self._client = client
+        self._available = asyncio.Event()
+
+    @property
+    def available_nodes(self) -> typing.List[lavalink.Node]:
+        return self._client.node_manager.available_nodes
+
+    def _local_players(self, node: lavalink.Node) -> typing.Tuple[int, int]:
+        players = playing = 0
+        for player in self._client.player_manager.players.values():
+            if player.node is node:
+                players += 1
+                if player.is_playing_a_track:
+                    playing += 1
+        return players, playing
+
+    def frame_loss(self, node: lavalink.Node) -> float:
+        stats = node.stats
+        if not stats or stats.playing_players <= 0:
+            return 0
+        lost = max(stats.frames_nulled, 0) + max(stats.frames_deficit, 0)
+        return lost / self.FRAMES_PER_MINUTE
+
+    def load(self, node: lavalink.Node) -> float:
+        if not node.available:
+            return float('inf')
+        players, playing = self._local_players(node)
+        stats = node.stats
+        if not stats:
+            # No stats received yet, only go by what we know
+            return playing + players * 0.1
+
+        playing = max(stats.playing_players, playing)
+        players = max(stats.players, players)
+        # Same curves as lavalink's Penalty, but using the local count and the lavalink process' own load
+        cpu = 1.05 ** (100 * stats.system_load) * 10 - 10
+        cpu += 1.05 ** (100 * stats.lavalink_load) * 5 - 5
+        frames = (1.03 ** (500 * self.frame_loss(node))) * 600 - 600
+        return playing + players * 0.1 + cpu + frames
+
+    def is_overloaded(self, node: lavalink.Node) -> bool:
+        if not node.available:
+            return True
+        stats = node.stats
+        if not stats:
+            return False
+        return stats.system_load >= self.OVERLOAD_SYSTEM_LOAD or self.frame_loss(node) >= self.OVERLOAD_FRAME_LOSS
+
+    def select(self, region: typing.Optional[str] = None, *,
+               exclude: typing.Optional[lavalink.Node] = None) -> typing.Optional[lavalink.Node]:
+        nodes = [n for n in self.available_nodes if n is not exclude]
+        if not nodes:
+            return None
+
+        healthy = [n for n in nodes if not self.is_overloaded(n)] or nodes
+        if region:
+            regional = [n for n in healthy if n.region == region]
+            if regional:
+                healthy = regional
+        return min(healthy, key=self.load)
+
+    def select_for_endpoint(self, endpoint: typing.Optional[str]) -> typing.Optional[lavalink.Node]:
+        return self.select(self._client.node_manager.get_region(endpoint))
+
+    async def rebalance(self) -> int:
+        moved = 0
+        for node in self.available_nodes:
+            if not self.is_overloaded(node):
+                continue
+            logger.warning("Node %s is overloaded (load %.2f, frame loss %.2f%%)",
+                           node.name, self.load(node), self.frame_loss(node) * 100)
+            # Moving playing players is what actually relieves the node
+            players = sorted((p for p in self._client.player_manager.players.values() if p.node is node),
+                             key=lambda p: not p.is_playing_a_track)
+            for player in players:
+                if moved >= self.MAX_MOVES:
+                    return moved
+                target = self.select(node.region, exclude=node)
+                if target is None or self.is_overloaded(target) or self.load(target) >= self.load(node):
+                    break
+                logger.info("Moving player %s from %s to %s", player.guild_id, node.name, target.name)
+                # noinspection PyBroadException
+                try:
+                    await player.change_node(target)
+                except Exception:
+                    logger.warning("Failed to move player %s", player.guild_id, exc_info=True)
+                    continue
+                moved += 1
+        return moved
+
+    def node_connected(self) -> None:
+        self._available.set()
+
+    def node_disconnected(self) -> None:
+        if not self.available_nodes:
+            self._available.clear()
+
+    async def wait_for_node(self, timeout: typing.Optional[float] = None) -> bool:
+        if self.available_nodes:
+            return True
+        self._available.clear()
+        try:
+            await asyncio.wait_for(self._available.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return bool(self.available_nodes)
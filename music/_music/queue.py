@@ -47,6 +47,7 @@ import discord
 
 from .audiotrack import LazyAudioTrack
 from .exceptions import EndOfQueue, QueueError
+from .metrics import metrics
 from .utils import *
 
 from core.models import getLogger
@@ -58,6 +59,16 @@ logger.spam = lambda *args, **kwargs: None
 
 
 class Queue:
+    # Lavalink sends a playerUpdate every 5 seconds while playing
+    POSITION_STALE_AFTER = 15
+    # How many playable tracks ahead of the cursor are kept loaded, read at preload time so config changes apply
+    # to existing players too
+    LOOKAHEAD = 5
+    # Loaded tracks further than this behind the cursor drop their Lavalink track data
+    EVICT_BEHIND = 50
+    # Shuffling yields to the loop after this many tracks
+    SHUFFLE_CHUNK = 2000
+
     def __init__(self, player):
         self.player = player
         self.cursor = 0
@@ -67,10 +78,15 @@ class Queue:
         self._current = None
         self._stopped = True
 
+        # Position is extrapolated from the last known position, _last_update is in time.monotonic() seconds
         self._last_update = 0
         self._last_position = 0
+        self._stale = False
         self.position_timestamp = 0
 
+        self._preload_task: typing.Optional[asyncio.Task] = None
+        self._preload_again = False
+
     @property
     def can_play_next(self):
         cursor = self.cursor + 1 if self.current and self.repeat != 'track' else self.cursor
@@ -79,6 +95,7 @@ class Queue:
         return True
 
     async def clear(self):
+        self.player.dirty = True
         self.cursor = 0
         self._queue.clear()
         if self.repeat == 'track':
@@ -86,6 +103,12 @@ class Queue:
         self._current = None
         await self.stop()
 
+    @property
+    def preloaded(self) -> int:
+        # How many of the upcoming tracks are ready to be played
+        start = self.cursor + 1 if self.current and self.repeat != 'track' else self.cursor
+        return sum(1 for track in self._queue[start:start + self.LOOKAHEAD] if track.loaded and track.success)
+
     @property
     def current(self) -> typing.Optional[LazyAudioTrack]:
         return self._current
@@ -103,12 +126,22 @@ class Queue:
         if self.player.paused:
             return min(self._last_position, self.current.duration)
 
-        difference = time.time() * 1000 - self._last_update  # should be less than 5
-        if difference > 15:
-            # TODO: do smt when it somehow disconnects
-            logger.debug("Something is wrong here...")
-        current_playing_time = self._last_position + difference
-        return min(current_playing_time, self.current.duration)
+        elapsed = time.monotonic() - self._last_update
+        if elapsed > self.POSITION_STALE_AFTER:
+            # Lavalink stopped sending updates, the track is most likely not progressing either.
+            # Lavalink v3 can't be asked for a player's state, so the position stays clamped until the
+            # next playerUpdate reseeds it, or change_node replays the track from here on another node.
+            if not self._stale:
+                self._stale = True
+                logger.debug("No player update for %.1fs for %s, node available: %s",
+                             elapsed, self.player.guild_id, self.player.node.available)
+            elapsed = self.POSITION_STALE_AFTER
+        return min(self._last_position + elapsed * 1000, self.current.duration)
+
+    def seed_position(self, position: float) -> None:
+        self._last_update = time.monotonic()
+        self._last_position = position
+        self._stale = False
 
     @property
     def remaining(self):
@@ -137,11 +170,11 @@ class Queue:
         if no_replace:
             options['noReplace'] = no_replace
 
+        self.player.dirty = True
         self._stopped = False
         self._current = track
-        self.position_timestamp = time.time()
-        self._last_update = self.position_timestamp * 1000
-        self._last_position = start_time
+        self.position_timestamp = int(time.time() * 1000)
+        self.seed_position(start_time)
 
         # noinspection PyProtectedMember
         if not self.player.node._manager.available_nodes:
@@ -156,19 +189,17 @@ class Queue:
                 except discord.HTTPException:
                     logger.debug("Failed to send cmd message")
             # wait at most 5 minutes
-            retry = 60 * 5 // 2
-            # noinspection PyProtectedMember
-            while retry > 0 and not self.player.node._manager.available_nodes:
-                await asyncio.sleep(2)
-                retry -= 1
+            await self.player.node_balancer.wait_for_node(timeout=60 * 5)
             # noinspection PyProtectedMember
             if not self.player.node._manager.available_nodes:
                 logger.warning("Failed to resume track at node disconnect")
                 raise EndOfQueue
 
         self.player.paused = False
-        # noinspection PyProtectedMember
-        await self.player.node._send(op='play', guildId=self.player.guild_id, track=track.track, **options)
+        # Lavalink doesn't acknowledge ops, sending the op is as close to a round trip as there is
+        with metrics.timer(f'lavalink.play_op.{self.player.node.name}'):
+            # noinspection PyProtectedMember
+            await self.player.node._send(op='play', guildId=self.player.guild_id, track=track.track, **options)
         event = lavalink.TrackStartEvent(self.player, track)
         # noinspection PyProtectedMember
         await asyncio.gather(
@@ -180,16 +211,28 @@ class Queue:
     def _reset_stats(self):
         self._last_update = 0
         self._last_position = 0
+        self._stale = False
         self.position_timestamp = 0
 
-    async def _load_next(self, load=5, *, start_from=None) -> int:
+    async def _load_next(self, load=None, *, start_from=None) -> int:
+        load = self.LOOKAHEAD if load is None else load
         cursor = start_from if start_from else \
             (self.cursor + 1 if self.current and self.repeat != 'track' else self.cursor)
         loaded = 0
+        checked = 0
+        # Positions in the lookahead, they may have wrapped around to the start of the queue
+        window = set()
 
-        while loaded < load and cursor < len(self._queue):
+        while loaded < load and checked < len(self._queue):
+            if cursor >= len(self._queue):
+                # The start of the queue is next when looping
+                if self.repeat != 'queue':
+                    break
+                cursor = 0
             track = self._queue[cursor]
+            window.add(cursor)
             cursor += 1
+            checked += 1
             try:
                 await track.load(self.player)
             except Exception as e:
@@ -198,17 +241,33 @@ class Queue:
             if track.success:
                 loaded += 1
 
-        for i in range(min(3, len(self._queue))):
-            if not self._queue[i].loaded:
-                try:
-                    await self._queue[i].load(self.player)
-                except Exception as e:
-                    logger.warning("Unknown error while loading music %s", e)
-                    continue
+        self._evict_behind(window)
         return loaded
 
+    def _evict_behind(self, keep: typing.Collection[int] = ()) -> None:
+        end = self.cursor - self.EVICT_BEHIND
+        for i in range(max(end, 0)):
+            if i not in keep:
+                self._queue[i].unload()
+
+    async def _preload(self) -> None:
+        try:
+            while True:
+                self._preload_again = False
+                await self._load_next()
+                # The cursor moved or tracks were queued while loading
+                if not self._preload_again:
+                    break
+        except Exception:
+            logger.warning("Failed to preload tracks for %s", self.player.guild_id, exc_info=True)
+        finally:
+            self._preload_task = None
+
     def load_next_few(self):
-        asyncio.create_task(self._load_next())
+        if self._preload_task is not None:
+            self._preload_again = True
+            return
+        self._preload_task = asyncio.create_task(self._preload())
 
     async def play_next(self, start_time: int = 0, end_time: int = 0,
                         no_replace: bool = False, force: bool = False) -> LazyAudioTrack:
@@ -245,6 +304,7 @@ class Queue:
                     except discord.HTTPException:
                         logger.debug("Command channel not found.")
                 logger.debug("removing track from queue %s", current)
+                self.player.dirty = True
                 try:
                     self._queue.remove(current)
                 except ValueError:
@@ -288,6 +348,7 @@ class Queue:
                     except discord.HTTPException:
                         logger.debug("Command channel not found.")
                 logger.debug("removing track from queue %s", current)
+                self.player.dirty = True
                 self._queue.remove(current)
             else:
                 playable = True
@@ -295,9 +356,15 @@ class Queue:
         return await self._play(start_time=start_time, end_time=end_time, no_replace=no_replace)
 
     def add(self, track: LazyAudioTrack) -> None:
+        self.player.dirty = True
         self._queue.append(track)
 
+    def extend(self, tracks: typing.Iterable[LazyAudioTrack]) -> None:
+        self.player.dirty = True
+        self._queue.extend(tracks)
+
     def remove(self, track: LazyAudioTrack) -> None:
+        self.player.dirty = True
         try:
             self._queue.remove(track)
         except ValueError:
@@ -305,6 +372,7 @@ class Queue:
 
     async def stop(self) -> None:
         if not self._stopped:
+            self.player.dirty = True
             self._reset_stats()
             self._stopped = True
             # noinspection PyBroadException
@@ -318,23 +386,53 @@ class Queue:
                 logger.warning("ws not available to send stop", exc_info=True)
 
     async def update_state(self, state: dict):
-        self._last_update = time.time() * 1000
-        self._last_position = state.get('position', 0)
+        if self._stale:
+            logger.debug("Player update resumed for %s", self.player.guild_id)
+        self.seed_position(state.get('position', 0))
         self.position_timestamp = state.get('time', 0)
 
         event = lavalink.events.PlayerUpdateEvent(self.player, self._last_position, self.position_timestamp)
         # noinspection PyProtectedMember
         await self.player.node._dispatch_event(event)
 
+    async def _shuffled(self, tracks: List[LazyAudioTrack]) -> List[LazyAudioTrack]:
+        tracks = list(tracks)
+        for i in range(len(tracks) - 1, 0, -1):
+            j = int(random.random() * (i + 1))
+            tracks[i], tracks[j] = tracks[j], tracks[i]
+            if i % self.SHUFFLE_CHUNK == 0:
+                await asyncio.sleep(0)
+        return tracks
+
     async def shuffle(self) -> None:
-        random.shuffle(self._queue)
-        self.cursor = 0
-        paused = self.player.paused
-        if self.repeat == 'track':
-            self.repeat = None
-        await self.play_current()
-        if paused:
-            await self.player.set_pause(True)
+        self.player.dirty = True
+        if not self.is_playing_a_track:
+            random.shuffle(self._queue)
+            self.cursor = 0
+            paused = self.player.paused
+            if self.repeat == 'track':
+                self.repeat = None
+            await self.play_current()
+            if paused:
+                await self.player.set_pause(True)
+            return
+
+        if self.repeat == 'queue':
+            # Everything else comes around again, the current track goes first and the rest follows
+            self._queue.insert(0, self._queue.pop(self.cursor))
+            self.cursor = 0
+        start = self.cursor + 1
+        upcoming = self._queue[start:]
+        shuffled = await self._shuffled(upcoming)
+        if self.cursor + 1 != start or self._queue[start:] != upcoming:
+            # The queue changed while shuffling, the new upcoming part is shuffled at once instead
+            start = self.cursor + 1
+            shuffled = self._queue[start:]
+            random.shuffle(shuffled)
+        self._queue[start:] = shuffled
+        self.player.dirty = True
+        # Loaded tracks stay loaded wherever they landed, only the new lookahead still needs loading
+        self.load_next_few()
 
     def _match_pos_from_name(self, name: str) -> typing.Optional[int]:
         old_song_or_pos = name.casefold()
@@ -366,6 +464,7 @@ class Queue:
         if pos == new_pos:
             return f"**{self._queue[pos].title}** is already at position **{pos + 1}**!"
 
+        self.player.dirty = True
         self._queue.insert(new_pos, self._queue.pop(pos))
         if self.cursor == pos:
             paused = self.player.paused
@@ -401,6 +500,7 @@ class Queue:
     async def remove_range(self, start: int, end: int) -> typing.Union[str, int]:
         if start < 0 or start >= end or end > len(self._queue):
             return "Invalid start / end range!"
+        self.player.dirty = True
         self._queue = self._queue[:start] + self._queue[end:]
         diff = max(min(self.cursor - start, end - start), 0)
         removed = start <= self.cursor < end
@@ -432,6 +532,7 @@ class Queue:
                        f'use the position number instead!'
         if pos < 0 or pos >= len(self._queue):
             return f"There's no track at position **{pos + 1}** in queue!"
+        self.player.dirty = True
         removed = self._queue.pop(pos)
         logger.debug("Removing track %s at %s cursor %s", removed, pos, self.cursor)
         if pos == self.cursor:
@@ -540,7 +641,6 @@ class Queue:
         self._queue = [LazyAudioTrack.load_dump(track) for track in data['tracks']]
         self._current = self._queue[self.cursor] if data['has_current'] else None
         self._stopped = data['_stopped']
-        self._last_position = data['position']
-        self.position_timestamp = time.time()
-        self._last_update = self.position_timestamp * 1000
+        self.position_timestamp = int(time.time() * 1000)
+        self.seed_position(data['position'])
         return self
@@ -0,0 +1,158 @@
+"""
+As substantial work has been placed—a few months of development—to make this fully featured music bot free for public use, please refrain from discrediting author or falsely claiming this open source work.
+
+BSD 3-Clause License
+
+Copyright (c) 2021, taku#3343 (Discord)
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without
+modification, are permitted provided that the following conditions are met:
+
+1. Redistributions of source code must retain the above copyright notice, this
+   list of conditions and the following disclaimer.
+
+2. Redistributions in binary form must reproduce the above copyright notice,
+   this list of conditions and the following disclaimer in the documentation
+   and/or other materials provided with the distribution.
+
+3. Neither the name of the copyright holder nor the names of its
+   contributors may be used to endorse or promote products derived from
+   this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+
+import asyncio
+import itertools
+import time
+import typing
+
+from core.models import getLogger
+
+from ._player import Player
+
+__all__ = ['RestoreScheduler']
+
+logger = getLogger(__name__)
+
+
+class RestoreScheduler:
+    """
+    Recreates saved players on a node with bounded concurrency.
+
+    Guilds are restored by priority: players that were playing to the most listeners first.
+    Guilds with no one left in the voice channel are skipped. Voice connections are spaced out
+    to stay under the gateway's voice state rate limit, and failed restores are retried with a backoff.
+    """
+    CONCURRENCY = 5
+    # The gateway allows 120 events per minute per shard, leave room for everything else
+    VOICE_STATES_PER_SECOND = 1
+    RETRIES = 2
+    TIMEOUT = 30
+
+    def __init__(self, bot, node):
+        self.bot = bot
+        self.node = node
+        self._queue = asyncio.PriorityQueue()
+        self._counter = itertools.count()
+        self._next_start = 0
+        self._start_lock = asyncio.Lock()
+        self._parsing = True
+
+        self.total = 0
+        self.restored = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def _priority(self, gid: int, data: dict) -> typing.Optional[typing.Tuple[int, int]]:
+        guild = self.bot.get_guild(gid)
+        if guild is None or not data.get('channel_id'):
+            return None
+        channel = guild.get_channel(int(data['channel_id']))
+        if channel is None:
+            return None
+        listeners = sum(1 for m in channel.members if not m.bot)
+        if not listeners:
+            return None
+        queue = data.get('queue', {})
+        playing = queue.get('has_current') and not queue.get('_stopped')
+        return 0 if playing and not data.get('paused') else 1, -listeners
+
+    def add(self, gid: int, data: dict) -> None:
+        self.total += 1
+        priority = self._priority(gid, data)
+        if priority is None:
+            logger.debug("Skipping restore of idle player %s", gid)
+            self.skipped += 1
+            return
+        self._queue.put_nowait((priority, next(self._counter), gid, data, 0))
+
+    def done_adding(self) -> None:
+        self._parsing = False
+
+    @property
+    def progress(self) -> str:
+        return f"{self.restored + self.skipped + self.failed}/{self.total} guilds processed " \
+               f"({self.restored} restored, {self.skipped} skipped, {self.failed} failed)"
+
+    async def _wait_turn(self) -> None:
+        async with self._start_lock:
+            now = time.monotonic()
+            if self._next_start > now:
+                await asyncio.sleep(self._next_start - now)
+            self._next_start = max(now, self._next_start) + 1 / self.VOICE_STATES_PER_SECOND
+
+    async def _restore(self, gid: int, data: dict, attempt: int) -> None:
+        await self._wait_turn()
+        logger.info("Recreating player for %s", gid)
+        # noinspection PyBroadException
+        try:
+            await asyncio.wait_for(Player.load_dump(self.bot, gid, self.node, data), self.TIMEOUT)
+        except Exception:
+            if attempt < self.RETRIES and self.node.available:
+                logger.warning("Failed to reconnect %s, retrying", gid, exc_info=True)
+                await asyncio.sleep(2 ** attempt)
+                self._queue.put_nowait(((2, attempt), next(self._counter), gid, data, attempt + 1))
+                return
+            logger.warning("Failed to reconnect %s", gid, exc_info=True)
+            self.failed += 1
+        else:
+            self.restored += 1
+        if (self.restored + self.failed) % 25 == 0:
+            logger.info("Restoring players on %s: %s", self.node.name, self.progress)
+
+    async def _worker(self) -> None:
+        while self._parsing or not self._queue.empty():
+            try:
+                _, _, gid, data, attempt = await asyncio.wait_for(self._queue.get(), 1)
+            except asyncio.TimeoutError:
+                continue
+            try:
+                await self._restore(gid, data, attempt)
+            finally:
+                self._queue.task_done()
+
+    async def run(self, guilds: typing.Iterable[typing.Tuple[int, dict]]) -> None:
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.CONCURRENCY)]
+        try:
+            # Workers start restoring while the rest of the save is still being parsed
+            for gid, data in guilds:
+                self.add(gid, data)
+                await asyncio.sleep(0)
+            self.done_adding()
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+        logger.info("Finished restoring players on %s: %s", self.node.name, self.progress)
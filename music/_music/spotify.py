@@ -47,8 +47,8 @@ class Spotify:
     OAUTH_TOKEN_URL = 'https://accounts.spotify.com/api/token'
     API_BASE = 'https://api.spotify.com/v1/'
 
-    def __init__(self, bot, client_id, client_secret):
-        self.bot = bot
+    def __init__(self, http, client_id, client_secret):
+        self.http = http
         self.client_id = client_id
         self.client_secret = client_secret
         self.token = None
@@ -72,16 +72,16 @@ class Spotify:
         return await self.make_get(url, headers={'Authorization': 'Bearer {0}'.format(token)})
 
     async def make_get(self, url, headers=None):
-        async with self.bot.session.get(url, headers=headers) as r:
-            if r.status != 200:
-                raise SpotifyError('Failed to make GET request to {0}: [{1.status}] {2}'.format(url, r, await r.json()))
-            return await r.json()
+        status, data = await self.http.request('spotify', 'GET', url, headers=headers)
+        if status != 200:
+            raise SpotifyError('Failed to make GET request to {0}: [{1}] {2}'.format(url, status, data))
+        return data
 
     async def make_post(self, url, payload, headers=None):
-        async with self.bot.session.post(url, data=payload, headers=headers) as r:
-            if r.status != 200:
-                raise SpotifyError('Failed to make POST request to {0}: [{1.status}] {2}'.format(url, r, await r.json()))
-            return await r.json()
+        status, data = await self.http.request('spotify', 'POST', url, data=payload, headers=headers)
+        if status != 200:
+            raise SpotifyError('Failed to make POST request to {0}: [{1}] {2}'.format(url, status, data))
+        return data
 
     async def get_token(self):
         if self.token and not await self.check_token(self.token):
@@ -45,7 +45,7 @@ import discord
 from discord.ext import commands
 
 
-__all__ = ['cache', 'trim', 'seconds_to_time_string', 'plural', 'Str',
+__all__ = ['cache', 'trim', 'seconds_to_time_string', 'plural', 'Str', 'TrackPages',
            'PaginatorSession', 'WrappedPaginator', 'EmbedPaginatorSession']
 
 
@@ -72,6 +72,7 @@ def _true_repr(o):
 def cache(maxsize=2048, ignore_kwargs=False, *, expires_after=None):
     def decorator(func):
         _internal_cache = LRUCache(maxsize)
+        stats = {'hits': 0, 'misses': 0}
 
         def _make_key(args, kwargs):
             key = [f'{func.__module__}.{func.__name__}']
@@ -95,10 +96,12 @@ def cache(maxsize=2048, ignore_kwargs=False, *, expires_after=None):
                     except KeyError:
                         pass
                 else:
+                    stats['hits'] += 1
                     if asyncio.iscoroutinefunction(func):
                         return _wrap_new_coroutine(value)
                     return value
 
+            stats['misses'] += 1
             value = func(*args, **kwargs)
 
             if inspect.isawaitable(value):
@@ -106,6 +109,8 @@ def cache(maxsize=2048, ignore_kwargs=False, *, expires_after=None):
 
             _internal_cache[key] = (value, time.time())
             return value
+
+        wrapper.cache_info = lambda: dict(stats, size=len(_internal_cache), maxsize=maxsize)
         return wrapper
     return decorator
 
@@ -199,6 +204,70 @@ class Str(commands.Converter):
         return argument
 
 
+class TrackPages(typing.Sequence[str]):
+    """
+    Pages of a track list, each page is only rendered when it's shown.
+    """
+    prefix = "```nim\n"
+    suffix = "\n```"
+    track_per_page = 10
+
+    def __init__(self, tracks, *, empty="No tracks found...", footer=""):
+        self.tracks = tracks
+        self.empty = empty
+        self.footer = footer
+        self._rendered = {}
+
+    def __len__(self):
+        return max((len(self.tracks) + self.track_per_page - 1) // self.track_per_page, 1)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("page index out of range")
+        if index not in self._rendered:
+            self._rendered[index] = self._render_page(index)
+        return self._rendered[index]
+
+    def _render_page(self, index):
+        if not self.tracks:
+            return f"{self.prefix}{self.empty}{self.suffix}{self.footer}"
+
+        total_tracks = len(self.tracks)
+        start = index * self.track_per_page
+        block = self.tracks[start:start + self.track_per_page]
+
+        count_length = 1
+        if total_tracks >= 10:
+            count_length += 1
+        if total_tracks >= 100 and start >= 90:
+            count_length += 1
+
+        block_max_title_length = max(30, max(len(track.title) for track in block))
+        title_length = min(39 - count_length, block_max_title_length)
+
+        # TODO: Pad duration too
+        message = ""
+        for i, track in enumerate(block, start=start + 1):
+            title = trim(track.title if track.success else f"[failed] {track.title}",
+                         title_length).ljust(title_length)
+
+            if hasattr(track, 'duration'):
+                duration = seconds_to_time_string(track.duration / 1000, int_seconds=True, format=2)
+            else:
+                duration = "  ???"
+            message += f"{i: >{count_length}}) {title} {duration}\n"
+
+        remaining_tracks = total_tracks - start - len(block)
+        if remaining_tracks > 0:
+            message += f"\n{' ' * count_length}{remaining_tracks} more " \
+                       f"{plural(remaining_tracks, show_count=False):track}"
+        return self.prefix + message.replace('```', '``\u200b`').replace('@', '@\u200b') + self.suffix + self.footer
+
+
 class PaginatorSession:
     def __init__(self, ctx: commands.Context, *pages, **options):
         self.ctx = ctx
@@ -209,7 +278,8 @@ class PaginatorSession:
 
         self.base: typing.Optional[discord.Message] = None
         self.current = 0
-        self.pages = list(pages)
+        # A lazy sequence of pages can be passed instead, pages are then only built when shown
+        self.pages = options["pages"] if "pages" in options else list(pages)
         self.destination = options.get("destination", ctx)
         self.reaction_map = {
             "⏮": self.first_page,
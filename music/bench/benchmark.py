@@ -0,0 +1,228 @@
+# As substantial work has been placed—a few months of development—to make this fully featured music bot free for public use, please refrain from discrediting author or falsely claiming this open source work.
+#
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, taku#3343 (Discord)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+End to end throughput benchmark of the music Player and Queue against a local fake Lavalink node.
+
+Each simulated guild queues a playlist, then skips, seeks and shuffles at random while tracks play on the fake
+node's sped up clock. Command latency and event loop lag are reported, with a label to compare releases::
+
+    PYTHONPATH=/path/to/modmail python -m music.bench.benchmark --guilds 200 --label v1.2 --json bench.json
+
+Nothing here is loaded by the plugin.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import typing
+
+import lavalink
+
+from music._music import HTTPClient, LazyAudioTrack, NodeBalancer, Player, metrics
+from music.bench.fake_lavalink import FakeLavalink
+
+BENCH_USER_ID = 1
+ACTIONS = ('skip', 'seek', 'shuffle')
+
+
+async def sample_loop_lag(interval: float = 0.1) -> None:
+    while True:
+        # Anything blocking the loop delays this wake up
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        metrics.observe('loop.lag', max((time.perf_counter() - start - interval) * 1000, 0))
+
+
+async def wait_for_node(client: lavalink.Client, timeout: float = 10) -> lavalink.Node:
+    deadline = time.monotonic() + timeout
+    while not client.node_manager.available_nodes:
+        if time.monotonic() > deadline:
+            raise RuntimeError('The fake Lavalink node did not connect')
+        await asyncio.sleep(0.05)
+    return client.node_manager.available_nodes[0]
+
+
+def make_playlist(player: Player, size: int, tag: str) -> typing.List[LazyAudioTrack]:
+    return [LazyAudioTrack(f'ytsearch:bench {tag} {player.guild_id} {i}', f'bench {player.guild_id} {i}',
+                           BENCH_USER_ID)
+            for i in range(size)]
+
+
+async def simulate_guild(player: Player, rng: random.Random, playlist: int, actions: int) -> None:
+    tracks = make_playlist(player, playlist, 'mixed')
+    with metrics.timer('bench.enqueue'):
+        await player.enqueue_many(tracks)
+
+    for _ in range(actions):
+        await asyncio.sleep(rng.uniform(0.2, 1.0))
+        action = rng.choice(ACTIONS)
+        with metrics.timer(f'bench.{action}'):
+            if action == 'skip':
+                await player.play_next()
+            elif action == 'seek':
+                if player.current is not None and player.current.duration:
+                    await player.seek(rng.randrange(player.current.duration))
+            else:
+                await player.shuffle()
+
+
+async def enqueue_per_track(player: Player, playlist: int) -> None:
+    # How play queued playlists before enqueue_many
+    tracks = make_playlist(player, playlist, 'per track')
+    with metrics.timer('bench.enqueue.play_later'):
+        for track in tracks:
+            await player.play_later(track=track, send_queue_message=False)
+
+
+async def enqueue_bulk(player: Player, playlist: int) -> None:
+    tracks = make_playlist(player, playlist, 'bulk')
+    with metrics.timer('bench.enqueue.enqueue_many'):
+        await player.enqueue_many(tracks)
+
+
+async def compare_enqueue(players: typing.List[Player], playlist: int) -> typing.Dict[str, float]:
+    # Same guilds, one way after the other, so both start from an empty queue
+    elapsed = {}
+    for name, enqueue in (('play_later', enqueue_per_track), ('enqueue_many', enqueue_bulk)):
+        start = time.perf_counter()
+        await asyncio.gather(*(enqueue(p, playlist) for p in players))
+        elapsed[name] = time.perf_counter() - start
+        for player in players:
+            await player.queue.clear()
+    return elapsed
+
+
+async def run(args) -> dict:
+    server = FakeLavalink(port=args.port, latency=(args.min_latency, args.max_latency),
+                          failure_rate=args.failure_rate, speed=args.speed, update_interval=1, stats_interval=5)
+    await server.start()
+
+    http = HTTPClient()
+    client = lavalink.Client(BENCH_USER_ID, player=Player)
+    # Same setup as the plugin
+    # noinspection PyProtectedMember
+    await client._session.close()
+    client._session = http.session('lavalink')
+    client.node_balancer = NodeBalancer(client)
+    client.add_node(server.host, server.port, server.password, 'us', name='fake')
+    lag = asyncio.ensure_future(sample_loop_lag())
+    try:
+        node = await wait_for_node(client)
+        metrics.reset()
+        rng = random.Random(args.seed)
+        players = []
+        for guild_id in range(1, args.guilds + 1):
+            player = client.player_manager.create(guild_id, node=node)
+            # Not actually in a voice channel, the fake node doesn't care
+            player.channel_id = '1'
+            players.append(player)
+
+        enqueue_elapsed = {}
+        start = time.perf_counter()
+        if args.mode == 'enqueue':
+            enqueue_elapsed = await compare_enqueue(players, args.playlist)
+        else:
+            await asyncio.gather(*(simulate_guild(p, random.Random(rng.random()), args.playlist, args.actions)
+                                   for p in players))
+        elapsed = time.perf_counter() - start
+
+        for player in players:
+            player.cancel_tasks()
+            await player.queue.stop()
+    finally:
+        lag.cancel()
+        await server.close()
+        await http.close()
+
+    dump = metrics.dump()
+    commands = sum(h['count'] for name, h in dump['histograms'].items() if name.startswith('bench.'))
+    return dict(
+        label=args.label,
+        mode=args.mode,
+        guilds=args.guilds,
+        playlist=args.playlist,
+        enqueue_elapsed_s=enqueue_elapsed,
+        elapsed_s=elapsed,
+        commands_per_s=commands / elapsed if elapsed else 0.0,
+        loadtracks_requests=server.requests,
+        loadtracks_failures=server.failures,
+        ops=server.ops,
+        histograms=dump['histograms'],
+        counters=dump['counters'],
+    )
+
+
+def print_report(report: dict) -> None:
+    print(f"{report['label']}: {report['guilds']} guilds in {report['elapsed_s']:.1f}s, "
+          f"{report['commands_per_s']:.1f} commands/s, "
+          f"{report['loadtracks_requests']} loadtracks ({report['loadtracks_failures']} failed)")
+    print(f"{'':32} {'count':>7} {'avg':>9} {'p50':>9} {'p95':>9} {'max':>9}")
+    for name, h in report['histograms'].items():
+        if name.startswith(('bench.', 'loop.', 'lavalink.', 'play.')):
+            print(f"{name:32} {h['count']:>7} {h['avg_ms']:>7.1f}ms {h['p50_ms']:>7.1f}ms "
+                  f"{h['p95_ms']:>7.1f}ms {h['max_ms']:>7.1f}ms")
+    if report['enqueue_elapsed_s']:
+        per_track = report['enqueue_elapsed_s']['play_later']
+        bulk = report['enqueue_elapsed_s']['enqueue_many']
+        print(f"Queueing {report['playlist']} tracks in {report['guilds']} guilds: {per_track * 1000:.1f}ms with play_later per "
+              f"track, {bulk * 1000:.1f}ms with enqueue_many ({per_track / bulk if bulk else 0:.1f}x)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mode', choices=('mixed', 'enqueue'), default='mixed',
+                        help='skips, seeks and shuffles, or queueing playlists per track against enqueue_many')
+    parser.add_argument('--guilds', type=int, default=50)
+    parser.add_argument('--playlist', type=int, default=100, help='tracks queued by each guild')
+    parser.add_argument('--actions', type=int, default=20, help='skips, seeks and shuffles by each guild')
+    parser.add_argument('--port', type=int, default=23330)
+    parser.add_argument('--min-latency', type=float, default=0.02, help='loadtracks latency in seconds')
+    parser.add_argument('--max-latency', type=float, default=0.2, help='loadtracks latency in seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.01, help='share of failed loadtracks')
+    parser.add_argument('--speed', type=float, default=60.0, help='track milliseconds per real millisecond')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--label', default='dev', help='release the run is for')
+    parser.add_argument('--json', help='also write the report to this file')
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
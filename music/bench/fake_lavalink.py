@@ -0,0 +1,307 @@
+# As substantial work has been placed—a few months of development—to make this fully featured music bot free for public use, please refrain from discrediting author or falsely claiming this open source work.
+#
+# BSD 3-Clause License
+#
+# Copyright (c) 2021, taku#3343 (Discord)
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice, this
+#    list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+#    this list of conditions and the following disclaimer in the documentation
+#    and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its
+#    contributors may be used to endorse or promote products derived from
+#    this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+"""
+A local stand-in for a Lavalink v3 node, for load testing the music plugin without a real one.
+
+It serves ``/loadtracks`` with configurable latency and failures, and speaks enough of the websocket protocol
+to play tracks: ``play``, ``stop``, ``pause``, ``seek`` and ``destroy`` ops are answered with ``playerUpdate``,
+``TrackEndEvent`` and periodic ``stats``, on a clock that can be sped up so tracks end in seconds.
+
+Run it on its own with ``python -m music.bench.fake_lavalink --port 2333``.
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import random
+import struct
+import time
+import typing
+
+from aiohttp import web, WSMsgType
+
+__all__ = ['FakeLavalink', 'encode_track']
+
+
+def _utf(s: str) -> bytes:
+    data = s.encode()
+    return struct.pack('>H', len(data)) + data
+
+
+def encode_track(title: str, author: str, length: int, identifier: str, uri: str, source: str = 'youtube') -> str:
+    """
+    Encodes a track the way Lavalink does (message version 2), so lavalink.py can decode it.
+    """
+    body = struct.pack('B', 2) + _utf(title) + _utf(author) + struct.pack('>Q', length) + _utf(identifier) + \
+        struct.pack('B', 0) + struct.pack('B', 1) + _utf(uri) + _utf(source) + struct.pack('>Q', 0)
+    return base64.b64encode(struct.pack('>i', len(body) | (1 << 30)) + body).decode()
+
+
+class FakePlayer:
+    def __init__(self, guild_id: str):
+        self.guild_id = guild_id
+        self.track: typing.Optional[str] = None
+        self.length = 0
+        self.paused = False
+        # Position at started_at, in track milliseconds
+        self.offset = 0
+        self.started_at = 0.0
+        self.end_handle: typing.Optional[asyncio.TimerHandle] = None
+
+
+class FakeLavalink:
+    """
+    One fake node. ``speed`` is how many track milliseconds pass per real millisecond.
+    """
+
+    def __init__(self, *, host: str = '127.0.0.1', port: int = 2333, password: str = 'youshallnotpass',
+                 latency: typing.Tuple[float, float] = (0.02, 0.2), failure_rate: float = 0.0,
+                 track_length: int = 180000, speed: float = 60.0, update_interval: float = 5.0,
+                 stats_interval: float = 60.0):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.track_length = track_length
+        self.speed = speed
+        self.update_interval = update_interval
+        self.stats_interval = stats_interval
+
+        self.players: typing.Dict[str, FakePlayer] = {}
+        self.sockets: typing.Set[web.WebSocketResponse] = set()
+        self.requests = 0
+        self.failures = 0
+        self.ops: typing.Dict[str, int] = {}
+        self._started = time.monotonic()
+        self._runner: typing.Optional[web.AppRunner] = None
+        self._tasks: typing.List[asyncio.Task] = []
+
+        self.app = web.Application()
+        self.app.router.add_get('/', self.websocket)
+        self.app.router.add_get('/loadtracks', self.loadtracks)
+
+    def _authorized(self, request: web.Request) -> bool:
+        return request.headers.get('Authorization') == self.password
+
+    async def loadtracks(self, request: web.Request) -> web.Response:
+        if not self._authorized(request):
+            return web.Response(status=401)
+        self.requests += 1
+        await asyncio.sleep(random.uniform(*self.latency))
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            return web.json_response({
+                'loadType': 'LOAD_FAILED', 'playlistInfo': {}, 'tracks': [],
+                'exception': {'message': 'Simulated failure', 'severity': 'COMMON'}
+            })
+
+        identifier = request.query.get('identifier', '')
+        query = identifier.split(':', 1)[-1]
+        count = 5 if identifier.startswith(('ytsearch:', 'scsearch:')) else 1
+        tracks = []
+        for i in range(count):
+            ident = f'{abs(hash((query, i))) % 10 ** 11:011d}'
+            info = {
+                'identifier': ident,
+                'isSeekable': True,
+                'author': 'Fake Lavalink',
+                'length': self.track_length,
+                'isStream': False,
+                'position': 0,
+                'title': f'{query} #{i + 1}' if count > 1 else query,
+                'uri': f'https://www.youtube.com/watch?v={ident}',
+            }
+            tracks.append({'track': encode_track(info['title'], info['author'], info['length'],
+                                                 ident, info['uri']), 'info': info})
+        load_type = 'SEARCH_RESULT' if count > 1 else 'TRACK_LOADED'
+        return web.json_response({'loadType': load_type, 'playlistInfo': {}, 'tracks': tracks})
+
+    def _position(self, player: FakePlayer) -> int:
+        if player.track is None:
+            return 0
+        if player.paused:
+            return player.offset
+        elapsed = (time.monotonic() - player.started_at) * 1000 * self.speed
+        return min(int(player.offset + elapsed), player.length)
+
+    async def _broadcast(self, **payload) -> None:
+        data = json.dumps(payload)
+        for ws in list(self.sockets):
+            if not ws.closed:
+                await ws.send_str(data)
+
+    def _schedule_end(self, player: FakePlayer) -> None:
+        if player.end_handle is not None:
+            player.end_handle.cancel()
+            player.end_handle = None
+        if player.track is None or player.paused:
+            return
+        remaining = (player.length - self._position(player)) / 1000 / self.speed
+        player.end_handle = asyncio.get_event_loop().call_later(
+            max(remaining, 0), lambda: asyncio.ensure_future(self._end(player, 'FINISHED')))
+
+    async def _end(self, player: FakePlayer, reason: str) -> None:
+        track = player.track
+        if track is None:
+            return
+        player.track = None
+        if player.end_handle is not None:
+            player.end_handle.cancel()
+            player.end_handle = None
+        await self._broadcast(op='event', type='TrackEndEvent', guildId=player.guild_id, track=track, reason=reason)
+
+    async def _handle_op(self, data: dict) -> None:
+        op = data.get('op')
+        self.ops[op] = self.ops.get(op, 0) + 1
+        guild_id = data.get('guildId')
+        if guild_id is None:
+            return
+        player = self.players.get(guild_id)
+        if player is None:
+            player = self.players[guild_id] = FakePlayer(guild_id)
+
+        if op == 'play':
+            if player.track is not None:
+                if data.get('noReplace'):
+                    return
+                await self._end(player, 'REPLACED')
+            player.track = data['track']
+            player.length = int(data.get('endTime') or self.track_length)
+            player.offset = int(data.get('startTime') or 0)
+            player.started_at = time.monotonic()
+            player.paused = bool(data.get('pause', False))
+            self._schedule_end(player)
+        elif op == 'stop':
+            await self._end(player, 'STOPPED')
+        elif op == 'pause':
+            player.offset = self._position(player)
+            player.started_at = time.monotonic()
+            player.paused = bool(data.get('pause'))
+            self._schedule_end(player)
+        elif op == 'seek':
+            player.offset = int(data.get('position', 0))
+            player.started_at = time.monotonic()
+            self._schedule_end(player)
+        elif op == 'destroy':
+            await self._end(player, 'CLEANUP')
+            self.players.pop(guild_id, None)
+
+    async def websocket(self, request: web.Request) -> web.StreamResponse:
+        if not self._authorized(request):
+            return web.Response(status=401)
+        ws = web.WebSocketResponse(heartbeat=60)
+        await ws.prepare(request)
+        self.sockets.add(ws)
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.TEXT:
+                    await self._handle_op(json.loads(msg.data))
+                elif msg.type == WSMsgType.ERROR:
+                    break
+        finally:
+            self.sockets.discard(ws)
+        return ws
+
+    def stats(self) -> dict:
+        playing = sum(1 for p in self.players.values() if p.track is not None and not p.paused)
+        return {
+            'op': 'stats',
+            'players': len(self.players),
+            'playingPlayers': playing,
+            'uptime': int((time.monotonic() - self._started) * 1000),
+            'memory': {'free': 0, 'used': 0, 'allocated': 0, 'reservable': 0},
+            'cpu': {'cores': 4, 'systemLoad': min(0.05 + playing * 0.002, 1.0), 'lavalinkLoad': 0.05},
+            # Averages per playing player over the last minute, like Lavalink
+            'frameStats': {'sent': 3000, 'nulled': 0, 'deficit': 0},
+        }
+
+    async def _send_updates(self) -> None:
+        while True:
+            await asyncio.sleep(self.update_interval)
+            now = int(time.time() * 1000)
+            for player in list(self.players.values()):
+                if player.track is not None:
+                    await self._broadcast(op='playerUpdate', guildId=player.guild_id,
+                                          state={'time': now, 'position': self._position(player)})
+
+    async def _send_stats(self) -> None:
+        while True:
+            await self._broadcast(**self.stats())
+            await asyncio.sleep(self.stats_interval)
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        self._tasks = [asyncio.ensure_future(self._send_updates()), asyncio.ensure_future(self._send_stats())]
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        for player in self.players.values():
+            if player.end_handle is not None:
+                player.end_handle.cancel()
+        for ws in list(self.sockets):
+            await ws.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+async def _serve(args) -> None:
+    server = FakeLavalink(host=args.host, port=args.port, password=args.password,
+                          latency=(args.min_latency, args.max_latency), failure_rate=args.failure_rate,
+                          speed=args.speed)
+    await server.start()
+    print(f'Fake Lavalink listening on {args.host}:{args.port}')
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2333)
+    parser.add_argument('--password', default='youshallnotpass')
+    parser.add_argument('--min-latency', type=float, default=0.02, help='seconds')
+    parser.add_argument('--max-latency', type=float, default=0.2, help='seconds')
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--speed', type=float, default=60.0, help='track milliseconds per real millisecond')
+    asyncio.run(_serve(parser.parse_args()))
+
+
+if __name__ == '__main__':
+    main()
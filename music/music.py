@@ -36,6 +36,7 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import asyncio
 import base64
+import io
 import json
 import os
 import time
@@ -43,9 +44,9 @@ import typing
 import urllib.parse
 import zlib
 from base64 import b64decode
-from collections import defaultdict
 
 import lavalink
+from cachetools import TTLCache
 
 import discord
 from discord import AllowedMentions
@@ -70,37 +71,44 @@ class Music(commands.Cog, name="music"):
         self._spotify: typing.Optional[Spotify] = None
         self.db = bot.api.get_plugin_partition(self)
         self._lyrics_api: typing.Optional[Lyrics] = None
+        # (guild_id, user_id) -> tracks from the user's last search
+        self._search_sessions = TTLCache(maxsize=1000, ttl=600)
 
         if not hasattr(self.bot, 'lavalink'):  # This ensures the client isn't overwritten during cog reloads.
             BOT_ID = int(b64decode(self.bot.token.split(".")[0]).decode())
             self.bot.lavalink = lavalink.Client(BOT_ID, player=Player)
+            # Nodes keep the session they were added with, so the HTTP client lives as long as the lavalink client
+            self.bot.lavalink_http = HTTPClient()
             self.bot.lavalink_saved_states = {}
             for save_file in os.listdir(MUSIC_STATE_PATH):
                 save_file = os.path.join(MUSIC_STATE_PATH, save_file)
-                if not save_file.endswith('.json'):
+                if save_file.endswith('.tmp'):
+                    # Interrupted checkpoint
+                    os.unlink(save_file)
+                    continue
+                if not save_file.endswith(('.json', StateCheckpointer.EXTENSION)):
                     continue
                 # noinspection PyBroadException
                 try:
-                    with open(save_file, 'r') as f:
-                        save = json.load(f)
-                    if time.time() - save['timestamp'] > 1800:
+                    save = StateCheckpointer.read_header(save_file)
+                    if not save or time.time() - save['timestamp'] > 1800:
                         logger.error("Save file timestamp older than 30 minutes, ignoring")
                         os.unlink(save_file)
                         continue
-                    save_state = self.bot.lavalink_saved_states[save['node_name']] = {}
-
-                    for gid, data in save['guilds'].items():
-                        save_state[int(gid)] = data
+                    # Guilds are only parsed when the node connects
+                    self.bot.lavalink_saved_states[save['node_name']] = dict(save, path=save_file)
                 except Exception:
                     logger.warning("Failed to load save state %s", save_file, exc_info=True)
                     os.unlink(save_file)
             self.bot.add_listener(self.bot.lavalink.voice_update_handler, 'on_socket_response')
-        else:
-            import aiohttp
-            if self.bot.lavalink._session.closed:
-                self.bot.lavalink._session = aiohttp.ClientSession(
-                    timeout=aiohttp.ClientTimeout(total=30)
-                )
+            # The client comes with its own session, REST calls should go through the shared connector instead
+            # noinspection PyProtectedMember
+            self.bot.loop.create_task(self.bot.lavalink._session.close())
+        self.http: HTTPClient = self.bot.lavalink_http
+        # Same session as before a reload, unless it was closed
+        self.bot.lavalink._session = self.http.session('lavalink')
+        self.bot.lavalink.node_balancer = NodeBalancer(self.bot.lavalink)
+        self.checkpointer = StateCheckpointer(self.bot, MUSIC_STATE_PATH)
         # noinspection PyTypeChecker
         lavalink.add_event_hook(self.track_hook)
         self.bot.loop.create_task(self.cog_load())
@@ -109,6 +117,9 @@ class Music(commands.Cog, name="music"):
     def lyrics_api(self) -> typing.Optional[Lyrics]:
         return self._lyrics_api
 
+    def _make_lyrics_api(self, GENIUS_TOKEN) -> Lyrics:
+        return Lyrics(GENIUS_TOKEN, self.http, cache_path=os.path.join(MUSIC_STATE_PATH, "lyrics.sqlite3"))
+
     @property
     def spotify(self) -> typing.Optional[Spotify]:
         if not self._spotify or not self._spotify.token:
@@ -122,7 +133,7 @@ class Music(commands.Cog, name="music"):
             SPOTIFY_CLIENT_SECRET = config.get('spotify_client_secret')
             if SPOTIFY_CLIENT_ID and SPOTIFY_CLIENT_SECRET:
                 try:
-                    self._spotify = Spotify(self.bot, SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET)
+                    self._spotify = Spotify(self.http, SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET)
                     await self._spotify.get_token()
                 except SpotifyError as e:
                     self._spotify = None
@@ -134,16 +145,14 @@ class Music(commands.Cog, name="music"):
                                   'spotify_client_secret': None}},
                         upsert=True
                     )
+            PRELOAD_LOOKAHEAD = config.get('preload_lookahead')
+            if isinstance(PRELOAD_LOOKAHEAD, int) and PRELOAD_LOOKAHEAD > 0:
+                Queue.LOOKAHEAD = PRELOAD_LOOKAHEAD
+
             GENIUS_TOKEN = config.get("genius_token")
             if GENIUS_TOKEN:
-                self._lyrics_api = Lyrics(GENIUS_TOKEN)
-                if not await self._lyrics_api.test_token():
-                    await self.db.find_one_and_update(
-                        {'_id': 'music-config'},
-                        {'$set': {'genius_token': None}},
-                        upsert=True
-                    )
-                    self._lyrics_api = None
+                # The token was checked when it was configured
+                self._lyrics_api = self._make_lyrics_api(GENIUS_TOKEN)
 
             LAVALINK_URI = config.get('lavalink')
             if LAVALINK_URI:
@@ -189,56 +198,77 @@ class Music(commands.Cog, name="music"):
                         )
 
         await self.bot.wait_until_ready()
-        self.auto_disconnect.start()
+        # Players may have been left over from before a reload, disconnecting is event driven afterwards
+        for player in self.bot.lavalink.player_manager.players.values():
+            self.check_idle(player)
+        self.rebalance_nodes.start()
+        self.checkpoint_states.start()
 
     def cleanup(self):
         logger.debug("Saving music states...")
+        # noinspection PyBroadException
+        try:
+            self.checkpointer.flush()
+        except Exception:
+            logger.error("Failed to save music states", exc_info=True)
+        # Only the lavalink session is kept open, the lavalink client and its nodes outlive the cog
+        self.bot.loop.create_task(self.http.close_sessions(keep=('lavalink',)))
 
-        saves = defaultdict(dict)
-
-        for gid, player in self.bot.lavalink.player_manager.players.items():
-            player: Player
-            if not player.is_connected:
-                logger.info("Skipped saving %s", player)
-                continue
-            data = player.dump()
-            saves[data['node_name']].setdefault('guilds', {})
-            saves[data['node_name']]['guilds'][gid] = data
-        for node_name, save in saves.items():
-            save['timestamp'] = time.time()
-            save['node_name'] = node_name
-            logger.info("Saving lavalink save file for %s", node_name)
-            with open(os.path.join(MUSIC_STATE_PATH, f"{node_name}.json"), 'w') as f:
-                json.dump(save, f, indent=4, sort_keys=True)
+    def check_idle(self, player: Player) -> None:
+        if not player.is_connected:
+            return
+        vc = self.bot.get_channel(int(player.channel_id))
+        if not player.is_playing_a_track or (vc and not any(not m.bot for m in vc.members)):
+            logger.debug('Auto disconnecting from %s', player.guild_id)
+            player.disconnect_soon(self.bot)
+        else:
+            player.cancel_tasks()
 
-        try:
-            logger.info("Closing lavalink session.")
-            # noinspection PyProtectedMember
-            self.bot.loop.run_until_complete(self.bot.lavalink._session.close())
-        except asyncio.CancelledError:
-            pass
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        if before.channel == after.channel:
+            return
+        if member.bot and member.id != self.bot.user.id:
+            return
+        player: typing.Optional[Player] = self.bot.lavalink.player_manager.get(member.guild.id)
+        if player is None or not player.is_connected:
+            return
+        # Only the channel I'm in matters, unless I'm the one moving
+        if member.id != self.bot.user.id and int(player.channel_id) not in {getattr(before.channel, 'id', None),
+                                                                             getattr(after.channel, 'id', None)}:
+            return
+        self.check_idle(player)
 
-    @tasks.loop(seconds=20, reconnect=False)
-    async def auto_disconnect(self):
-        for player in self.bot.lavalink.player_manager.players.values():
-            player: Player
-            if player.is_connected:
-                vc = self.bot.get_channel(int(player.channel_id))
-                if not player.is_playing_a_track or (vc and not any(not m.bot for m in vc.members)):
-                    logger.debug('Auto disconnecting from %s', player.guild_id)
-                    player.disconnect_soon(self.bot)
-            elif player.queue.position_timestamp - time.time() > 30:
-                logger.warning("Idle player, destroy? %s", player)
+    @tasks.loop(seconds=60, reconnect=False)
+    async def rebalance_nodes(self):
+        # Lavalink sends stats every minute, no point checking more often
+        if len(self.bot.lavalink.node_manager.available_nodes) < 2:
+            return
+        moved = await self.bot.lavalink.node_balancer.rebalance()
+        if moved:
+            logger.info("Moved %s players off overloaded nodes", moved)
+
+    @tasks.loop(seconds=30, reconnect=False)
+    async def checkpoint_states(self):
+        # noinspection PyBroadException
+        try:
+            await self.checkpointer.checkpoint()
+        except Exception:
+            logger.warning("Failed to checkpoint music states", exc_info=True)
 
     def cog_unload(self):
-        self.auto_disconnect.cancel()
+        self.rebalance_nodes.cancel()
+        self.checkpoint_states.cancel()
+        if self._lyrics_api:
+            self._lyrics_api.close()
         # noinspection PyProtectedMember
         self.bot.lavalink._event_hooks.clear()
         self.cleanup()
 
     async def cog_before_invoke(self, ctx):
+        ctx.invoked_at = time.perf_counter()
         # TODO: check bot connected
-        if ctx.command.qualified_name in {'musicconfig', 'requestapi', 'aboutmusic'}:
+        if ctx.command.qualified_name in {'musicconfig', 'requestapi', 'aboutmusic', 'musicstats'}:
             return
         if not self.bot.lavalink.node_manager.available_nodes:
             raise Failure(ctx, "Music isn't ready/configured yet, try again later...\n"
@@ -247,8 +277,19 @@ class Music(commands.Cog, name="music"):
                                "perhaps check logs to see the error.")
         await self.ensure_voice(ctx)
 
+    async def cog_after_invoke(self, ctx):
+        metrics.observe(f'command.{ctx.command.qualified_name}', (time.perf_counter() - ctx.invoked_at) * 1000)
+        player = getattr(ctx, 'player', None)
+        if player is not None:
+            # The command didn't end up starting a track
+            player.play_requested_at = None
+
     async def ensure_voice(self, ctx):
-        ctx.player = self.bot.lavalink.player_manager.create(ctx.guild.id, endpoint=str(ctx.guild.region))
+        ctx.player = self.bot.lavalink.player_manager.get(ctx.guild.id)
+        if ctx.player is None:
+            node = self.bot.lavalink.node_balancer.select_for_endpoint(str(ctx.guild.region))
+            ctx.player = self.bot.lavalink.player_manager.create(ctx.guild.id, endpoint=str(ctx.guild.region),
+                                                                 node=node)
         is_universal = ctx.command.qualified_name in {'search', 'lyrics'}
         if is_universal:
             return
@@ -286,12 +327,17 @@ class Music(commands.Cog, name="music"):
             ctx.player.command_channel = ctx.channel
 
     async def track_hook(self, event):
-        if isinstance(event, lavalink.events.QueueEndEvent):
+        if isinstance(event, lavalink.events.TrackStartEvent):
+            # Tracks starting cancel the scheduled disconnect, check if anyone is still listening
+            self.check_idle(event.player)
+
+        elif isinstance(event, lavalink.events.QueueEndEvent):
             player: Player = event.player
             # noinspection PyBroadException
             try:
                 logger.debug("Queue ended")
                 player.playing_message = None
+                player.disconnect_soon(self.bot)
             except Exception:
                 logger.warning("Failed to disconnect / schedule clear queue", exc_info=True)
 
@@ -301,25 +347,28 @@ class Music(commands.Cog, name="music"):
 
         elif isinstance(event, lavalink.events.NodeDisconnectedEvent):
             logger.warning('Node disconnected')
+            self.bot.lavalink.node_balancer.node_disconnected()
 
         elif isinstance(event, lavalink.events.NodeConnectedEvent):
             logger.warning('Node connected')
-            if event.node.name in self.bot.lavalink_saved_states:
-                async def reconnect(gid, data):
-                    # noinspection PyBroadException
-                    try:
-                        logger.info("Recreating player for %s", gid)
-                        await Player.load_dump(self.bot, gid, event.node, data)
-                    except Exception:
-                        logger.warning("Failed to reconnect %s", gid, exc_info=True)
-
-                save = self.bot.lavalink_saved_states.pop(event.node.name)
+            self.bot.lavalink.node_balancer.node_connected()
+            save_name = event.node.name
+            if save_name not in self.bot.lavalink_saved_states:
+                # Node names are regenerated on restart, match the save by address instead
+                save_name = next((name for name, save in self.bot.lavalink_saved_states.items()
+                                  if (save.get('host'), save.get('port')) == (event.node.host, event.node.port)),
+                                 None)
+            if save_name is not None:
+                save = self.bot.lavalink_saved_states.pop(save_name)
+                # Checkpoints may write a new save for this node while restoring
+                root, ext = os.path.splitext(save['path'])
+                save_file = f"{root}.restoring{ext}"
+                os.replace(save['path'], save_file)
                 await self.bot.wait_until_ready()
                 try:
-                    await asyncio.gather(*[reconnect(gid, data) for gid, data in save.items()])
+                    await RestoreScheduler(self.bot, event.node).run(StateCheckpointer.iter_guilds(save_file))
                 finally:
-                    logger.debug("Removing save file for %s", event.node.name)
-                    save_file = os.path.join(MUSIC_STATE_PATH, f"{event.node.name}.json")
+                    logger.debug("Removing save file for %s", save_name)
                     if os.path.exists(save_file):
                         os.unlink(save_file)
 
@@ -371,54 +420,17 @@ class Music(commands.Cog, name="music"):
         except (ValueError, KeyError):
             return None
 
-    @staticmethod
-    def _render(tracks):
-        prefix = "```nim\n"
-        suffix = "\n```"
-        track_per_page = 10
-
-        if not tracks:
-            return [f"{prefix}No tracks found...{suffix}"]
-
-        messages = []
-
-        total_tracks = len(tracks)
-
-        count_length = 1
-        if total_tracks >= 10:
-            count_length += 1
-
-        # TODO: Pad duration too
-        for i, track in enumerate(tracks, start=1):
-            if (i - 1) % track_per_page == 0:
-                messages += [""]
-
-            if i == 91 and total_tracks >= 100:
-                count_length += 1
-
-            block_max_title_length = max(30, len(max(
-                tracks[(i - 1) // track_per_page * track_per_page:
-                       (i - 1) // track_per_page * track_per_page + track_per_page],
-                key=lambda x: len(x.title)).title))
-            title_length = min(39 - count_length, block_max_title_length)
-            title = utils.trim(track.title if track.success else f"[failed] {track.title}",
-                               title_length).ljust(title_length)
+    def _render(self, ctx, tracks) -> TrackPages:
+        # Keep the resolved tracks so they can be played without searching again
+        self._search_sessions[ctx.guild.id, ctx.author.id] = tracks
+        footer = f"Play one of these with `{self.bot.prefix}play #<number>`." if tracks else ""
+        return TrackPages(tracks, footer=footer)
 
-            if hasattr(track, 'duration'):
-                duration = utils.seconds_to_time_string(track.duration / 1000,
-                                                        int_seconds=True, format=2)
-            else:
-                duration = "  ???"
-            messages[-1] += f"{i: >{count_length}}) {title} {duration}\n"
-
-            remaining_tracks = total_tracks - i
-            if i % track_per_page == 0 and remaining_tracks > 0:
-                messages[-1] += f"\n{' ' * count_length}{remaining_tracks} more " \
-                                f"{utils.plural(remaining_tracks, show_count=False):track}"
-
-        for i in range(len(messages)):
-            messages[i] = prefix + messages[i].replace('```', '``\u200b`').replace('@', '@\u200b') + suffix
-        return messages
+    async def _send_pages(self, ctx, pages: TrackPages):
+        if len(pages) == 1:
+            return await ctx.send(pages[0], allowed_mentions=AllowedMentions.none())
+        session = PaginatorSession(ctx, pages=pages)
+        return await session.run()
 
     @commands.cooldown(1, 10)
     @commands.bot_has_permissions(send_messages=True, embed_links=True)
@@ -487,7 +499,7 @@ class Music(commands.Cog, name="music"):
             if not SPOTIFY_CLIENT_ID or not SPOTIFY_CLIENT_SECRET:
                 raise Failure(ctx, "The format for configuring spotify is `SPOTIFY_CLIENT_ID:SPOTIFY_CLIENT_SECRET`.")
             try:
-                self._spotify = Spotify(self.bot, SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET)
+                self._spotify = Spotify(self.http, SPOTIFY_CLIENT_ID, SPOTIFY_CLIENT_SECRET)
                 await self._spotify.get_token()
             except SpotifyError as e:
                 self._spotify = None
@@ -510,7 +522,9 @@ class Music(commands.Cog, name="music"):
             return await ctx.send("Successfully set and enabled spotify!")
         elif type == "genius":
             GENIUS_TOKEN = config
-            self._lyrics_api = Lyrics(GENIUS_TOKEN)
+            if self._lyrics_api:
+                self._lyrics_api.close()
+            self._lyrics_api = self._make_lyrics_api(GENIUS_TOKEN)
             m = await ctx.send("Checking the token... please wait")
             if not await self._lyrics_api.test_token():
                 await self.db.find_one_and_update(
@@ -518,6 +532,7 @@ class Music(commands.Cog, name="music"):
                     {'$set': {'genius_token': None}},
                     upsert=True
                 )
+                self._lyrics_api.close()
                 self._lyrics_api = None
                 raise Failure(ctx, "It seems your Genius API token is invalid...")
             else:
@@ -593,17 +608,12 @@ class Music(commands.Cog, name="music"):
                 tracks = [LazyAudioTrack(f'ytsearch:{title}', title, ctx.author.id, duration=duration, spotify=True)
                           for title, duration in titles]
                 await asyncio.gather(*[track.load(player) for track in tracks])
-                pages = self._render(tracks)
-                if len(pages) == 1:
-                    return await ctx.send(pages[-1], allowed_mentions=AllowedMentions.none())
-                session = PaginatorSession(ctx, *pages)
-                return await session.run()
+                return await self._send_pages(ctx, self._render(ctx, tracks))
 
             track = LazyAudioTrack(f'ytsearch:{titles[0][0]}', titles[0][0], ctx.author.id,
                                    duration=titles[0][1], spotify=True)
             await track.load(player)
-            pages = self._render([track])
-            return await ctx.send(pages[-1], allowed_mentions=AllowedMentions.none())
+            return await self._send_pages(ctx, self._render(ctx, [track]))
 
         if is_youtube_playlist:
             try:
@@ -626,11 +636,7 @@ class Music(commands.Cog, name="music"):
                     # noinspection PyTypeChecker
                     tracks += [LazyAudioTrack.from_loaded(track, ctx.author.id)]
 
-                pages = self._render(tracks)
-                if len(pages) == 1:
-                    return await ctx.send(pages[-1], allowed_mentions=AllowedMentions.none())
-                session = PaginatorSession(ctx, *pages)
-                return await session.run()
+                return await self._send_pages(ctx, self._render(ctx, tracks))
 
             else:
                 logger.error("Shouldn't be here... %s", query)
@@ -650,8 +656,7 @@ class Music(commands.Cog, name="music"):
         for track in result['tracks'][:10]:
             tracks += [LazyAudioTrack.from_loaded(track, ctx.author.id)]
 
-        pages = self._render(tracks)
-        return await ctx.send(pages[-1], allowed_mentions=AllowedMentions.none())
+        return await self._send_pages(ctx, self._render(ctx, tracks))
 
     @commands.cooldown(1, 1.5, type=commands.BucketType.guild)
     @commands.bot_has_permissions(send_messages=True, embed_links=True)
@@ -683,7 +688,25 @@ class Music(commands.Cog, name="music"):
                         logger.debug("Failed to add reaction")
             return await ctx.send('Playing!')
 
+        if not player.is_playing_a_track:
+            # Observed once the track starts, see Queue._play
+            player.play_requested_at = time.perf_counter()
+
         raw_query = track_title = query = query.strip('<>')
+        search_results = self._search_sessions.get((ctx.guild.id, ctx.author.id))
+        result_match = SEARCH_RESULT_REGEX.match(query.strip())
+        # Anything else, or a position that isn't in the search, is searched for as usual
+        if search_results and result_match and 0 < int(result_match.group(1)) <= len(search_results):
+            index = int(result_match.group(1)) - 1
+            # Copy, the same search result may be queued more than once
+            track = LazyAudioTrack.load_dump(search_results[index].dump())
+            track.requester = ctx.author.id
+            if track.loaded and not track.success:
+                raise Failure(ctx, 'No matches found!')
+            await player.play_later(track=track)
+            player.load_next_few()
+            return
+
         matches = URL_REGEX.search(query)
         is_youtube_playlist = False
         if matches:
@@ -717,11 +740,9 @@ class Music(commands.Cog, name="music"):
                 if spotify_image:
                     embed.set_thumbnail(url=spotify_image)
                 await ctx.send(embed=embed)
-                for title, duration in titles:
-                    track = LazyAudioTrack(f'ytsearch:{title}', title, ctx.author.id,
-                                           duration=duration, spotify=True)
-                    await player.play_later(track=track, send_queue_message=False)
-                    tracks += [track]
+                tracks = [LazyAudioTrack(f'ytsearch:{title}', title, ctx.author.id, duration=duration, spotify=True)
+                          for title, duration in titles]
+                await player.enqueue_many(tracks)
             else:
                 track = LazyAudioTrack(f'ytsearch:{titles[0][0]}', titles[0][0], ctx.author.id,
                                        duration=titles[0][1], spotify=True)
@@ -758,12 +779,10 @@ class Music(commands.Cog, name="music"):
                         colour=self.bot.main_color
                     )
                     await ctx.send(embed=embed)
-                    for track in result['tracks']:
-                        # noinspection PyTypeChecker
-                        track = LazyAudioTrack.from_loaded(track, ctx.author.id)
-                        await player.play_later(track=track, send_queue_message=False)
-                        if track.success:
-                            loaded_any_song = True
+                    # noinspection PyTypeChecker
+                    playlist = [LazyAudioTrack.from_loaded(track, ctx.author.id) for track in result['tracks']]
+                    await player.enqueue_many(playlist)
+                    loaded_any_song = any(track.success for track in playlist)
                 else:
                     logger.error("Shouldn't be here... %s", query)
                     raise Failure(ctx, "An unknown error has occurred... try again later")
@@ -895,6 +914,7 @@ class Music(commands.Cog, name="music"):
         """Clears the queue"""
         player: Player = ctx.player
         await player.queue.clear()
+        self.check_idle(player)
         if ctx.channel.permissions_for(ctx.guild.me).add_reactions:
             try:
                 return await ctx.message.add_reaction("👌")
@@ -946,6 +966,7 @@ class Music(commands.Cog, name="music"):
         player: Player = ctx.player
 
         await player.queue.stop()
+        self.check_idle(player)
         if ctx.channel.permissions_for(ctx.guild.me).add_reactions:
             try:
                 return await ctx.message.add_reaction("🛑")
@@ -1352,6 +1373,97 @@ class Music(commands.Cog, name="music"):
         session = EmbedPaginatorSession(ctx, *embeds)
         await session.run()
 
+    def collect_stats(self) -> dict:
+        balancer = self.bot.lavalink.node_balancer
+        nodes = {}
+        for node in self.bot.lavalink.node_manager.nodes:
+            stats = node.stats
+            nodes[node.name] = dict(
+                available=node.available,
+                players=stats.players if stats else None,
+                playing_players=stats.playing_players if stats else None,
+                system_load=stats.system_load if stats else None,
+                frame_loss=balancer.frame_loss(node),
+                penalty=stats.penalty.total if stats else None,
+            )
+
+        players = [p for p in self.bot.lavalink.player_manager.players.values() if p.is_playing_a_track]
+        preloaded = [p.queue.preloaded for p in players]
+        return dict(
+            nodes=nodes,
+            http=self.http.dump_stats(),
+            caches=dict(
+                req_lavalink_track=Player.req_lavalink_track.cache_info(),
+                req_lavalink_playlist=Player.req_lavalink_playlist.cache_info(),
+                req_spotify=Music._req_spotify.cache_info(),
+            ),
+            preload=dict(
+                playing_players=len(players),
+                avg_preloaded=sum(preloaded) / len(preloaded) if preloaded else 0.0,
+                starved_players=sum(1 for n in preloaded if n == 0),
+                lookahead=Queue.LOOKAHEAD,
+            ),
+            track_infos=TrackInfo.count(),
+            metrics=metrics.dump(),
+        )
+
+    @commands.bot_has_permissions(send_messages=True, embed_links=True, attach_files=True)
+    @commands.command()
+    @checks.has_permissions(PermissionLevel.OWNER)
+    async def musicstats(self, ctx, output: Str(lower=True) = None):
+        """
+        Shows where music playback is spending its time.
+
+        Run `{prefix}musicstats json` to get the full dump as a file.
+        """
+        stats = self.collect_stats()
+        if output == 'json':
+            data = json.dumps(stats, indent=2).encode()
+            return await ctx.send(file=discord.File(io.BytesIO(data), filename='musicstats.json'))
+
+        def fmt_histogram(h):
+            return f"{h['count']} × avg {h['avg_ms']:.0f}ms, p95 {h['p95_ms']:.0f}ms"
+
+        def fmt_cache(c):
+            total = c['hits'] + c['misses']
+            return f"{c['hits'] / total:.0%} of {total} ({c['size']}/{c['maxsize']})" if total else "unused"
+
+        histograms = stats['metrics']['histograms']
+        embed = discord.Embed(title="Music stats", colour=self.bot.main_color)
+        for name, node in stats['nodes'].items():
+            lines = [
+                "Available" if node['available'] else "**Unavailable**",
+                f"Players: {node['playing_players']}/{node['players']}, load {node['system_load'] or 0:.0%}, "
+                f"frame loss {node['frame_loss']:.1%}",
+            ]
+            for key, label in (('loadtracks', 'loadtracks'), ('play_op', 'play op'),
+                               ('player_update_delay', 'playerUpdate delay')):
+                h = histograms.get(f'lavalink.{key}.{name}')
+                if h:
+                    lines.append(f"{label}: {fmt_histogram(h)}")
+            embed.add_field(name=f"Node {name}", value="\n".join(lines), inline=False)
+
+        upstreams = [f"{name}: {s['requests']} × avg {s['avg_ms']:.0f}ms, p95 {s['p95_ms']:.0f}ms, "
+                     f"{s['errors']} errors, {s['retries']} retries" for name, s in stats['http'].items()]
+        embed.add_field(name="HTTP", value="\n".join(upstreams) or "No requests yet", inline=False)
+
+        counters = stats['metrics']['counters']
+        lyrics_total = counters.get('lyrics.cache_hits', 0) + counters.get('lyrics.cache_misses', 0)
+        caches = [f"{name}: {fmt_cache(c)}" for name, c in stats['caches'].items()]
+        caches.append(f"lyrics: {counters.get('lyrics.cache_hits', 0) / lyrics_total:.0%} of {lyrics_total}, "
+                      f"{counters.get('lyrics.merged', 0)} merged" if lyrics_total else "lyrics: unused")
+        caches.append(f"Shared track infos: {stats['track_infos']}")
+        embed.add_field(name="Caches", value="\n".join(caches), inline=False)
+
+        preload = stats['preload']
+        playback = [f"Preloaded: {preload['avg_preloaded']:.1f}/{preload['lookahead']} on average, "
+                    f"{preload['starved_players']}/{preload['playing_players']} players with none"]
+        h = histograms.get('play.command_to_start')
+        if h:
+            playback.append(f"Play to track start: {fmt_histogram(h)}")
+        embed.add_field(name="Playback", value="\n".join(playback), inline=False)
+        await ctx.send(embed=embed)
+
     @commands.bot_has_permissions(send_messages=True, embed_links=True)
     @commands.command()
     @checks.has_permissions(PermissionLevel.REGULAR)
@@ -0,0 +1,104 @@
+"""
+Lyrics lookups against a local fake Genius, which serves the search API and the song pages.
+"""
+
+import asyncio
+
+import pytest
+
+pytest.importorskip('aiohttp')
+pytest.importorskip('bs4')
+pytest.importorskip('core')
+
+from aiohttp import web  # noqa: E402
+from aiohttp.test_utils import TestServer  # noqa: E402
+
+from music._music.httpclient import HTTPClient  # noqa: E402
+from music._music.lyrics import Lyrics  # noqa: E402
+
+CURRENT_PAGE = """
+<html><body>
+<div data-lyrics-container="true"><div class="LyricsHeader__Container">Never Gonna Give You Up Lyrics</div>
+Never gonna give you up<br/>Never gonna let you down</div>
+</body></html>
+"""
+
+OLD_PAGE = """
+<html><body>
+<div class="lyrics"><p>Never gonna run around<br/>And desert you</p></div>
+</body></html>
+"""
+
+
+class FakeGenius:
+    def __init__(self, page=CURRENT_PAGE, delay=0.05):
+        self.page = page
+        self.delay = delay
+        self.searches = 0
+        self.pages = 0
+        self.app = web.Application()
+        self.app.router.add_get('/search', self.search)
+        self.app.router.add_get('/Rick-astley-never-gonna-give-you-up-lyrics', self.song)
+
+    async def search(self, request):
+        self.searches += 1
+        assert request.headers['Authorization'] == 'Bearer token'
+        await asyncio.sleep(self.delay)
+        return web.json_response({'response': {'hits': [{'type': 'song', 'result': {
+            'title': 'Never Gonna Give You Up',
+            'primary_artist': {'name': 'Rick Astley'},
+            'url': 'https://genius.com/Rick-astley-never-gonna-give-you-up-lyrics',
+        }}]}})
+
+    async def song(self, request):
+        self.pages += 1
+        return web.Response(text=self.page, content_type='text/html')
+
+
+async def _lookups(genius, cache_path, *queries, rounds=1):
+    # Each round uses a new client, only the sqlite cache is shared between them
+    server = TestServer(genius.app)
+    await server.start_server()
+    base = str(server.make_url('/'))
+    results = []
+    try:
+        for _ in range(rounds):
+            http = HTTPClient()
+            lyrics = Lyrics('token', http, cache_path=cache_path, api_base=base, web_base=base)
+            try:
+                results.extend(await asyncio.gather(*(lyrics.fetch_lyrics(*q) for q in queries)))
+            finally:
+                lyrics.close()
+                await http.close()
+    finally:
+        await server.close()
+    return results
+
+
+def test_concurrent_lookups_are_merged():
+    genius = FakeGenius()
+    first, second = asyncio.run(_lookups(genius, None, ('Never Gonna Give You Up', 'Rick Astley'),
+                                         ('never gonna give you up (feat. nobody)', 'rick astley')))
+    assert genius.searches == 1 and genius.pages == 1
+    assert first is second
+    assert first.lyrics == 'Never gonna give you up\nNever gonna let you down'
+
+
+def test_second_lookup_is_a_cache_hit(tmp_path):
+    cache_path = str(tmp_path / 'lyrics.sqlite3')
+    genius = FakeGenius()
+    song, cached = asyncio.run(_lookups(genius, cache_path, ('Never Gonna Give You Up', 'Rick Astley'), rounds=2))
+    assert genius.searches == 1
+    assert (cached.title, cached.artist, cached.lyrics) == (song.title, song.artist, song.lyrics)
+
+
+def test_older_page_layout_is_parsed():
+    genius = FakeGenius(OLD_PAGE)
+    song, = asyncio.run(_lookups(genius, None, ('Never Gonna Give You Up', None)))
+    assert song.lyrics == 'Never gonna run around\nAnd desert you'
+
+
+def test_page_without_lyrics():
+    genius = FakeGenius('<html><body><div class="instrumental">Instrumental</div></body></html>')
+    song, = asyncio.run(_lookups(genius, None, ('Never Gonna Give You Up', None)))
+    assert song is None
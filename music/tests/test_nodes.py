@@ -0,0 +1,94 @@
+"""
+Simulated multi-node setups for the node balancer, the nodes and players are plain fakes fed with Lavalink stats.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('lavalink')
+pytest.importorskip('discord')
+pytest.importorskip('core')
+
+from music._music.nodes import NodeBalancer  # noqa: E402
+
+
+def make_stats(players=0, playing=0, system_load=0.1, lavalink_load=0.05, nulled=0, deficit=0):
+    # frameStats are averages per playing player over the last minute, like Lavalink sends them
+    return SimpleNamespace(players=players, playing_players=playing, system_load=system_load,
+                           lavalink_load=lavalink_load, frames_nulled=nulled, frames_deficit=deficit)
+
+
+def make_node(name, region='us', **stats):
+    return SimpleNamespace(name=name, region=region, available=True, stats=make_stats(**stats) if stats else None)
+
+
+class FakePlayer:
+    def __init__(self, guild_id, node, playing=True):
+        self.guild_id = guild_id
+        self.node = node
+        self.is_playing_a_track = playing
+
+    async def change_node(self, node):
+        self.node = node
+
+
+def make_balancer(nodes, players=()):
+    client = SimpleNamespace(
+        node_manager=SimpleNamespace(available_nodes=[n for n in nodes if n.available]),
+        player_manager=SimpleNamespace(players={p.guild_id: p for p in players}),
+    )
+    return NodeBalancer(client)
+
+
+def test_frame_loss_is_not_divided_by_players():
+    # 300 of 3000 frames lost on average for each of the 100 playing players
+    node = make_node('busy', players=100, playing=100, deficit=300)
+    balancer = make_balancer([node])
+    assert balancer.frame_loss(node) == pytest.approx(0.1)
+    assert balancer.is_overloaded(node)
+
+
+def test_select_avoids_lossy_node():
+    lossy = make_node('lossy', players=10, playing=10, nulled=200, deficit=200)
+    fine = make_node('fine', players=40, playing=40)
+    balancer = make_balancer([lossy, fine])
+    assert balancer.select() is fine
+
+
+def test_select_prefers_region_and_least_loaded():
+    eu_busy = make_node('eu-busy', region='eu', players=50, playing=50, system_load=0.5)
+    eu_idle = make_node('eu-idle', region='eu', players=2, playing=2)
+    us_idle = make_node('us-idle', region='us')
+    balancer = make_balancer([eu_busy, eu_idle, us_idle])
+    assert balancer.select('eu') is eu_idle
+    assert balancer.select('asia') is us_idle
+
+
+def test_select_counts_local_players_before_stats():
+    first = make_node('first')
+    second = make_node('second')
+    players = [FakePlayer(i, first) for i in range(3)]
+    balancer = make_balancer([first, second], players)
+    assert balancer.select() is second
+
+
+def test_rebalance_moves_playing_players_off_overloaded_node():
+    overloaded = make_node('overloaded', players=20, playing=10, system_load=0.95)
+    healthy = make_node('healthy', players=1, playing=1)
+    idle = [FakePlayer(i, overloaded, playing=False) for i in range(10)]
+    playing = [FakePlayer(i, overloaded) for i in range(10, 20)]
+    balancer = make_balancer([overloaded, healthy], idle + playing)
+
+    moved = asyncio.run(balancer.rebalance())
+
+    assert moved == NodeBalancer.MAX_MOVES
+    assert [p for p in idle + playing if p.node is healthy] == playing[:NodeBalancer.MAX_MOVES]
+
+
+def test_rebalance_leaves_healthy_nodes_alone():
+    nodes = [make_node(f'node-{i}', players=5, playing=5) for i in range(3)]
+    players = [FakePlayer(i, nodes[i % 3]) for i in range(9)]
+    balancer = make_balancer(nodes, players)
+    assert asyncio.run(balancer.rebalance()) == 0
@@ -0,0 +1,140 @@
+"""
+Play position drift across playerUpdates, node changes and gaps in the updates, on a fake clock.
+"""
+
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('lavalink')
+pytest.importorskip('discord')
+pytest.importorskip('core')
+
+from music._music import queue as queue_module  # noqa: E402
+from music._music._player import Player  # noqa: E402
+
+DURATION = 200_000
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class FakeNode:
+    def __init__(self, name):
+        self.name = name
+        self.available = True
+        self.sent = []
+        self._manager = SimpleNamespace(available_nodes=[self], _lavalink=SimpleNamespace(node_balancer=None))
+
+    async def _send(self, **op):
+        self.sent.append(op)
+
+    async def _dispatch_event(self, event):
+        pass
+
+
+class FakeTrack:
+    loaded = True
+    success = True
+    duration = DURATION
+    track = 'QAAAjQIAJFJpY2sgQXN0bGV5'
+    title = 'Never Gonna Give You Up'
+    uri = 'https://www.youtube.com/watch?v=dQw4w9WgXcQ'
+    requester = 1
+
+    async def load(self, player):
+        pass
+
+    def unload(self):
+        pass
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(queue_module, 'time', SimpleNamespace(monotonic=clock, time=time.time))
+    return clock
+
+
+async def _playing_player(node):
+    player = Player(1, node)
+    player.channel_id = '2'
+    player.queue.add(FakeTrack())
+    await player.play_next()
+    return player
+
+
+def test_position_resyncs_across_node_change(clock):
+    async def run():
+        old, new = FakeNode('old'), FakeNode('new')
+        player = await _playing_player(old)
+        clock.advance(4)
+        assert player.position == 4000
+
+        # The node was a little behind the extrapolation
+        await player._update_state({'position': 3900, 'time': int(time.time() * 1000)})
+        assert player.position == 3900
+        clock.advance(2)
+        assert player.position == 5900
+
+        await player.change_node(new)
+        assert old.sent[-1] == {'op': 'destroy', 'guildId': '1'}
+        assert new.sent[0]['op'] == 'play' and new.sent[0]['startTime'] == 5900
+        assert player.position == 5900
+
+        clock.advance(1)
+        assert player.position == 6900
+        await player._update_state({'position': 6850, 'time': int(time.time() * 1000)})
+        assert player.position == 6850
+
+    asyncio.run(run())
+
+
+def test_stale_position_is_clamped_until_the_next_update(clock):
+    async def run():
+        player = await _playing_player(FakeNode('node'))
+        clock.advance(30)
+        assert player.position == queue_module.Queue.POSITION_STALE_AFTER * 1000
+        assert player.queue._stale
+
+        # The next playerUpdate resyncs it
+        await player._update_state({'position': 31000, 'time': int(time.time() * 1000)})
+        assert not player.queue._stale
+        clock.advance(1)
+        assert player.position == 32000
+
+    asyncio.run(run())
+
+
+def test_stale_position_is_replayed_on_a_new_node(clock):
+    async def run():
+        old, new = FakeNode('old'), FakeNode('new')
+        player = await _playing_player(old)
+        clock.advance(60)
+        await player.change_node(new)
+        # Picks up from the last position that can be vouched for
+        assert new.sent[0]['startTime'] == queue_module.Queue.POSITION_STALE_AFTER * 1000
+        assert not player.queue._stale
+
+    asyncio.run(run())
+
+
+def test_paused_position_does_not_move(clock):
+    async def run():
+        player = await _playing_player(FakeNode('node'))
+        clock.advance(3)
+        await player.set_pause(True)
+        clock.advance(20)
+        assert player.position == 3000
+
+    asyncio.run(run())
@@ -0,0 +1,35 @@
+"""
+Preloading of upcoming tracks, on tracks that only count their loads.
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip('lavalink')
+pytest.importorskip('discord')
+pytest.importorskip('core')
+
+from music._music.queue import Queue  # noqa: E402
+
+
+class CountingTrack:
+    def __init__(self):
+        self.loaded = False
+        self.success = False
+
+    async def load(self, player):
+        self.loaded = self.success = True
+
+    def unload(self):
+        self.loaded = self.success = False
+
+
+def test_lookahead_change_reaches_existing_queues(monkeypatch):
+    queue = Queue(SimpleNamespace(dirty=False, guild_id='1'))
+    queue.extend(CountingTrack() for _ in range(20))
+
+    monkeypatch.setattr(Queue, 'LOOKAHEAD', 8)
+    assert asyncio.run(queue._load_next()) == 8
+    assert queue.preloaded == 8
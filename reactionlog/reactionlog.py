@@ -1,6 +1,8 @@
 import asyncio
 import datetime
 import re
+import time
+from collections import OrderedDict
 
 import discord
 from discord import utils
@@ -11,13 +13,66 @@ RE_WEBHOOK_NAME = re.compile(r"webhook name:\s*(.+)\n", re.I)
 RE_EMOJI = re.compile(r'<(a?):([a-zA-Z0-9_]+):([0-9]+)>', re.I)
 
 
+class ReactionWindow:
+    """
+    Reactions added to one message, grouped by emoji, until the message goes quiet.
+    """
+
+    def __init__(self, channel, message_id):
+        self.channel = channel
+        self.message_id = message_id
+        self.opened_at = self.last_at = time.monotonic()
+        self.total = 0
+        # emoji key -> [emoji, count, [user names]]
+        self.emojis = OrderedDict()
+        # (user, emoji, time) of each reaction, only kept while it's still going to be detailed
+        self.details = []
+
+    def add(self, user, emoji, users_listed, detail_threshold):
+        self.last_at = time.monotonic()
+        self.total += 1
+        entry = self.emojis.get(str(emoji))
+        if entry is None:
+            entry = self.emojis[str(emoji)] = [emoji, 0, []]
+        entry[1] += 1
+        stored = 0
+        if len(entry[2]) < users_listed:
+            entry[2].append(str(user))
+            stored += 1
+        if self.total <= detail_threshold:
+            self.details.append((user, emoji, datetime.datetime.utcnow()))
+        else:
+            self.details.clear()
+        return stored
+
+
 class ReactionLogger(commands.Cog):
+    # A message's reactions are sent once it had none for AGGREGATE_WINDOW seconds, or after MAX_WINDOW seconds
+    AGGREGATE_WINDOW = 10
+    MAX_WINDOW = 60
+    # Up to this many reactions are sent one embed each, more become a summary
+    DETAIL_THRESHOLD = 5
+    USERS_LISTED = 20
+    # Discord rejects embeds over 6000 characters, keep some room for the "more emojis" line
+    MAX_EMBED_LENGTH = 5800
+    # Memory budget, the oldest window is sent early when either is reached
+    MAX_OPEN_WINDOWS = 500
+    MAX_STORED_USERS = 20000
+
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.webhook: discord.Webhook = None
         self.channel: discord.TextChannel = None
         self.ignored_list = []
+        self.windows = OrderedDict()
+        self.stored_users = 0
         asyncio.create_task(self.cog_load())
+        self.flush_task = asyncio.create_task(self.flush_windows())
+
+    def cog_unload(self):
+        self.flush_task.cancel()
+        for message_id in list(self.windows):
+            asyncio.create_task(self.send_window(self.pop_window(message_id)))
 
     async def cog_load(self):
         await self.bot.wait_until_ready()
@@ -302,18 +357,59 @@ class ReactionLogger(commands.Cog):
             return
 
         channel: discord.TextChannel = self.bot.get_channel(payload.channel_id)
-        message: discord.PartialMessage = channel.get_partial_message(payload.message_id)
-        emoji: discord.PartialEmoji = payload.emoji
+        window = self.windows.get(payload.message_id)
+        if window is None:
+            window = self.windows[payload.message_id] = ReactionWindow(channel, payload.message_id)
+        self.stored_users += window.add(user, payload.emoji, self.USERS_LISTED, self.DETAIL_THRESHOLD)
+
+        while len(self.windows) > self.MAX_OPEN_WINDOWS or self.stored_users > self.MAX_STORED_USERS:
+            await self.send_window(self.pop_window(next(iter(self.windows))))
+
+    def pop_window(self, message_id):
+        window = self.windows.pop(message_id)
+        self.stored_users -= sum(len(users) for _, _, users in window.emojis.values())
+        return window
+
+    async def flush_windows(self):
+        while True:
+            await asyncio.sleep(1)
+            if not self.webhook:
+                # Kept until there's somewhere to send them
+                continue
+            now = time.monotonic()
+            done = [message_id for message_id, window in self.windows.items()
+                    if now - window.last_at >= self.AGGREGATE_WINDOW or now - window.opened_at >= self.MAX_WINDOW]
+            for message_id in done:
+                await self.send_window(self.pop_window(message_id))
+
+    async def send_window(self, window):
+        if not self.webhook:
+            print("No reaction logs webhook, dropped the reactions to", window.message_id)
+            return
+        try:
+            if window.details:
+                embeds = [self.reaction_embed(window.channel, window.message_id, user, emoji, timestamp)
+                          for user, emoji, timestamp in window.details]
+                await self.webhook.send(embeds=embeds)
+            else:
+                await self.webhook.send(embed=self.summary_embed(window))
+        except discord.HTTPException as e:
+            print("Failed to send reaction logs", e)
+
+    @staticmethod
+    def emoji_text(emoji):
         if emoji.is_custom_emoji():
-            emoji_text = f"`:{emoji.name}:`"
-        else:
-            emoji_text = str(emoji)
+            return f"`:{emoji.name}:`"
+        return str(emoji)
+
+    def reaction_embed(self, channel, message_id, user, emoji, timestamp):
+        emoji_text = self.emoji_text(emoji)
 
         embed = discord.Embed(
-            description=f"**Message:** [Jump!](https://discord.com/channels/{channel.guild.id}/{channel.id}/{message.id}) {channel.mention}\n",
+            description=f"**Message:** [Jump!](https://discord.com/channels/{channel.guild.id}/{channel.id}/{message_id}) {channel.mention}\n",
             colour=0xffd1df,
         )
-        embed.timestamp = datetime.datetime.utcnow()
+        embed.timestamp = timestamp
 
         try:
             if emoji.is_custom_emoji():
@@ -329,8 +425,36 @@ class ReactionLogger(commands.Cog):
 
         embed.set_footer(text=f"User ID: {user.id}\n"
                               f"Channel ID: {channel.id}\n"
-                              f"Message ID: {message.id}")
-        await self.webhook.send(embed=embed)
+                              f"Message ID: {message_id}")
+        return embed
+
+    def summary_embed(self, window):
+        channel = window.channel
+        embed = discord.Embed(
+            description=f"**Message:** [Jump!](https://discord.com/channels/{channel.guild.id}/{channel.id}/{window.message_id}) {channel.mention}\n",
+            colour=0xffd1df,
+        )
+        embed.timestamp = datetime.datetime.utcnow()
+        embed.set_author(name=f"{window.total} reactions added")
+
+        entries = list(window.emojis.values())
+        for i, (emoji, count, users) in enumerate(entries):
+            more = count - len(users)
+            more_text = f" and {more} more" if more > 0 else ""
+            name = f"{self.emoji_text(emoji)} \u00d7 {count}"
+            value = (', '.join(discord.utils.escape_markdown(u) for u in users) + more_text)[:1024]
+            # The last field is kept for the emojis that don't fit
+            if len(embed.fields) >= 24 or len(embed) + len(name) + len(value) > self.MAX_EMBED_LENGTH:
+                rest = entries[i:]
+                rest_total = sum(c for _, c, _ in rest)
+                embed.add_field(name=f"And {len(rest)} more emoji{'s' if len(rest) != 1 else ''}",
+                                value=f"{rest_total} reaction{'s' if rest_total != 1 else ''}", inline=False)
+                break
+            embed.add_field(name=name, value=value, inline=False)
+
+        embed.set_footer(text=f"Channel ID: {channel.id}\n"
+                              f"Message ID: {window.message_id}")
+        return embed
 
 
 def setup(bot):